@@ -1,9 +1,98 @@
 from utils import Utils
+import re
 import numpy as np
+from collections import OrderedDict
 from enum import Enum
+from mesh_topology import MeshTopology
 from PyQt5.QtGui import QColor
 import json
 
+'''
+PointBuffer lets rows be added to an array of points (for
+instance, a fragment's gpoints) without copying the whole
+array every time, as np.append and np.insert do.
+The array that is handed out is a view of the first rows of
+a larger buffer, whose capacity is doubled whenever it runs
+out, so that adding a row costs amortized O(1) in allocation.
+Only the array most recently returned by the buffer is
+extended in place; any other array (for instance, one that
+was created by np.delete, or an older, shorter view) is 
+first copied into a new buffer.
+The arrays are stored as ordinary attributes (so that the
+rest of the code sees a normal numpy array); appendTo and 
+insertInto look up the PointBuffer for a given attribute 
+in the owner's point_buffers dict.
+'''
+class PointBuffer:
+
+    min_capacity = 16
+
+    def __init__(self):
+        self.data = None
+        self.length = 0
+
+    # class function
+    # Appends rows to the array obj.<name>
+    def appendTo(obj, name, rows):
+        buf = obj.point_buffers.setdefault(name, PointBuffer())
+        setattr(obj, name, buf.append(getattr(obj, name), rows))
+
+    # class function
+    # Inserts rows into the array obj.<name>, before row index
+    def insertInto(obj, name, index, rows):
+        buf = obj.point_buffers.setdefault(name, PointBuffer())
+        setattr(obj, name, buf.insert(getattr(obj, name), index, rows))
+
+    # whether arr is the array most recently returned
+    def holds(self, arr):
+        data = self.data
+        return (data is not None and isinstance(arr, np.ndarray) 
+                and arr.base is data and len(arr) == self.length
+                and arr.dtype == data.dtype and arr.strides == data.strides
+                and arr.__array_interface__['data'][0] == data.__array_interface__['data'][0])
+
+    # makes sure that the buffer holds arr (converted to dtype),
+    # with room for nrows more rows
+    def reserve(self, arr, nrows, dtype):
+        n = len(arr)
+        if self.holds(arr) and arr.dtype == dtype and n+nrows <= len(self.data):
+            return
+        capacity = max(PointBuffer.min_capacity, 2*(n+nrows))
+        data = np.empty((capacity,)+arr.shape[1:], dtype=dtype)
+        data[:n] = arr
+        self.data = data
+        self.length = n
+
+    # Returns arr with rows added at the end.  As with
+    # np.append, the result has the dtype of arr and rows
+    # combined.
+    def append(self, arr, rows):
+        arr = np.asarray(arr)
+        rows = np.asarray(rows)
+        dtype = np.result_type(arr, rows)
+        rows = rows.reshape((-1,)+arr.shape[1:])
+        n = len(arr)
+        k = len(rows)
+        self.reserve(arr, k, dtype)
+        self.data[n:n+k] = rows
+        self.length = n+k
+        return self.data[:n+k]
+
+    # Returns arr with rows inserted before row index.  As
+    # with np.insert, the result has the dtype of arr.
+    def insert(self, arr, index, rows):
+        arr = np.asarray(arr)
+        rows = np.asarray(rows).reshape((-1,)+arr.shape[1:])
+        n = len(arr)
+        k = len(rows)
+        self.reserve(arr, k, arr.dtype)
+        data = self.data
+        if index < n:
+            data[index+k:n+k] = data[index:n]
+        data[index:index+k] = rows
+        self.length = n+k
+        return data[:n+k]
+
 class BaseFragment:
     class Type(Enum):
         TRGL_FRAGMENT = "3D"
@@ -19,6 +108,8 @@ class BaseFragment:
         self.valid = False
         self.project = None
         self.type = None
+        # see PointBuffer
+        self.point_buffers = {}
 
     def notifyModified(self, tstamp=""):
         if tstamp == "":
@@ -92,22 +183,188 @@ class BaseFragment:
         return ""
 
     # class function
-    # returns normals at points
+    # Writes each row of arr to the text file of, formatted 
+    # by fmt (for instance "v %f %f %f\n").  The result is
+    # exactly the same as calling of.write(fmt%tuple(row)) for
+    # each row, but the rows are formatted a chunk at a time, 
+    # and each chunk is written as one large string.
+    # When fmt contains only %d, %f, and %.Nf conversions, and
+    # the values allow it (see objColumnChars), the formatting
+    # is done by numpy; otherwise a single % operation
+    # formats each chunk.
+    def writeObjRows(of, fmt, arr, chunk=65536):
+        arr = np.asarray(arr)
+        if len(arr) == 0:
+            return
+        arr = arr.reshape(len(arr), -1)
+        # pieces alternate between literal text and conversions
+        pieces = re.split(r'(%(?:\.\d)?[df])', fmt)
+        specs = pieces[1::2]
+        literals = pieces[0::2]
+        fast = (len(specs) == arr.shape[1] and 
+                not any('%' in literal for literal in literals))
+        for start in range(0, len(arr), chunk):
+            rows = arr[start:start+chunk]
+            text = None
+            if fast:
+                text = BaseFragment.formatObjRows(literals, specs, rows)
+            if text is None:
+                # tolist converts to python floats and ints, 
+                # which format exactly as numpy scalars do
+                text = (fmt*len(rows)) % tuple(rows.ravel().tolist())
+            of.write(text)
+
+    # class function
+    # Formats rows with numpy; returns None if any of the
+    # columns can't be formatted this way
+    def formatObjRows(literals, specs, rows):
+        n = len(rows)
+        chars = []
+        masks = []
+        for i, literal in enumerate(literals):
+            if literal != "":
+                lchars = np.frombuffer(literal.encode('ascii'), dtype=np.uint8)
+                chars.append(np.broadcast_to(lchars, (n, len(lchars))))
+                masks.append(np.ones((n, len(lchars)), dtype=np.bool_))
+            if i < len(specs):
+                result = BaseFragment.objColumnChars(rows[:,i], specs[i])
+                if result is None:
+                    return None
+                chars.extend(result[0])
+                masks.extend(result[1])
+        chars = np.concatenate(chars, axis=1)
+        masks = np.concatenate(masks, axis=1)
+        return chars[masks].tobytes().decode('ascii')
+
+    # class function
+    # Returns the ASCII digits of the non-negative integers
+    # in mag (uint64) as an (n, ndigits) array, along with
+    # a mask that excludes the leading zeros (but keeps
+    # at least one digit).  If ndigits is not given, it is
+    # the number of digits in the largest value.
+    def objDigitChars(mag, ndigits=None):
+        top = int(mag.max())
+        if ndigits is None:
+            ndigits = len(str(top))
+        # uint32 division is much faster than uint64
+        if top < 2**32:
+            mag = mag.astype(np.uint32)
+        else:
+            mag = mag.copy()
+        digits = np.empty((len(mag), ndigits), dtype=np.uint8)
+        nonzero = np.empty((len(mag), ndigits), dtype=np.bool_)
+        for j in range(ndigits-1, -1, -1):
+            q = mag // 10
+            digits[:,j] = mag - q*10
+            nonzero[:,j] = (mag != 0)
+            mag = q
+        digits += ord('0')
+        nonzero[:,-1] = True
+        return digits, nonzero
+
+    # class function
+    # Formats a column of values as the conversion spec
+    # ("%d", "%f", or "%.Nf") would.  Returns (chars, masks),
+    # two lists of arrays to be concatenated horizontally, or
+    # None if the values can't be handled:
+    # "%d" requires integers; "%f" requires values that are 
+    # finite, less than 2**31 in magnitude, and exactly 
+    # representable as float32 (so that they can be rounded 
+    # exactly using int64 arithmetic).
+    def objColumnChars(col, spec):
+        n = len(col)
+        if spec == "%d":
+            if col.dtype.kind not in "iu" or col.dtype == np.uint64:
+                return None
+            neg = (col < 0)
+            mag = np.abs(col.astype(np.int64)).astype(np.uint64)
+            digits, dmask = BaseFragment.objDigitChars(mag)
+            sign = np.full((n,1), ord('-'), dtype=np.uint8)
+            return [sign, digits], [neg[:,np.newaxis], dmask]
+
+        precision = 6
+        if spec != "%f":
+            precision = int(spec[2])
+        if col.dtype.kind != 'f':
+            return None
+        col32 = col.astype(np.float32)
+        if col.dtype != np.float32 and not np.array_equal(col32, col):
+            return None
+        if not np.isfinite(col32).all() or (np.abs(col32) >= 2.**31).any():
+            return None
+        # col32 = mant * 2**exp exactly, with mant an integer
+        mant, exp = np.frexp(col32)
+        mant = np.abs(mant.astype(np.float64)*2.**24).astype(np.int64)
+        exp = exp.astype(np.int64)-24
+        scaled = mant*10**precision
+        # round scaled / 2**(-exp) to the nearest integer,
+        # ties to even, which is what python's % does (the
+        # rounding is done on the exact binary value)
+        shift = np.clip(-exp, 1, 62)
+        q = scaled >> shift
+        rem = scaled & ((np.int64(1) << shift)-1)
+        half = np.int64(1) << (shift-1)
+        rounded = q + ((rem > half) | ((rem == half) & ((q & 1) == 1)))
+        rounded = np.where(exp >= 0, scaled << np.clip(exp, 0, 62), rounded)
+        # values smaller than 2**-62 round to 0
+        rounded[-exp > 62] = 0
+        rounded = rounded.astype(np.uint64)
+        ipart = rounded // np.uint64(10**precision)
+        fpart = rounded % np.uint64(10**precision)
+        # negative values (including -0., and values that 
+        # round to 0) keep their sign
+        neg = np.signbit(col32)
+        sign = np.full((n,1), ord('-'), dtype=np.uint8)
+        idigits, imask = BaseFragment.objDigitChars(ipart)
+        chars = [sign, idigits]
+        masks = [neg[:,np.newaxis], imask]
+        if precision > 0:
+            fdigits, _ = BaseFragment.objDigitChars(fpart, precision)
+            chars.extend([np.full((n,1), ord('.'), dtype=np.uint8), fdigits])
+            masks.extend([np.ones((n,1), dtype=np.bool_), np.ones((n,precision), dtype=np.bool_)])
+        return chars, masks
+
+    # class function
+    # returns normals at points: at each point, the sum
+    # of the (area-weighted) normals of the trgls that
+    # share that point, normalized
     def pointNormals(pts, trgls):
+        vecs = BaseFragment.trglNormalVectors(pts, trgls)
+        sums = BaseFragment.sumTrglVectorsAtPoints(len(pts), trgls, vecs)
+        return BaseFragment.unitVectors(sums)
+
+    # class function
+    # returns the cross product of two edges of each trgl
+    # (float64, not normalized; its length is twice the
+    # trgl's area)
+    def trglNormalVectors(pts, trgls):
         v0 = trgls[:,0]
         v1 = trgls[:,1]
         v2 = trgls[:,2]
         d01 = (pts[v1] - pts[v0]).astype(np.float64)
         d02 = (pts[v2] - pts[v0]).astype(np.float64)
-        n3d = np.cross(d01, d02)
-        ptn = np.zeros((len(pts), 3), np.float32)
-        ptn[v0] += n3d
-        ptn[v1] += n3d
-        ptn[v2] += n3d
-        l2 = np.sqrt(np.sum(ptn*ptn, axis=1)).reshape(-1,1)
+        return np.cross(d01, d02).reshape(-1, 3)
+
+    # class function
+    # returns, for each of the npts points, the sum of the
+    # vecs (one per trgl) of the trgls that share that point
+    def sumTrglVectorsAtPoints(npts, trgls, vecs):
+        idxs = np.asarray(trgls).flatten()
+        sums = np.zeros((npts, 3), dtype=np.float64)
+        if len(idxs) == 0:
+            return sums
+        for i in range(3):
+            weights = np.repeat(vecs[:,i], 3)
+            sums[:,i] = np.bincount(idxs, weights, minlength=npts)
+        return sums
+
+    # class function
+    # returns vecs, normalized (float32); zero-length vectors
+    # are left as they are
+    def unitVectors(vecs):
+        l2 = np.sqrt(np.sum(vecs*vecs, axis=1)).reshape(-1,1)
         l2[l2==0] = 1.
-        ptn /= l2
-        return ptn
+        return (vecs/l2).astype(np.float32)
 
     # class function
     # returns normals of triangles
@@ -200,38 +457,7 @@ class BaseFragment:
 
     # class function
     def findNeighbors(trgls):
-        index = np.indices((len(trgls),1))[0]
-        ones = np.ones((len(trgls),1), dtype=np.int32)
-        zeros = np.zeros((len(trgls),1), dtype=np.int32)
-        twos = 2*ones
-        
-        e01 = np.concatenate((trgls[:, (0,1)], index, twos, ones), axis=1)
-        e12 = np.concatenate((trgls[:, (1,2)], index, zeros, ones), axis=1)
-        e20 = np.concatenate((trgls[:, (2,0)], index, ones, ones), axis=1)
-        
-        edges = np.concatenate((e01,e12,e20), axis=0)
-        rev = (edges[:,0] > edges[:,1])
-        edges[rev,0:2] = edges[rev,1::-1]
-        edges[rev,4] = -1
-        edges = edges[edges[:,4].argsort()]
-        edges = edges[edges[:,1].argsort(kind='mergesort')]
-        edges = edges[edges[:,0].argsort(kind='mergesort')]
-        
-        ediff = np.diff(edges, axis=0)
-        duprows = np.where(((ediff[:,0]==0) & (ediff[:,1]==0)))[0]
-        duprows2 = np.sort(np.append(duprows, duprows+1))
-        bdup = np.zeros((len(edges)), dtype=np.bool_)
-        bdup[duprows2] = True
-        
-        neighbors = np.full((len(trgls), 3), -1, dtype=np.int32)
-        
-        eplus = edges[duprows+1,:4]
-        eminus = edges[duprows,:4]
-        # print(eplus)
-        # print(eminus)
-        neighbors[eplus[:,2],eplus[:,3]] = eminus[:,2]
-        neighbors[eminus[:,2],eminus[:,3]] = eplus[:,2]
-        return neighbors
+        return MeshTopology.findNeighbors(trgls)
 
     # returns list of indexes of those trgls that have pt_index as
     # a vertex
@@ -243,6 +469,110 @@ class BaseFragment:
     def getType(self):
         return self.type.value if self.type else None
 
+'''
+SliceCache holds the cross sections of a fragment view
+(the results of getLinesOnSlice and getZsurfPoints) for
+recently drawn slices, since the slice windows ask for the
+same cross sections many times while nothing has changed.
+The key of each entry is (kind, axis, position), where kind
+is the name of the function.  Each fragment view has its
+own cache; the fragment view is responsible for removing
+entries that become out of date, either all at once (clear)
+or only those that are affected by an edit (invalidate).
+The least recently used entries are discarded once there
+are more than max_entries of them.
+Hit and miss counts are kept for each cache, and totaled
+over all caches, for profiling.
+'''
+class SliceCache:
+
+    max_entries = 64
+    total_hits = 0
+    total_misses = 0
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # number of entries removed by invalidate
+        self.invalidated = 0
+        self.version = None
+
+    # returns (True, value) if key is in the cache,
+    # (False, None) otherwise
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            SliceCache.total_hits += 1
+            return True, self.entries[key]
+        self.misses += 1
+        SliceCache.total_misses += 1
+        return False, None
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    # version is a tuple of the objects (for instance,
+    # arrays) that the cross sections are computed from.
+    # If any of them is not the same object as when
+    # checkVersion or setVersion was last called, the
+    # cache is cleared.
+    def checkVersion(self, version):
+        if not self.isVersion(version):
+            self.clear()
+            self.version = version
+
+    def isVersion(self, version):
+        old = self.version
+        return (old is not None and len(old) == len(version) 
+                and all(a is b for a,b in zip(old, version)))
+
+    # Records the version without clearing the cache; to
+    # be called after the out-of-date entries have been
+    # removed by invalidate
+    def setVersion(self, version):
+        self.version = version
+
+    # ranges is a list, one item per axis, of (min, max) 
+    # position ranges, or None if no position on that axis
+    # is affected.  Removes the entries whose position 
+    # is within the range for their axis.
+    def invalidate(self, ranges):
+        remove = []
+        for key in self.entries.keys():
+            kind, axis, position = key
+            rng = ranges[axis]
+            if rng is not None and rng[0] <= position <= rng[1]:
+                remove.append(key)
+        for key in remove:
+            del self.entries[key]
+        self.invalidated += len(remove)
+
+    def hitRate(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.
+        return self.hits/total
+
+    # class function
+    def totalHitRate():
+        total = SliceCache.total_hits + SliceCache.total_misses
+        if total == 0:
+            return 0.
+        return SliceCache.total_hits/total
+
+    # class function
+    def resetTotals():
+        SliceCache.total_hits = 0
+        SliceCache.total_misses = 0
+
 class BaseFragmentView:
 
     def __init__(self, project_view, fragment):
@@ -258,6 +588,11 @@ class BaseFragmentView:
         self.modified = Utils.timestamp()
         self.local_points_modified = Utils.timestamp()
         self.normal_offset = 0.
+        # cross sections of this fragment view, for recently
+        # drawn slices
+        self.slice_cache = SliceCache()
+        # see PointBuffer
+        self.point_buffers = {}
 
     def allowAutoExtrapolation(self):
         return False
@@ -339,6 +674,11 @@ class BaseFragmentView:
     def reparameterize(self):
         return
 
+    # returns False if only the whole fragment can be
+    # reparameterized
+    def reparameterizeWorkingRegion(self):
+        return False
+
     # direction is not used here, but this notifies fragment view
     # to recompute things
     def setVolumeViewDirection(self, direction):
@@ -390,6 +730,11 @@ class BaseFragmentView:
         self.fragment.notifyModified()
         self.setLocalPoints(True)
 
+    # returns list of indexes of those trgls (of self.trgls())
+    # that have pt_index as a vertex
+    def trglsAroundPoint(self, pt_index):
+        return BaseFragment.trglsAroundPoint(pt_index, self.trgls())
+
     # returns 3 axes: axis along increasing stx, axis along increasing sty,
     # normal.  The 3 axes are orthonormal.
     # TODO: the calculation of stxaxis and styaxis should take into
@@ -401,7 +746,7 @@ class BaseFragmentView:
         trgls = self.trgls()
         if uvpts is None or len(xyzpts) != len(uvpts):
             return None
-        ltrgl_indexes = BaseFragment.trglsAroundPoint(pt_index, trgls)
+        ltrgl_indexes = self.trglsAroundPoint(pt_index)
         ltrgls = trgls[ltrgl_indexes]
 
         v0 = ltrgls[:,0]
@@ -10,7 +10,7 @@ import cv2
 
 from utils import Utils
 from project import ProjectView
-from st import ST
+from st import ST, STTileCache
 from uv_mapper import UVMapper
 # import PIL
 # import PIL.Image
@@ -18,6 +18,12 @@ from uv_mapper import UVMapper
 # non-intuitively, QLabel is what is used to display pixmaps
 class DataWindow(QLabel):
 
+    # whether autoInterpolate and autoExtrapolateOld take
+    # the slice eigens from (and add them to) st_cache
+    use_st_cache = True
+    # shared by all data windows
+    st_cache = STTileCache()
+
     def __init__(self, window, axis):
         super(DataWindow, self).__init__()
         self.window = window
@@ -1185,7 +1191,11 @@ class DataWindow(QLabel):
             current_frag = self.currentFragmentView()
             if current_frag is not None:
                 self.setWaitCursor()
-                current_frag.reparameterize()
+                # shift (~) always reparameterizes the whole fragment
+                modifiers = QApplication.keyboardModifiers()
+                full = key == Qt.Key_AsciiTilde or bool(modifiers & Qt.ShiftModifier)
+                if full or not current_frag.reparameterizeWorkingRegion():
+                    current_frag.reparameterize()
                 self.window.drawSlices()
         self.setStatusTextFromMousePosition()
         self.checkCursor()
@@ -1256,6 +1266,35 @@ class DataWindow(QLabel):
         gaxis = self.volume_view.globalAxisFromTransposedAxis(self.axis)
         return gxyz[gaxis]
 
+    # Returns an ST, with eigens computed, of the part of the
+    # current slice between ij0 and ij1 (in data coordinates);
+    # s0 and s1 are the corners of the readable part of the
+    # slice (see getSliceBounds)
+    def sliceST(self, ij0, ij1, s0, s1):
+        volume = self.volume_view
+        k = volume.ijktf[self.axis]
+        x0 = int(s0[0] + int(ij0[0]-s0[0]))
+        y0 = int(s0[1] + int(ij0[1]-s0[1]))
+        x1 = int(s0[0] + int(ij1[0]-s0[0]))
+        y1 = int(s0[1] + int(ij1[1]-s0[1]))
+
+        def reader(xa, ya, xb, yb):
+            slc, missed = volume.getSliceInRangeWithMisses(
+                    volume.trdata, slice(xa,xb), slice(ya,yb), k, self.axis)
+            # trdata has a trailing axis of size 1
+            if slc.ndim == 3:
+                slc = slc[:,:,0]
+            return slc, len(missed) == 0
+
+        if not self.use_st_cache:
+            slc, complete = reader(x0, y0, x1, y1)
+            st = ST(slc.astype(np.float64)/65535.)
+            st.computeEigens()
+            return st
+        key = (volume.volume, volume.direction, self.axis, int(k))
+        bounds = ((int(s0[0]), int(s0[1])), (int(s1[0]), int(s1[1])))
+        return self.st_cache.getST(key, ((x0,y0),(x1,y1)), bounds, reader)
+
     def autoInterpolate(self):
         if self.bounding_nodes is None:
             return
@@ -1303,11 +1342,6 @@ class DataWindow(QLabel):
         if rs is None:
             return
         (sx1,sy1),(sx2,sy2) = rs
-        slc = volume.getSliceInRange(
-                volume.trdata, slice(sx1,sx2), slice(sy1,sy2),
-                volume.ijktf[self.axis], self.axis)
-        sw = slc.shape[1]
-        sh = slc.shape[0]
         s0 = (sx1,sy1)
         s1 = (sx2,sy2)
         ri = Utils.rectIntersection((ij0m,ij1m), (s0,s1))
@@ -1325,9 +1359,8 @@ class DataWindow(QLabel):
             return
         if jmin < ij0[1] or jmax >= ij1[1]:
             return
-        st = ST((slc[int(ij0[1]-s0[1]):int(ij1[1]-s0[1]),int(ij0[0]-s0[0]):int(ij1[0]-s0[0])]).astype(np.float64)/65535.)
+        st = self.sliceST(ij0, ij1, s0, s1)
         print ("st created", st.image.shape)
-        st.computeEigens()
         '''
         path = self.window.project_view.project.path
         st.saveImage(path / "st_debug.tif")
@@ -1407,12 +1440,6 @@ class DataWindow(QLabel):
         if rs is None:
             return
         (sx1,sy1),(sx2,sy2) = rs
-        slc = volume.getSliceInRange(
-                volume.trdata, slice(sx1,sx2), slice(sy1,sy2), 
-                volume.ijktf[self.axis], self.axis)
-        # print(volume.trdata.shape, rs, slc.shape, (ij0m,ij1m))
-        sw = slc.shape[1]
-        sh = slc.shape[0]
         s0 = (sx1,sy1)
         s1 = (sx2,sy2)
 
@@ -1434,9 +1461,8 @@ class DataWindow(QLabel):
             return
         if ij[1] < ij0[1] or ij[1] >= ij1[1]:
             return
-        st = ST((slc[int(ij0[1]-s0[1]):int(ij1[1]-s0[1]),int(ij0[0]-s0[0]):int(ij1[0]-s0[0])]).astype(np.float64)/65535.)
+        st = self.sliceST(ij0, ij1, s0, s1)
         # print ("st created", st.image.shape)
-        st.computeEigens()
         # print ("eigens computed")
         dij = (ij[0]-ij0[0], ij[1]-ij0[1])
         # min distance between computed auto-pick points
@@ -0,0 +1,139 @@
+# Measures the time and memory allocated per redraw by
+# CachedZarrVolume.paintSlice, using a synthetic multi-resolution
+# (OME) zarr data store.
+#
+# Three cases are measured:
+#   "loaded": all chunks are in the cache, and the view is panned
+#       a few pixels on every redraw;
+#   "zoom": all chunks are in the cache, and the zoom changes
+#       slightly on every redraw, so no previously resized 
+#       tiles can be reused;
+#   "partial": half of the full-resolution chunks are marked
+#       as still loading, so that every redraw has to composite
+#       data from two levels.
+# Each case is measured with and without the slice tile cache
+# (CachedZarrVolume.use_tile_cache).
+#
+# usage: python paint_benchmark.py [width height [dtype]]
+# for example: python paint_benchmark.py 3840 2160 uint8
+
+import sys
+import os
+import json
+import time
+import tempfile
+import tracemalloc
+import numpy as np
+import zarr
+
+sys.path.append(os.path.join(sys.path[0], '..'))
+from volume_zarr import CachedZarrVolume
+
+def create_store(dirname, dtype, size=1024, nlevels=4, chunk=128):
+    zdir = os.path.join(dirname, "bench.zarr")
+    group = zarr.open_group(zdir, mode="w")
+    rng = np.random.default_rng(0)
+    info = np.iinfo(dtype)
+    # smooth-ish random data, so that resizing is not trivial
+    base = rng.integers(info.max//4, info.max, (size//8,)*3, dtype=dtype)
+    base = base.repeat(8, 0).repeat(8, 1).repeat(8, 2)
+    datasets = []
+    for i in range(nlevels):
+        s = 2**i
+        group.create_dataset(str(i), data=base[::s,::s,::s], chunks=(chunk,)*3)
+        datasets.append({"path": str(i), "coordinateTransformations": [{"type": "scale", "scale": [s,s,s]}]})
+    group.attrs["multiscales"] = [{"datasets": datasets}]
+    vfile = os.path.join(dirname, "bench.volzarr")
+    with open(vfile, "w") as outfile:
+        json.dump({"khartes_version": "1.0", "zarr_dir": zdir}, outfile)
+    return vfile, size
+
+def paint(volume, shape, ijkt, zoom):
+    out = np.zeros((shape[0], shape[1], 1), dtype=np.uint16)
+    volume.paintSlice(out, 2, ijkt, zoom, 0, 0)
+    return out
+
+def run_case(name, volume, shape, center, zoom, count=20):
+    for use_tile_cache in (False, True):
+        CachedZarrVolume.use_tile_cache = use_tile_cache
+        CachedZarrVolume.tile_cache.clear()
+        # warm up (for instance, allocate any per-window buffers)
+        paint(volume, shape, center, zoom)
+        # frames are timed without tracemalloc, which slows
+        # down python considerably; the allocations are
+        # measured on a second pass
+        times = []
+        allocs = []
+        for tracing in (False, True):
+            for i in range(count):
+                ijkt = (center[0]+i, center[1]+i, center[2])
+                z = zoom
+                if name == "zoom":
+                    ijkt = center
+                    z = zoom*(1.+.01*(i+1+tracing*count))
+                if tracing:
+                    tracemalloc.start()
+                t0 = time.perf_counter()
+                paint(volume, shape, ijkt, z)
+                if not tracing:
+                    times.append(time.perf_counter()-t0)
+                else:
+                    _, peak = tracemalloc.get_traced_memory()
+                    tracemalloc.stop()
+                    allocs.append(peak)
+        # The output buffer itself is allocated by the caller
+        # on every redraw; report it separately
+        out_bytes = shape[0]*shape[1]*2
+        print("%-8s tiles %-3s  frame time %7.2f ms   peak allocated %7.2f Mb (of which %.2f Mb is the output buffer)"%(
+            name, ("on" if use_tile_cache else "off"), 1000*np.median(times), np.median(allocs)/2**20, out_bytes/2**20))
+
+def main():
+    ww, wh = 1920, 1080
+    dtype = np.uint8
+    if len(sys.argv) > 2:
+        ww, wh = int(sys.argv[1]), int(sys.argv[2])
+    if len(sys.argv) > 3:
+        dtype = np.dtype(sys.argv[3]).type
+    with tempfile.TemporaryDirectory() as tdir:
+        vfile, size = create_store(tdir, dtype)
+        # listing the chunks is not needed for a local store
+        CachedZarrVolume.seed_empty_chunk_index = False
+        volume = CachedZarrVolume.loadFile(vfile)
+        shape = (wh, ww)
+        center = (size//2, size//2, size//2)
+        # zoom at which level 0 is drawn, and at which
+        # the data fills the window
+        zoom = 4.
+        # load the chunks needed to draw each level
+        # (paintSlice starts with level i when the zoom is
+        # between 0.5/scale and 1/scale)
+        volume.setImmediateDataMode(True)
+        for level in volume.levels:
+            lzoom = .75/level.scale
+            if level.ilevel == 0:
+                lzoom = zoom
+            paint(volume, shape, center, lzoom)
+            for i in range(20):
+                paint(volume, shape, (center[0]+i, center[1]+i, center[2]), lzoom)
+        volume.setImmediateDataMode(False)
+
+        print("window %dx%d, %s data"%(ww, wh, np.dtype(dtype).name))
+        run_case("loaded", volume, shape, center, zoom)
+        run_case("zoom", volume, shape, center, zoom)
+
+        # Pretend that the right half of the level-0 chunks
+        # are still being loaded
+        klru = volume.levels[0].klru
+        chunk = volume.levels[0].data.chunks
+        with klru._mutex:
+            for key in list(klru._values_cache.keys()):
+                idxs = klru.chunkIndices(key)
+                if idxs is not None and idxs[2]*chunk[2] >= size//2:
+                    klru.submitted.add(key)
+                    del klru._values_cache[key]
+        # keep the scheduler from actually loading the chunks
+        volume.scheduler.max_workers = 0
+        run_case("partial", volume, shape, center, zoom)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+# Compares the speed of Ppm.layerIjksToScrollIjks (which
+# is called on every vertex when a mesh is exported with
+# a ppm file) with the previous implementation, which used
+# scipy's RegularGridInterpolator, and checks that both give
+# the same results.
+# A synthetic ppm file is created in a temporary directory.
+#
+# usage: python ppm_benchmark.py [number_of_points [ppm_width ppm_height]]
+# for example: python ppm_benchmark.py 5000000 4000 4000
+
+import sys
+import os
+import time
+import pathlib
+import tempfile
+import numpy as np
+
+sys.path.append(os.path.join(sys.path[0], '..'))
+from ppm import Ppm
+
+# If aligned is True, a comment is added to the header so
+# that the data starts on an 8-byte boundary (this affects 
+# the speed of Ppm.bilinear)
+def create_ppm(filename, width, height, aligned):
+    rng = np.random.default_rng(0)
+    header = "width: %d\nheight: %d\ndim: 6\nordered: true\ntype: double\nversion: 1\n"%(width, height)
+    pad = (8 - (len(header)+3)%8)%8
+    if aligned and pad > 0:
+        # (loadPpm ignores lines that aren't "name: value")
+        header += "#"*(pad-1) + "\n"
+    with open(filename, "wb") as outfile:
+        outfile.write((header+"<>\n").encode('utf-8'))
+        # write a row at a time, to limit memory use
+        for i in range(height):
+            row = np.zeros((width, 6), dtype=np.float64)
+            row[:,0] = np.arange(width) + rng.random(width)
+            row[:,1] = i + rng.random(width)
+            row[:,2] = 1000. + 10*rng.random(width)
+            row[:,3:] = rng.random((width, 3))
+            row.tofile(outfile)
+
+# the previous version of layerIjksToScrollIjks
+def rgi_layer_ijks_to_scroll_ijks(ppm, lijks):
+    ijs = lijks[:,(2,0)]
+    ks = lijks[:,1,np.newaxis]
+    sijks = ppm.ijk_interpolator(ijs)
+    norms = ppm.normal_interpolator(ijs)
+    sijks += norms*(ks-32)
+    return sijks
+
+def main():
+    npts = 2000000
+    width, height = 2000, 2000
+    if len(sys.argv) > 1:
+        npts = int(sys.argv[1])
+    if len(sys.argv) > 3:
+        width, height = int(sys.argv[2]), int(sys.argv[3])
+    print("%d points, ppm %d x %d"%(npts, width, height))
+    for aligned in (False, True):
+        with tempfile.TemporaryDirectory() as tdir:
+            filename = pathlib.Path(tdir) / "bench.ppm"
+            create_ppm(filename, width, height, aligned)
+            run(filename, npts, width, height)
+
+def run(filename, npts, width, height):
+    ppm = Ppm.loadPpm(filename)
+    ppm.loadData()
+    rng = np.random.default_rng(1)
+    # a few percent of the points are outside of the grid
+    lijks = np.stack((
+        rng.random(npts)*(width+20)-10,
+        rng.random(npts)*64,
+        rng.random(npts)*(height+20)-10), axis=1)
+    # include the grid corners and edges
+    lijks[:4,(2,0)] = ((0,0), (0,width-1), (height-1,0), (height-1,width-1))
+    lijks[4:8,(2,0)] = ((.5,width-1), (height-1,.5), (-1.e-9,0), (0,width-1+1.e-9))
+
+    # touch all of the pages, so that reading the file
+    # isn't included in the timing
+    ppm.data.sum()
+
+    t0 = time.perf_counter()
+    expected = rgi_layer_ijks_to_scroll_ijks(ppm, lijks)
+    t_rgi = time.perf_counter()-t0
+
+    results = {}
+    nthreads = Ppm.eval_threads
+    for threads in sorted(set((1, nthreads))):
+        Ppm.eval_threads = threads
+        t0 = time.perf_counter()
+        result = ppm.layerIjksToScrollIjks(lijks)
+        results[threads] = (time.perf_counter()-t0, result)
+    Ppm.eval_threads = nthreads
+
+    aligned = np.asarray(ppm.data).flags.aligned
+    print("data is %s"%("aligned" if aligned else "not aligned"))
+    print("  RegularGridInterpolator: %7.3f s"%t_rgi)
+    for threads, (t, result) in results.items():
+        diff = np.abs(result-expected).max()
+        print("  bilinear, %d thread(s):  %7.3f s  (speedup %5.1f)  max difference %.3g"%(threads, t, t_rgi/t, diff))
+    del ppm
+
+if __name__ == '__main__':
+    main()
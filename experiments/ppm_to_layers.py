@@ -1,283 +1,472 @@
+# Renders the layers of a ppm file: layer n (for n in the
+# range nmin to nmax) is the surface described by the ppm file,
+# displaced by n voxels along the ppm normals.  The voxel values
+# are trilinearly interpolated from a scroll volume, which is
+# either a directory of TIFF slices or a zarr array.
+#
+# The volume is processed in bands of z values, which are
+# distributed over a pool of worker processes.  Within a band,
+# the volume is read in thinner slabs; the next slab is read
+# (on a separate thread) while the current one is being
+# interpolated.
+#
+# All the workers write into a single uint16 file (of shape
+# (layers, ppm height, ppm width)) in a work directory;
+# each voxel of this file is written by exactly one band, so
+# the workers never write to the same location.  Each time
+# a band is completed, this is recorded in a progress file in
+# the work directory, so if a run is interrupted, running the
+# same command again will continue where the first run stopped.
+# Once all the bands are done, the layers are copied from the
+# work file to the output, which is either a zarr array or a
+# directory of TIFF files (one per layer).
+#
+# usage example:
+# python ppm_to_layers.py 20230827161846.ppm /volumes/20230205180739 layers.zarr --workers 4
+
 import sys
 import os
-import pathlib
-import numpy as np
+import re
+import json
 import math
 import time
+import shutil
+import pathlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+import numpy as np
 import cv2
-from scipy.interpolate import RegularGridInterpolator
+import zarr
 
 sys.path.append(os.path.join(sys.path[0], '..'))
 from ppm import Ppm
 
-def vdirname(vdir, num):
-    fstr = "%05d.tif"%num
-    print("vdirname", num)
-    return str(vdir / fstr)
-
-def print_sleep(text):
-    time.sleep(5)
-    print(text)
-
-# I could just use cv2.imread, but the approach here gives
-# the possibility of later trying async input
-def read_tif(fname):
-    npbuf = None
-    # t0 = time.time()
-    try:
-        # print("reading",fname, time.time()-t0)
-        buf = open(fname, "rb").read()
-        # print("frombuffer", time.time()-t0)
-        npbuf = np.frombuffer(buf, dtype=np.uint8)
-    except Exception as e:
-        print("Read error:", str(e))
-    if npbuf is None:
-        return None
-    # print("imdecode", time.time()-t0)
-    im = cv2.imdecode(npbuf, cv2.IMREAD_UNCHANGED)
-    # print("done", time.time()-t0)
-    return im
-
-def process_z_pair(ss_zi, ss_index, ss_next_tif, ss_xyzsl, ss_volume, ss_vdir):
-    # print_sleep("top of loop")
-    # t0 = time.time()
-    ss_cur_tif = ss_next_tif
-    # TODO: make sure tif is not out of range
-    # if zi+1 > zend:
-    #     break
-    # print_sleep("reading tiff")
-    # print("reading tif", time.time()-t0)
-    # next_tif = cv2.imread(vdirname(vdir, i+1), cv2.IMREAD_UNCHANGED)
-    ss_next_tif = read_tif(vdirname(ss_vdir, ss_zi+1))
-    # for testing!
-    # if ss_zi == 9367:
-    #     # return ss_next_tif
-    #     ss_next_tif[:,:] = 65535
+'''
+Scroll volume stored as a directory of TIFF files, one file
+per z value.  The file names are created from a pattern
+such as "%05d.tif".
+'''
+class TiffSource():
+    def __init__(self, tdir, pattern):
+        self.tdir = pathlib.Path(tdir)
+        self.pattern = pattern
+        # largest z value for which there is a file; the
+        # lookup is by file number, so gaps are only detected
+        # when a missing file is actually needed
+        zs = []
+        for name in os.listdir(self.tdir):
+            m = re.fullmatch(r"(\d+)\.tiff?", name)
+            if m is not None:
+                zs.append(int(m.group(1)))
+        if len(zs) == 0:
+            raise RuntimeError("No TIFF files found in %s"%self.tdir)
+        im = self.readImage(min(zs))
+        self.shape = (max(zs)+1, im.shape[0], im.shape[1])
+        self.dtype = im.dtype
+        # the last image read, so that the slice shared by
+        # consecutive slabs is only read once
+        self.last = None
 
-    # print_sleep("creating tif_xyzs")
-    # print("creating tif_xyzs", time.time()-t0)
-    print("indexes",ss_index[ss_zi],ss_index[ss_zi+1])
-    ss_tif_xyzs = ss_xyzsl[ss_index[ss_zi]:ss_index[ss_zi+1], :]
-    # the -= operation probably affects xyzsl as well,
-    # but we won't be using those rows of tif_xyzs again
-    # ss_tif_xyzs[:,2] -= ss_zi
-    print("tif_xyzs", ss_tif_xyzs.shape)
-    # print(np.max(tif_xyzs, axis=0))
+    def readImage(self, z):
+        fname = self.tdir / (self.pattern%z)
+        im = cv2.imread(str(fname), cv2.IMREAD_UNCHANGED)
+        if im is None:
+            raise RuntimeError("Could not read %s"%fname)
+        return im
 
-    i0 = np.floor(ss_tif_xyzs[:,0]).astype(np.int32)
-    i1 = np.floor(ss_tif_xyzs[:,1]).astype(np.int32)
-    i2 = np.floor(ss_tif_xyzs[:,2]).astype(np.int32)
-    f0 = ss_tif_xyzs[:,0]-i0
-    f1 = ss_tif_xyzs[:,1]-i1
-    f2 = ss_tif_xyzs[:,2]-i2
-    i2 -= ss_zi
-    # iv0 = cur_tif.astype(np.float32)
-    # iv1 = next_tif.astype(np.float32)
-    iv0 = ss_cur_tif
-    iv1 = ss_next_tif
+    # returns slices z0 (inclusive) to z1 (exclusive),
+    # cropped to bbox = (y0, y1, x0, x1)
+    def read(self, z0, z1, bbox):
+        y0, y1, x0, x1 = bbox
+        slab = np.zeros((z1-z0, y1-y0, x1-x0), dtype=self.dtype)
+        for z in range(z0, z1):
+            if self.last is not None and self.last[0] == z:
+                im = self.last[1]
+            else:
+                im = self.readImage(z)
+            slab[z-z0] = im[y0:y1, x0:x1]
+        self.last = (z1-1, im)
+        return slab
 
-    us = ss_tif_xyzs[:,3].astype(np.int32)
-    vs = ss_tif_xyzs[:,4].astype(np.int32)
-    ls = ss_tif_xyzs[:,5].astype(np.int32)
-    # volume[ls,us,vs] = interp
-    # interp = (
-    ss_volume[ls,us,vs] = (
-            (1.-f2)*((1.-f1)*((1.-f0)*iv0[i1,i0] + f0*iv0[i1,i0+1])+
-            f1*((1.-f0)*iv0[i1+1,i0] + f0*iv0[i1+1,i0+1]))+
-            f2*((1.-f1)*((1.-f0)*iv1[i1,i0] + f0*iv1[i1,i0+1])+
-            f1*((1.-f0)*iv1[i1+1,i0] + f0*iv1[i1+1,i0+1]))
-            )
-    return ss_next_tif
+'''
+Scroll volume stored as a zarr array (or, in the case of an
+OME-zarr group, its full-resolution level "0").
+'''
+class ZarrSource():
+    def __init__(self, path):
+        data = zarr.open(str(path), mode="r")
+        if isinstance(data, zarr.hierarchy.Group):
+            data = data["0"]
+        self.data = data
+        self.shape = data.shape
+        self.dtype = data.dtype
+        self.chunk_depth = data.chunks[0]
 
-def process_z_band(tt_z0, tt_z1, tt_vdir, tt_ijks, tt_normals, tt_zminmaxar, tt_nrange, tt_volume, tt_next_tif):
-    tt_th = tt_next_tif.shape[0]
-    tt_tw = tt_next_tif.shape[1]
-    tt_iv = np.zeros((2,tt_th,tt_tw), dtype=np.float32)
-    tt_thrange = np.arange(tt_th)
-    tt_twrange = np.arange(tt_tw)
-    tt_zminar = tt_zminmaxar[:,:,0]
-    tt_zmaxar = tt_zminmaxar[:,:,1]
-    tt_nmin = tt_nrange[0]
-    tt_nmax = tt_nrange[-1]
-    tt_nn = len(tt_nrange)
+    def read(self, z0, z1, bbox):
+        y0, y1, x0, x1 = bbox
+        return self.data[z0:z1, y0:y1, x0:x1]
 
-    # xyzsl = None
-    # index = None
-    print("z0", tt_z0)
-    tt_inrange = ((tt_zminar>=tt_z0)&(tt_zminar<=tt_z1)|(tt_z0>=tt_zminar)&(tt_z0<=tt_zmaxar))
-    print("inrange", tt_inrange.shape, tt_inrange.sum())
-    # changing integer coordinates into floats to ensure
-    # xyzs (created by concatenation) will be float32
-    tt_uvinrange = np.argwhere(tt_inrange).astype(np.float32)
-    print("uvinrange", tt_uvinrange.shape, tt_uvinrange.dtype)
-    tt_xyzs = np.zeros((tt_uvinrange.shape[0], tt_nrange.shape[0], 3), dtype=np.float32)
-    tt_xyzs[:,:,:] = tt_ijks[tt_inrange][:,np.newaxis,:]+tt_nrange[np.newaxis,:,np.newaxis]*tt_normals[tt_inrange][:,np.newaxis,:]
-    print("xyzs",tt_xyzs.shape, tt_xyzs.dtype)
-    tt_inrange = None
+def open_source(path, pattern):
+    path = pathlib.Path(path)
+    if path.suffix == ".zarr" or (path / ".zarray").exists() or (path / ".zgroup").exists():
+        return ZarrSource(path)
+    return TiffSource(path, pattern)
 
-    # tt_narray = np.zeros((tt_xyzs.shape[0], tt_nrange.shape[0]), dtype=np.float32)
-    tt_narray = np.repeat((tt_nrange[np.newaxis,:]-tt_nmin).astype(np.float32), tt_xyzs.shape[0], axis=0)[:,:,np.newaxis]
-    print("narray", tt_narray.shape, tt_narray.dtype)
-    # tt_uvarray = np.zeros((tt_xyzs.shape[0], tt_nrange.shape[0], 2), dtype=np.float32)
-    tt_uvarray = np.repeat(tt_uvinrange[:,np.newaxis,:], tt_nn, axis=1)
-    print("uvarray", tt_uvarray.shape, tt_uvarray.dtype)
-    tt_uvinrange = None
-    tt_xyzs = np.concatenate((tt_xyzs, tt_uvarray, tt_narray), axis=2)
-    print("xyzs", tt_xyzs.shape, tt_xyzs.dtype)
-    tt_xyzsl = tt_xyzs.reshape(-1,6)
-    print("xyzsl", tt_xyzsl.shape, tt_xyzsl.dtype)
-    ''''''
-    print("sorting args")
-    tt_xyzsl_sort = np.argsort(tt_xyzsl[:,2])
-    print("xyzsl_sort", tt_xyzsl_sort.shape, tt_xyzsl_sort.dtype)
-    print("applying sorted args")
-    tt_xyzsl = tt_xyzsl[tt_xyzsl_sort]
-    tt_xyzsl_sort = None
-    ''''''
-    '''
-    # awkward way to do inplace sorting on third column.  But very slow!
-    # https://stackoverflow.com/questions/2828059/sorting-arrays-in-numpy-by-column
-    # print("converting")
-    # vtest = tt_xyzsl.view("f4,f4,f4,f4,f4,f4")
-    # print(tt_xyzsl.dtype, tt_xyzsl.shape, vtest.dtype, vtest.shape)
-    print("sorting")
-    tt_xyzsl.view("f4,f4,f4,f4,f4,f4").sort(order=["f2"], axis=0)
-    '''
-    tt_xyzs = None
-    print("xyzsl", tt_xyzsl.shape)
-    # print(xyzs[100])
-    tt_zrange = np.arange(tt_z1+1)
-    print("indexing")
-    tt_index = np.searchsorted(tt_xyzsl[:,2], tt_zrange, side='right')
-    tt_zrange = None
-    for tt_i in range(tt_z0,tt_z1):
-        tt_next_tif = process_z_pair(tt_i, tt_index, tt_next_tif, tt_xyzsl, tt_volume, tt_vdir)
-    return tt_next_tif
+# Settings that determine the contents of the work file; a
+# run can only be resumed if these have not changed
+def run_settings(args, ppm, nrange, band_depth):
+    return {
+            "ppm": str(pathlib.Path(args.ppm_file).resolve()),
+            "volume": str(pathlib.Path(args.volume).resolve()),
+            "pattern": args.pattern,
+            "ppm_shape": [ppm.height, ppm.width],
+            "nmin": int(nrange[0]),
+            "nmax": int(nrange[-1]),
+            "band_depth": band_depth,
+            }
 
-def compute_zmin_zmax(uu_nrange, uu_ijks, uu_normals):
-    uu_nmin = uu_nrange[0]
-    uu_nmax = uu_nrange[-1]
-    uu_h = uu_ijks.shape[0]
-    uu_w = uu_ijks.shape[1]
+# Computes, for each ppm point, the z range covered by its
+# layers, and whether the point is valid (ppm points that
+# are not on the surface have zero normals).
+# The ppm data is processed a block of rows at a time, to
+# limit memory use.
+def compute_zmin_zmax(ppm, nrange, zminmax_file):
+    nmin = nrange[0]
+    nmax = nrange[-1]
+    zminmax = np.lib.format.open_memmap(zminmax_file, mode="w+", dtype=np.float32, shape=(ppm.height, ppm.width, 2))
+    zmin = np.inf
+    zmax = -np.inf
+    rows = 256
+    for r0 in range(0, ppm.height, rows):
+        r1 = min(r0+rows, ppm.height)
+        ijks = ppm.ijks[r0:r1]
+        normals = ppm.normals[r0:r1]
+        za = ijks[:,:,2]+nmin*normals[:,:,2]
+        zb = ijks[:,:,2]+nmax*normals[:,:,2]
+        block = zminmax[r0:r1]
+        block[:,:,0] = np.minimum(za, zb)
+        block[:,:,1] = np.maximum(za, zb)
+        valid = (normals != 0).any(axis=2)
+        # invalid points are given an empty z range, so
+        # that they are never in any band
+        block[~valid,0] = np.inf
+        block[~valid,1] = -np.inf
+        if valid.any():
+            zmin = min(zmin, block[valid,0].min())
+            zmax = max(zmax, block[valid,1].max())
+    zminmax.flush()
+    return zmin, zmax
 
-    print("compute normals_valid")
-    uu_normals_valid = (uu_normals!=0).any(axis=2)
+# Per-process state of the workers (the ppm, volume source,
+# and work file are opened once per process)
+worker_state = {}
 
-    print("compute zminmaxar")
-    uu_zminmaxar = np.zeros((uu_h,uu_w,2), dtype=np.float32)
-    uu_zminmaxar[:,:,0] = (uu_ijks[:,:,2]+uu_nmin*uu_normals[:,:,2])
-    uu_zminmaxar[:,:,1] = (uu_ijks[:,:,2]+uu_nmax*uu_normals[:,:,2])
-    uu_minmax_switched = uu_zminmaxar[:,:,1] < uu_zminmaxar[:,:,0]
-    print(uu_minmax_switched.shape)
-    # print(zminmaxar[minmax_switched,:].shape, zminmaxar[minmax_switched,:][:,[1,0]].shape)
-    uu_zminmaxar[uu_minmax_switched,:] = uu_zminmaxar[uu_minmax_switched,:][:,[1,0]]
-    print(uu_zminmaxar.shape, uu_zminmaxar[uu_normals_valid].shape)
-    # uu_zmin = uu_zminmaxar[uu_normals_valid].min()
-    # uu_zmax = uu_zminmaxar[uu_normals_valid].max()
-    '''
-    print("minz maxz",zmin,zmax)
-    print("switchtest", 
-          zminmaxar[normals_valid,0].min(),
-          zminmaxar[normals_valid,1].max())
-    # normals_valid = None
-    '''
-    return uu_zminmaxar, uu_normals_valid
+def worker_init(settings, work_dir, layers_shape):
+    ppm = Ppm.loadPpm(pathlib.Path(settings["ppm"]))
+    ppm.loadData()
+    worker_state["ppm"] = ppm
+    worker_state["source"] = open_source(settings["volume"], settings["pattern"])
+    worker_state["zminmax"] = np.load(work_dir / "zminmax.npy", mmap_mode="r")
+    worker_state["layers"] = np.memmap(work_dir / "layers.raw", dtype=np.uint16, mode="r+", shape=layers_shape)
+    worker_state["nrange"] = np.arange(settings["nmin"], settings["nmax"]+1, dtype=np.float32)
 
-case = 2
+# Finds the samples (points of a given layer) whose z value
+# lies between z0 (inclusive) and z1 (exclusive), and which
+# can be interpolated from the volume.
+# band is (flat_uvs, ijks, normals, zminmax) of the ppm
+# points in the band, where flat_uvs are the indices of
+# the points in a flattened layer.
+# Returns (xyzs, flat_indices, bbox), where flat_indices
+# are indices into the flattened layers array, or None if 
+# there are no such samples.
+def slab_samples(z0, z1, band, nrange, vshape, layer_size):
+    flat_uvs, ijks, normals, zminmax = band
+    # (the margin allows for rounding differences between
+    # zminmax and xyzs; the samples are selected by their 
+    # actual z values below)
+    sel = (zminmax[:,0] < z1+1) & (zminmax[:,1] >= z0-1)
+    if not sel.any():
+        return None
+    xyzs = ijks[sel][:,np.newaxis,:] + nrange[np.newaxis,:,np.newaxis]*normals[sel][:,np.newaxis,:]
+    zf = np.floor(xyzs[:,:,2])
+    # the samples need voxels x to x+1, y to y+1, z to z+1
+    keep = ((zf >= z0) & (zf < z1) &
+            (xyzs[:,:,0] >= 0) & (xyzs[:,:,0] < vshape[2]-1) &
+            (xyzs[:,:,1] >= 0) & (xyzs[:,:,1] < vshape[1]-1))
+    pi, ni = np.nonzero(keep)
+    if len(pi) == 0:
+        return None
+    xyzs = xyzs[pi, ni]
+    flat = ni.astype(np.int64)*layer_size + flat_uvs[sel][pi]
+    xmin, ymin = np.floor(xyzs[:,:2].min(axis=0)).astype(np.int64)
+    xmax, ymax = np.floor(xyzs[:,:2].max(axis=0)).astype(np.int64)
+    bbox = (ymin, ymax+2, xmin, xmax+2)
+    return xyzs, flat, bbox
 
-if case == 0:
-    ppm = Ppm.loadPpm(pathlib.Path(r'C:\Vesuvius\Projects\large_frag_1846.khprj\orig obj\20230827161846.ppm'))
-    ofpm = pathlib.Path(r'C:\Vesuvius\Projects\ppmtest\mesh.obj')
-    ofpn = pathlib.Path(r'C:\Vesuvius\Projects\ppmtest\normals.obj')
-elif case == 2:
-    ppm = Ppm.loadPpm(pathlib.Path(r'C:\Vesuvius\Projects\ppmtest\1846.ppm'))
-    ofpm = pathlib.Path(r'C:\Vesuvius\Projects\ppmtest\mesh2.obj')
-    ofpn = pathlib.Path(r'C:\Vesuvius\Projects\ppmtest\normals2.obj')
-    ofl = pathlib.Path(r'C:\Vesuvius\Projects\ppmtest\layers')
-    
-vdir = pathlib.Path(r"H:\Vesuvius\Scroll1.volpkg\volumes\20230205180739")
+# Trilinear interpolation of slab (which contains the slices
+# z0 to z0+slab.shape[0]-1, cropped to bbox) at the points xyzs
+def interpolate(slab, z0, bbox, xyzs):
+    x = xyzs[:,0]-bbox[2]
+    y = xyzs[:,1]-bbox[0]
+    z = xyzs[:,2]-z0
+    i0 = np.floor(x).astype(np.int64)
+    i1 = np.floor(y).astype(np.int64)
+    i2 = np.floor(z).astype(np.int64)
+    f0 = x-i0
+    f1 = y-i1
+    f2 = z-i2
+    sh = slab.shape
+    s = slab.reshape(-1)
+    base = (i2*sh[1]+i1)*sh[2]+i0
+    dz = sh[1]*sh[2]
+    dy = sh[2]
+    v000 = s[base]
+    v001 = s[base+1]
+    v010 = s[base+dy]
+    v011 = s[base+dy+1]
+    v100 = s[base+dz]
+    v101 = s[base+dz+1]
+    v110 = s[base+dz+dy]
+    v111 = s[base+dz+dy+1]
+    return ((1.-f2)*((1.-f1)*((1.-f0)*v000 + f0*v001) + f1*((1.-f0)*v010 + f0*v011)) +
+            f2*((1.-f1)*((1.-f0)*v100 + f0*v101) + f1*((1.-f0)*v110 + f0*v111)))
 
-print("vdir test",vdirname(vdir,25))
-'''
-im = read_tif(vdirname(vdir,25))
-if im is None:
-    print("im is None!")
-else:
-    print("im", im.shape)
-'''
+# Renders all the samples whose z values lie in the band z0
+# (inclusive) to z1 (exclusive), writing them to the work file.
+# Runs in a worker process.  Returns (z0, number of samples).
+def process_band(z0, z1, slab_depth):
+    ppm = worker_state["ppm"]
+    source = worker_state["source"]
+    layers = worker_state["layers"]
+    nrange = worker_state["nrange"]
+    zminmax = worker_state["zminmax"]
+    layer_size = ppm.height*ppm.width
+    flat_layers = layers.reshape(-1)
+    vshape = source.shape
+    scale = 1.
+    if source.dtype == np.uint8:
+        scale = 256.
 
-ppm.loadData()
+    # the ppm points with at least one sample in this band
+    inrange = (zminmax[:,:,0] < z1+1) & (zminmax[:,:,1] >= z0-1)
+    # (index into the flattened layer)
+    flat_uvs = np.flatnonzero(inrange)
+    inrange = None
+    ppm_flat = np.asarray(ppm.data).reshape(-1, 6)
+    data = ppm_flat[flat_uvs].astype(np.float32)
+    band = (flat_uvs, data[:,:3], data[:,3:], zminmax.reshape(-1, 2)[flat_uvs])
+    data = None
 
-'''
-# pts = np.array(((3000.5, 3000.5),(-1.,-1.)))
-pts = np.array(((3000.5, 3000.5),(-3000.,-3000.)))
-# pts = np.array(((3000.5, 3000.5),))
-print (ppm.ijk_interpolator(pts))
-print (ppm.normal_interpolator(pts))
-'''
-print(ppm.data[2500,1500])
-print(ppm.data[2500,1501])
-print(ppm.data[2501,1500])
-print(ppm.ijks.shape)
-rr_ijks = ppm.ijks.astype(np.float32)
-rr_normals = ppm.normals.astype(np.float32)
-rr_h = rr_ijks.shape[0]
-rr_w = rr_ijks.shape[1]
-rr_uvs = np.mgrid[0:rr_h, 0:rr_w]
-rr_uvs = rr_uvs.transpose(1,2,0)
-print(rr_uvs.shape)
+    count = 0
+    reader = ThreadPoolExecutor(max_workers=1)
+    slabs = [(s, min(s+slab_depth, z1)) for s in range(z0, z1, slab_depth)]
+    # Each slab is read while the previous one is being
+    # interpolated
+    def prepare(i):
+        s0, s1 = slabs[i]
+        samples = slab_samples(s0, s1, band, nrange, vshape, layer_size)
+        if samples is None:
+            return None, None
+        # the slices s0 to s1 inclusive are needed
+        return samples, reader.submit(source.read, s0, s1+1, samples[2])
+    try:
+        cur = prepare(0)
+        for i in range(len(slabs)):
+            nxt = (None, None)
+            if i+1 < len(slabs):
+                nxt = prepare(i+1)
+            samples, future = cur
+            if samples is not None:
+                xyzs, flat, bbox = samples
+                slab = future.result()
+                values = interpolate(slab, slabs[i][0], bbox, xyzs)
+                if scale != 1.:
+                    values *= scale
+                flat_layers[flat] = np.clip(values, 0, 65535).astype(np.uint16)
+                count += len(flat)
+            cur = nxt
+    finally:
+        reader.shutdown(wait=True)
+    layers.flush()
+    return z0, count
 
-# uvks = np.concatenate((uvs, np.full((uvs.shape[0],uvs.shape[1],1),-1)), axis=2)
-# print(uvks.shape, uvks.dtype)
-rr_hrange = np.arange(rr_h)
-rr_wrange = np.arange(rr_w)
-rr_nmin = -32
-rr_nmax = 32
-rr_nrange = np.arange(rr_nmin, rr_nmax+1)
-rr_nn = rr_nmax-rr_nmin+1
+# Writes the progress file atomically, so that an
+# interruption cannot leave a damaged file
+def save_progress(progress_file, progress):
+    tmp = progress_file.with_suffix(".tmp")
+    with open(tmp, "w") as outfile:
+        json.dump(progress, outfile, indent=1)
+    os.replace(tmp, progress_file)
 
-# too big!
-# zs = np.full((h,w,nn), -1.0, dtype=np.float32)
+def write_zarr(layers, ofile, chunk):
+    nn = layers.shape[0]
+    chunks = (min(nn, chunk), chunk, chunk)
+    out = zarr.open(str(ofile), mode="w", shape=layers.shape, chunks=chunks, dtype=np.uint16)
+    # copy a chunk-row at a time (all layers), to keep memory
+    # use bounded
+    for r0 in range(0, layers.shape[1], chunk):
+        r1 = min(r0+chunk, layers.shape[1])
+        for l0 in range(0, nn, chunks[0]):
+            l1 = min(l0+chunks[0], nn)
+            out[l0:l1, r0:r1, :] = layers[l0:l1, r0:r1, :]
 
-rr_zminmaxar, rr_normals_valid = compute_zmin_zmax(rr_nrange, rr_ijks, rr_normals)
-rr_zmin = rr_zminmaxar[rr_normals_valid].min()
-rr_zmax = rr_zminmaxar[rr_normals_valid].max()
+def write_tiffs(layers, odir):
+    odir.mkdir(parents=True, exist_ok=True)
+    digits = max(2, len(str(layers.shape[0]-1)))
+    for i in range(layers.shape[0]):
+        cv2.imwrite(str(odir / ("%0*d.tif"%(digits, i))), layers[i])
 
-rr_volume = np.zeros((rr_nn,rr_h,rr_w), dtype=np.uint16)
-# iv = np.zeros((2,h,w), dtype=np.float32)
-# iv = None
-# thrange = None
-# twrange = None
+def main():
+    parser = argparse.ArgumentParser(
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+            description="Render layers of a ppm file from a scroll volume")
+    parser.add_argument(
+            "ppm_file",
+            help="ppm file describing the surface")
+    parser.add_argument(
+            "volume",
+            help="scroll volume: directory of TIFF files, or zarr array")
+    parser.add_argument(
+            "output",
+            help="output: zarr array if the name ends in .zarr, otherwise a directory of TIFF files (one per layer)")
+    parser.add_argument(
+            "--nmin",
+            type=int,
+            default=-32,
+            help="offset of the first layer along the normal")
+    parser.add_argument(
+            "--nmax",
+            type=int,
+            default=32,
+            help="offset of the last layer along the normal")
+    parser.add_argument(
+            "--pattern",
+            default="%05d.tif",
+            help="file name pattern of the TIFF files")
+    parser.add_argument(
+            "--workers",
+            type=int,
+            default=min(4, os.cpu_count() or 1),
+            help="number of worker processes")
+    parser.add_argument(
+            "--band_depth",
+            type=int,
+            default=128,
+            help="number of z values in each band (the unit of work of the worker processes)")
+    parser.add_argument(
+            "--slab_depth",
+            type=int,
+            default=None,
+            help="number of z values read at a time within a band (default: 16 for TIFF files, chunk depth for zarr)")
+    parser.add_argument(
+            "--zarr_chunk",
+            type=int,
+            default=128,
+            help="chunk size of the output zarr array")
+    parser.add_argument(
+            "--work_dir",
+            default=None,
+            help="directory for intermediate files (default: output name + '.work')")
+    parser.add_argument(
+            "--keep_work_dir",
+            action="store_true",
+            help="do not delete the work directory when done")
 
-rr_zstep = 200
-# TODO: check tif directory and make sure zstart and
-# zend are in range
-rr_zstart = int(math.floor(rr_zmin/rr_zstep)*rr_zstep)
-# zstart = max(zstart, 0)
-rr_zend = int(math.ceil(rr_zmax))
+    args = parser.parse_args()
 
-# TODO: for testing
-'''
-rr_zstep = 50
-rr_zstart = 9300
-rr_zend = 9400
-rr_zstep = 47
-rr_zstart = 9300
-rr_zend = 9400
-# rr_zend = 9369
-'''
+    ofile = pathlib.Path(args.output)
+    work_dir = pathlib.Path(args.work_dir) if args.work_dir is not None else ofile.with_name(ofile.name+".work")
+    if args.nmax < args.nmin:
+        print("nmax %d must not be less than nmin %d"%(args.nmax, args.nmin))
+        return 1
 
-rr_next_tif = read_tif(vdirname(vdir, rr_zstart))
+    ppm = Ppm.loadPpm(pathlib.Path(args.ppm_file))
+    if not ppm.valid:
+        print("Could not read ppm file:", ppm.error)
+        return 1
+    err = ppm.loadData()
+    if err is not None:
+        print("Could not read ppm data:", err.error)
+        return 1
+    try:
+        source = open_source(args.volume, args.pattern)
+    except Exception as e:
+        print("Could not open volume %s: %s"%(args.volume, e))
+        return 1
+    slab_depth = args.slab_depth
+    if slab_depth is None:
+        slab_depth = getattr(source, "chunk_depth", 16)
+    band_depth = max(args.band_depth, 1)
+    nrange = np.arange(args.nmin, args.nmax+1)
+    layers_shape = (len(nrange), ppm.height, ppm.width)
+    settings = run_settings(args, ppm, nrange, band_depth)
 
-for rr_z0 in range(rr_zstart, rr_zend, rr_zstep):
-    rr_z1 = min(rr_zend, rr_z0+rr_zstep)
-    rr_next_tif = process_z_band(rr_z0, rr_z1, vdir, rr_ijks, rr_normals, rr_zminmaxar, rr_nrange, rr_volume, rr_next_tif)
+    progress_file = work_dir / "progress.json"
+    progress = None
+    if progress_file.exists():
+        with open(progress_file) as infile:
+            progress = json.load(infile)
+        if progress["settings"] != settings:
+            print("Work directory %s was created with different settings;"%work_dir)
+            print("delete it (or use --work_dir) to start a new run")
+            return 1
+        print("Resuming: %d of %d bands already done"%(len(progress["done"]), len(progress["bands"])))
+    else:
+        work_dir.mkdir(parents=True, exist_ok=True)
+        print("Computing z range")
+        zmin, zmax = compute_zmin_zmax(ppm, nrange, work_dir / "zminmax.npy")
+        if not np.isfinite(zmin):
+            print("ppm file has no valid points")
+            return 1
+        # slices 0 to depth-1 are available; samples need z and z+1
+        zstart = max(0, int(math.floor(zmin)))
+        zend = min(source.shape[0]-1, int(math.ceil(zmax))+1)
+        # align the bands, so that the bands of runs with
+        # different z ranges line up with the zarr chunks
+        zstart = (zstart//band_depth)*band_depth
+        bands = [[z0, min(z0+band_depth, zend)] for z0 in range(zstart, zend, band_depth)]
+        with open(work_dir / "layers.raw", "wb") as outfile:
+            # creates a file of zeros (sparse on most file systems)
+            outfile.truncate(2*layers_shape[0]*layers_shape[1]*layers_shape[2])
+        progress = {"settings": settings, "bands": bands, "done": []}
+        save_progress(progress_file, progress)
+        print("z range %.1f to %.1f, %d bands"%(zmin, zmax, len(bands)))
 
-total = (rr_volume>0).sum()
-print("total", total)
+    done = set(progress["done"])
+    todo = [band for band in progress["bands"] if band[0] not in done]
+    t0 = time.time()
+    total = 0
+    if len(todo) > 0:
+        with ProcessPoolExecutor(max_workers=max(args.workers, 1), initializer=worker_init, initargs=(settings, work_dir, layers_shape)) as executor:
+            futures = [executor.submit(process_band, z0, z1, slab_depth) for z0, z1 in todo]
+            try:
+                for future in as_completed(futures):
+                    z0, count = future.result()
+                    total += count
+                    progress["done"].append(z0)
+                    save_progress(progress_file, progress)
+                    ndone = len(progress["done"])
+                    dt = time.time()-t0
+                    print("band %d done (%d of %d), %.2f M samples/s"%(z0, ndone, len(progress["bands"]), total/max(dt,.001)/1.e6))
+            except Exception as e:
+                for future in futures:
+                    future.cancel()
+                print("Error while rendering layers:", e)
+                print("Run the same command again to resume")
+                return 1
 
-for i,layer in enumerate(rr_volume):
-    print("layer", i)
-    cv2.imwrite(str(ofl / ("%02d.tif"%i)), rr_volume[i,:,:].astype(np.uint16))
-print("done")
+    print("Writing %s"%ofile)
+    layers = np.memmap(work_dir / "layers.raw", dtype=np.uint16, mode="r", shape=layers_shape)
+    if ofile.suffix == ".zarr":
+        write_zarr(layers, ofile, args.zarr_chunk)
+    else:
+        write_tiffs(layers, ofile)
+    del layers
+    if not args.keep_work_dir:
+        shutil.rmtree(work_dir)
+    print("done")
+    return 0
 
+if __name__ == '__main__':
+    exit(main())
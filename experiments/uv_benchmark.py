@@ -0,0 +1,279 @@
+# Benchmarks the UVMapper functions computeUvsFromXyzs,
+# computeUvsFromAngles, linABF and computeUvsFromABF, on
+# synthetic scroll-like meshes and (optionally) on meshes read
+# from OBJ files.
+#
+# A synthetic mesh is a sheet rolled into a spiral, with
+# radial noise, a few holes, and a band of skinny trgls; its
+# size is given as an approximate number of trgls.
+#
+# Each function is run on each mesh in a separate process, so
+# that the peak memory (RSS) of each run can be measured.  For
+# each run, the wall time, the peak memory, and the angle
+# metrics of UVMapper.angleQuality and UVMapper.maxWheelError
+# are recorded.  For functions that compute uvs, the metrics are
+# those of the angles of the trgls in uv space; in addition,
+# the difference between these angles and the xyz angles
+# (angle_distortion), and the number of trgls that are flipped
+# in uv space, are recorded.  For linABF, the metrics are those
+# of the angles that it computes.
+#
+# The results are printed, and, if --output is given, written
+# to a JSON file.  If --baseline is given (the JSON output of a
+# previous run), runs that are slower, use more memory, or
+# have more angle distortion than the baseline by more than
+# the given tolerance are listed, and the exit status is 1.
+#
+# usage: python uv_benchmark.py [mesh ...] [--output results.json]
+#            [--baseline baseline.json [--tolerance 1.25]]
+# where each mesh is either a number of trgls or an OBJ file,
+# for example: python uv_benchmark.py 10000 100000 scroll.obj --output uv.json
+
+import sys
+import os
+import io
+import json
+import time
+import platform
+import argparse
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import scipy
+
+sys.path.append(os.path.join(sys.path[0], '..'))
+from uv_mapper import UVMapper, PartitionedUVMapper
+
+default_sizes = [10000, 50000, 200000]
+functions = ["computeUvsFromXyzs", "computeUvsFromAngles", "linABF", "computeUvsFromABF"]
+
+# Creates a rolled sheet with about ntrgls trgls; returns
+# points (float64, shape (npts, 3)) and trgls (int64,
+# shape (nt, 3)).  The same seed gives the same mesh.
+def create_rolled_sheet(ntrgls, seed=0):
+    rng = np.random.default_rng(seed)
+    # the sheet is a grid of nu by nv points, 4 times longer
+    # (along the spiral) than it is wide (along z)
+    nv = max(4, int(np.sqrt(ntrgls/8)))
+    nu = 4*nv
+    us = np.arange(nu, dtype=np.float64)
+    # band of skinny trgls: the rows in this band are closer
+    # together (in v) by a factor of 10
+    vstep = np.ones(nv-1)
+    band = slice((nv-1)//3, (nv-1)//3 + max(1, (nv-1)//10))
+    vstep[band] = .1
+    vs = np.concatenate(([0.], np.cumsum(vstep)))
+    u, v = np.meshgrid(us, vs, indexing='ij')
+    # jitter the points within the sheet, except on the boundary
+    jitter = rng.uniform(-.25, .25, (2, nu, nv))
+    jitter[:, (0,-1), :] = 0.
+    jitter[:, :, (0,-1)] = 0.
+    u = u + jitter[0]
+    v = v + jitter[1]*np.concatenate(([vstep[0]], np.minimum(vstep[1:], vstep[:-1]), [vstep[-1]]))
+    # roll the sheet into an Archimedean spiral (radius
+    # proportional to angle), with about 3 turns; the
+    # turns are about 10 grid spacings apart
+    gap = 10.
+    theta_max = 6*np.pi
+    # arc length of the spiral is approximately
+    # a*theta^2/2, with a = gap/(2 pi)
+    a = gap/(2*np.pi)
+    theta0 = np.sqrt(2*nu/(a*theta_max))
+    theta = theta0 + np.sqrt(2*u/a)
+    r = a*theta
+    # noise: smooth waves plus random bumps
+    r = r + .8*np.sin(.05*u)*np.cos(.13*v) + rng.normal(0., .05, r.shape)
+    points = np.stack((r*np.cos(theta), r*np.sin(theta), v), axis=2).reshape(-1, 3)
+
+    # split each grid square along a randomly chosen diagonal
+    iu, iv = np.meshgrid(np.arange(nu-1), np.arange(nv-1), indexing='ij')
+    p00 = (iu*nv + iv).flatten()
+    p10 = p00 + nv
+    p01 = p00 + 1
+    p11 = p10 + 1
+    flip = rng.random(len(p00)) < .5
+    t1 = np.where(flip[:,np.newaxis], np.stack((p00, p10, p11), axis=1), np.stack((p00, p10, p01), axis=1))
+    t2 = np.where(flip[:,np.newaxis], np.stack((p00, p11, p01), axis=1), np.stack((p10, p11, p01), axis=1))
+    trgls = np.concatenate((t1, t2))
+
+    # holes: remove the trgls whose centroids are within
+    # a few disks in the interior of the sheet
+    centroids = np.stack((u.flatten()[trgls].mean(axis=1), v.flatten()[trgls].mean(axis=1)), axis=1)
+    keep = np.ones(len(trgls), dtype=np.bool_)
+    vmax = vs[-1]
+    for i in range(5):
+        center = (rng.uniform(.1, .9)*nu, rng.uniform(.2, .8)*vmax)
+        radius = rng.uniform(.02, .06)*vmax
+        keep &= ((centroids-center)**2).sum(axis=1) > radius*radius
+    trgls = trgls[keep]
+
+    # remove the points that are no longer used
+    used = np.zeros(len(points), dtype=np.bool_)
+    used[trgls.flatten()] = True
+    renumber = np.cumsum(used)-1
+    return points[used], renumber[trgls]
+
+def load_obj(filename):
+    from trgl_fragment import TrglFragment
+    with contextlib.redirect_stdout(io.StringIO()):
+        frags = TrglFragment.load(filename)
+    if frags is None or len(frags) == 0:
+        print("Could not read", filename)
+        return None, None
+    frag = frags[0]
+    return np.asarray(frag.gpoints[:,0:3], dtype=np.float64), np.asarray(frag.trgls, dtype=np.int64)
+
+# angles (in radians) of the trgls, given 2D or 3D points
+def trgl_angles(points, trgls):
+    if points.shape[1] == 2:
+        points = np.concatenate((points, np.zeros((len(points), 1))), axis=1)
+    mapper = UVMapper(points, trgls)
+    mapper.createAngles()
+    return mapper.angles
+
+# metrics of the given angles, which may be the output of
+# linABF, or the angles of the trgls in uv space
+def angle_metrics(mapper, angles, xyz_angles):
+    metrics = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        quality = mapper.angleQuality(angles.copy())
+        wheel = mapper.maxWheelError(angles.copy())
+    if quality is not None:
+        metrics.update(quality)
+    if wheel is not None:
+        metrics["max_wheel_error"] = float(wheel)
+    distortion = np.degrees(np.abs(angles-xyz_angles))
+    metrics["angle_distortion_mean_deg"] = float(np.nanmean(distortion))
+    metrics["angle_distortion_max_deg"] = float(np.nanmax(distortion))
+    return metrics
+
+# Runs one function on one mesh; this is called in a
+# separate process.  Returns a dict of results.
+def run_function(points, trgls, function):
+    mapper = UVMapper(points, trgls)
+    with contextlib.redirect_stdout(io.StringIO()):
+        pts = mapper.getTwoAdjacentBoundaryPoints()
+    if pts is None:
+        return {"error": "no boundary"}
+    pt0, pt1 = pts
+    mapper.constraints = np.array([[pt0, 0., 0.], [pt1, 1., 0.]], dtype=np.float64)
+    xyz_angles = trgl_angles(points, trgls)
+    if function in ("computeUvsFromAngles", "linABF"):
+        mapper.createAngles()
+    base_rss = PartitionedUVMapper.peakMemory()
+    log = io.StringIO()
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(log):
+        result = getattr(mapper, function)()
+    seconds = time.perf_counter()-t0
+    peak_rss = PartitionedUVMapper.peakMemory()
+    out = {"seconds": seconds, "peak_rss_mb": peak_rss, "base_rss_mb": base_rss}
+    if result is None:
+        out["error"] = log.getvalue().strip().split("\n")[-1]
+        return out
+    if function == "linABF":
+        out.update(angle_metrics(mapper, result, xyz_angles))
+    else:
+        uv_angles = trgl_angles(result, trgls)
+        out.update(angle_metrics(mapper, uv_angles, xyz_angles))
+        d1 = result[trgls[:,1]]-result[trgls[:,0]]
+        d2 = result[trgls[:,2]]-result[trgls[:,0]]
+        out["flipped_trgls"] = int(((d1[:,0]*d2[:,1]-d1[:,1]*d2[:,0]) < 0).sum())
+    return out
+
+def compare(results, baseline, tolerance):
+    old = {}
+    for row in baseline["results"]:
+        old[(row["mesh"], row["function"])] = row
+    regressions = []
+    for row in results:
+        prev = old.get((row["mesh"], row["function"]))
+        if prev is None:
+            continue
+        if "error" in row and "error" not in prev:
+            regressions.append((row, "failed: %s"%row["error"]))
+            continue
+        for key in ("seconds", "peak_rss_mb", "angle_distortion_mean_deg"):
+            new_value = row.get(key)
+            old_value = prev.get(key)
+            if new_value is None or old_value is None:
+                continue
+            # small absolute differences are not regressions
+            slack = {"seconds": .05, "peak_rss_mb": 10., "angle_distortion_mean_deg": 1.e-6}[key]
+            if new_value > old_value*tolerance + slack:
+                regressions.append((row, "%s %.4g (baseline %.4g)"%(key, new_value, old_value)))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the UVMapper functions")
+    parser.add_argument("meshes", nargs="*", help="number of trgls of a synthetic mesh, or an OBJ file")
+    parser.add_argument("--output", help="JSON file for the results")
+    parser.add_argument("--baseline", help="JSON file from a previous run, to compare with")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="allowed ratio of new to baseline values")
+    parser.add_argument("--functions", nargs="+", choices=functions, default=functions)
+    args = parser.parse_args()
+
+    meshes = args.meshes
+    if len(meshes) == 0:
+        meshes = [str(size) for size in default_sizes]
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for mesh in meshes:
+        if mesh.isdigit():
+            name = "rolled_%s"%mesh
+            points, trgls = create_rolled_sheet(int(mesh))
+        else:
+            name = os.path.basename(mesh)
+            points, trgls = load_obj(mesh)
+            if points is None:
+                continue
+        print("%s: %d points, %d trgls"%(name, len(points), len(trgls)))
+        for function in args.functions:
+            # a new process for each run, so that peak_rss_mb
+            # is the peak of that run only
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                out = executor.submit(run_function, points, trgls, function).result()
+            row = {"mesh": name, "npoints": len(points), "ntrgls": len(trgls), "function": function}
+            row.update(out)
+            results.append(row)
+            if "seconds" not in row:
+                print("  %-22s %s"%(function, row["error"]))
+                continue
+            msg = "  %-22s %8.3f s"%(function, row["seconds"])
+            if row["peak_rss_mb"] is not None:
+                msg += "  %7.0f Mb"%row["peak_rss_mb"]
+            if "error" in row:
+                msg += "  failed: %s"%row["error"]
+            else:
+                msg += "  distortion %.3f deg, max wheel error %.3g"%(row["angle_distortion_mean_deg"], row.get("max_wheel_error", np.nan))
+                if "flipped_trgls" in row:
+                    msg += ", %d flipped"%row["flipped_trgls"]
+            print(msg)
+
+    info = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "scipy": scipy.__version__,
+            "cpu_count": os.cpu_count(),
+            }
+    if args.output is not None:
+        with open(args.output, "w") as outfile:
+            json.dump({"info": info, "results": results}, outfile, indent=1)
+
+    if args.baseline is not None:
+        with open(args.baseline) as infile:
+            baseline = json.load(infile)
+        regressions = compare(results, baseline, args.tolerance)
+        if len(regressions) == 0:
+            print("no regressions")
+        for row, msg in regressions:
+            print("regression: %s %s: %s"%(row["mesh"], row["function"], msg))
+        if len(regressions) > 0:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -18,7 +18,7 @@ from scipy.interpolate import (
 from scipy.interpolate import CubicSpline
 from utils import Utils
 from volume import Volume
-from base_fragment import BaseFragment, BaseFragmentView
+from base_fragment import BaseFragment, BaseFragmentView, PointBuffer
 from PyQt5 import QtCore, QtGui
 from PyQt5.QtCore import Qt
 from PyQt5.QtGui import QColor
@@ -818,11 +818,12 @@ class Fragment(BaseFragment):
             if ppm is not None:
                 vrts = ppm.layerIjksToScrollIjks(vrts)
             print("# fragment", ef.frag.name, file=of)
-            for vrt in vrts:
-                if mesh_visible:
-                    print("v %.2f %.2f %.2f "%(vrt[0],vrt[1],vrt[2]), file=of)
-                else:
-                    print("v %.2f %.2f %.2f %.4f %.4f %.4f"%(vrt[0],vrt[1],vrt[2], r, g, b), file=of)
+            if mesh_visible:
+                BaseFragment.writeObjRows(of, "v %.2f %.2f %.2f \n", vrts)
+            else:
+                rgbs = np.tile((r, g, b), (len(vrts), 1))
+                BaseFragment.writeObjRows(of, "v %.2f %.2f %.2f %.4f %.4f %.4f\n", 
+                        np.concatenate((np.asarray(vrts).reshape(-1, 3), rgbs), axis=1))
 
         tex_rect = Fragment.ExportFrag.pack(efs)
         if tex_rect is None:
@@ -851,8 +852,7 @@ class Fragment(BaseFragment):
         for ef in efs:
             print("# fragment", ef.frag.name, file=of)
             if not ef.has_ssurf:
-                for i in range(len(ef.vrts)):
-                    print("vt %f %f"%(0.,0.), file=of)
+                of.write("vt %f %f\n"%(0.,0.)*len(ef.vrts))
                 continue
 
             x0, y0 = ef.tex_orig
@@ -862,24 +862,21 @@ class Fragment(BaseFragment):
             fv = ef.fv
             # tgps = Volume.globalIjksToTransposedGlobalIjks(ef.vrts, frag.direction)
             tgps = fv.cur_volume_view.volume.globalPositionsToTransposedIjks(ef.vrts, frag.direction)
-            for fpt in tgps:
-                # print("v %d %d %d"%(vrt[0],vrt[1],vrt[2]), file=of)
-                vx, vy = fpt[0:2]
-                tx = (vx+x0-dx)/(tw-1)
-                ty = (vy+y0-dy)/(th-1)
-                ty = 1.-ty
-                print("vt %f %f"%(tx, ty), file=of)
+            tgps = np.asarray(tgps)
+            vx = tgps[:,0]
+            vy = tgps[:,1]
+            tx = (vx+x0-dx)/(tw-1)
+            ty = (vy+y0-dy)/(th-1)
+            ty = 1.-ty
+            BaseFragment.writeObjRows(of, "vt %f %f\n", np.stack((tx, ty), axis=1))
 
         print("# trgls", file=of)
         i0 = 1
         for i,ef in enumerate(efs):
             print("# fragment", ef.frag.name, file=of)
             print("usemtl frag%d"%i, file=of)
-            for trg in ef.trgs:
-                v0 = trg[0]+i0
-                v1 = trg[1]+i0
-                v2 = trg[2]+i0
-                print("f %d/%d %d/%d %d/%d"%(v0,v0,v1,v1,v2,v2), file=of)
+            trgs = np.asarray(ef.trgs).reshape(-1, 3)
+            BaseFragment.writeObjRows(of, "f %d/%d %d/%d %d/%d\n", np.repeat(trgs+i0, 2, axis=1))
             i0 += len(ef.vrts)
 
         try:
@@ -939,8 +936,6 @@ class FragmentView(BaseFragmentView):
         self.lineAxis = -1
         self.lineAxisPosition = 0
         self.zsurf = None
-        self.prevZslice = -1
-        self.prevZslicePts = None
         self.ssurf = None
         self.nearbyNode = -1
         self.live_zsurf_update = True
@@ -998,9 +993,27 @@ class FragmentView(BaseFragmentView):
         self.oldtri = None
         self.clearZsliceCache()
 
-    def clearZsliceCache(self):
-        self.prevZslice = -1
-        self.prevZslicePts = None
+    # If rect (minx, miny, maxx, maxy) is given, only the
+    # cached cross sections that are affected by replacing
+    # that part of zsurf by new_zsurf are removed
+    def clearZsliceCache(self, rect=None, new_zsurf=None):
+        if rect is None or self.zsurf is None:
+            self.slice_cache.clear()
+            return
+        minx, miny, maxx, maxy = rect
+        old_zsurf = self.zsurf[miny:maxy,minx:maxx]
+        # getZsurfPoints may look at the column or row next
+        # to the requested one
+        franges = [(minx-1, maxx), (miny-1, maxy), None]
+        zs = np.concatenate((old_zsurf.flatten(), np.asarray(new_zsurf).flatten()))
+        zs = np.rint(zs[~np.isnan(zs)])
+        if len(zs) > 0:
+            franges[2] = (zs.min(), zs.max())
+        if self.aligned():
+            ranges = franges
+        else:
+            ranges = franges[::-1]
+        self.slice_cache.invalidate(ranges)
 
     def aligned(self):
         if self.cur_volume_view is None:
@@ -1102,7 +1115,7 @@ class FragmentView(BaseFragmentView):
             vol = self.cur_volume_view.volume
             print("vol", vol.name)
             newgijks = self.fragment.createInfillPoints(infill)
-            self.fragment.gpoints = np.append(self.fragment.gpoints, newgijks, axis=0)
+            PointBuffer.appendTo(self.fragment, "gpoints", newgijks)
             self.setLocalPoints(True)
 
     # given node indices and a triangulation, return a list of the
@@ -1407,8 +1420,8 @@ class FragmentView(BaseFragmentView):
                 pts = pts.transpose()
                 local_zsurf = interp(pts)
                 # print("shapes", self.zsurf.shape, local_zsurf.shape)
+                self.clearZsliceCache((minx, miny, maxx, maxy), local_zsurf)
                 self.zsurf[miny:maxy,minx:maxx] = local_zsurf
-                self.clearZsliceCache()
             timer.time("zsurf")
             overlay = self.fragment.params.get('overlay', '')
             if overlay == "diff":
@@ -1601,6 +1614,23 @@ class FragmentView(BaseFragmentView):
     def getZsurfPoints(self, vaxis, vaxisPosition):
         if self.zsurf is None:
             return
+        # Finding the points can be relatively expensive 
+        # (especially for the so-called z slice), and the
+        # same slices are requested repeatedly, so cache
+        # the results.  The cache is emptied if zsurf is
+        # replaced, and clearZsliceCache removes the entries
+        # that are affected when part of zsurf is modified.
+        cache = self.slice_cache
+        cache.checkVersion((self.zsurf,))
+        key = ("getZsurfPoints", vaxis, vaxisPosition)
+        found, pts = cache.get(key)
+        if found:
+            return pts
+        pts = self.computeZsurfPoints(vaxis, vaxisPosition)
+        cache.put(key, pts)
+        return pts
+
+    def computeZsurfPoints(self, vaxis, vaxisPosition):
         faxis = vaxis
         vnk, vnj, vni = self.cur_volume_view.trshape
         fnk, fnj, fni = vnk, vnj, vni
@@ -1645,11 +1675,6 @@ class FragmentView(BaseFragmentView):
                 pts = pts[:,(1,0)]
             return pts
         else: # faxis == 2
-            # The so-called z slice is a relatively expensive
-            # operation, and should not be performed unless "z"
-            # or the zsurf has changed.  So cache the results.
-            if self.prevZslicePts is not None and self.prevZslice == vaxisPosition:
-                return self.prevZslicePts
             frag_rect = self.computeFragRect()
             if frag_rect is not None:
                 minx, miny, maxx, maxy = frag_rect
@@ -1668,8 +1693,6 @@ class FragmentView(BaseFragmentView):
                 # print("len pts",len(pts), pts.shape)
             else:
                 pts = None
-            self.prevZslice = vaxisPosition
-            self.prevZslicePts = pts
             return pts
 
     def triangulate(self):
@@ -1783,7 +1806,7 @@ class FragmentView(BaseFragmentView):
         # create new point
         gijk = self.cur_volume_view.transposedIjkToGlobalPosition(tijk)
         self.pushFragmentState()
-        self.fragment.gpoints = np.append(self.fragment.gpoints, np.reshape(gijk, (1,3)), axis=0)
+        PointBuffer.appendTo(self.fragment, "gpoints", np.reshape(gijk, (1,3)))
         # print(self.lpoints)
         self.setLocalPoints(True, False)
         self.fragment.notifyModified()
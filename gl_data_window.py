@@ -1405,6 +1405,9 @@ class GLDataWindowChild(QOpenGLWidget):
         self.colormap_textures = {}
         self.prev_pv = None
         self.painting_slice = False
+        # reused from one redraw to the next, rather
+        # than being allocated for every volume on every redraw
+        self.data_slice = None
 
         # synchronous mode is said to be much slower
         # self.logging_mode = QOpenGLDebugLogger.SynchronousLogging
@@ -2130,7 +2133,14 @@ OSError: exception: stack overflow
         ww = self.size().width()
         wh = self.size().height()
         # TODO: need 1 or 4
-        data_slice = np.zeros((wh,ww,1), dtype=np.uint16)
+        # texFromData copies data_slice into the texture, so
+        # the same buffer can be used for every volume view
+        data_slice = self.data_slice
+        if data_slice is None or data_slice.shape != (wh,ww,1):
+            data_slice = np.zeros((wh,ww,1), dtype=np.uint16)
+            self.data_slice = data_slice
+        else:
+            data_slice.fill(0)
         zarr_max_width = dw.getZarrMaxWidth()
         axis = dw.axis
         zoom = dw.getZoom()
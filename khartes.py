@@ -18,23 +18,27 @@ class Khartes():
         self.window = window
         window.show()
 
-fmt = QSurfaceFormat()
-# Note that pyQt5 only supports OpenGL versions 2.0, 2.1, and 4.1 Core :
-# https://riverbankcomputing.com/pipermail/pyqt/2017-January/038640.html
-# To get the latest OpenGL version, perhaps use the python opengl module?
-# https://stackoverflow.com/questions/38645674/issues-with-pyqt5s-opengl-module-and-versioning-calls-for-incorrect-qopenglfu
-# But for our purposes, 4.1 Core is fine, since that is the last version
-# supported by MacOS.
-fmt.setVersion(4, 1)
-fmt.setProfile(QSurfaceFormat.CoreProfile)
-fmt.setOption(QSurfaceFormat.DebugContext)
-QSurfaceFormat.setDefaultFormat(fmt)
-
-# According to https://doc.qt.io/qt-5/qopenglwidget.html
-# QSurfaceFormat.setDefaultFormat needs to be called before
-# constructing QApplication, for MacOS
-
-app = QApplication(sys.argv)
-
-khartes = Khartes(app)
-app.exec()
+# The worker processes started by PartitionedUVMapper import
+# this file, so it must not start the application unless it
+# is run as a script
+if __name__ == '__main__':
+    fmt = QSurfaceFormat()
+    # Note that pyQt5 only supports OpenGL versions 2.0, 2.1, and 4.1 Core :
+    # https://riverbankcomputing.com/pipermail/pyqt/2017-January/038640.html
+    # To get the latest OpenGL version, perhaps use the python opengl module?
+    # https://stackoverflow.com/questions/38645674/issues-with-pyqt5s-opengl-module-and-versioning-calls-for-incorrect-qopenglfu
+    # But for our purposes, 4.1 Core is fine, since that is the last version
+    # supported by MacOS.
+    fmt.setVersion(4, 1)
+    fmt.setProfile(QSurfaceFormat.CoreProfile)
+    fmt.setOption(QSurfaceFormat.DebugContext)
+    QSurfaceFormat.setDefaultFormat(fmt)
+
+    # According to https://doc.qt.io/qt-5/qopenglwidget.html
+    # QSurfaceFormat.setDefaultFormat needs to be called before
+    # constructing QApplication, for MacOS
+
+    app = QApplication(sys.argv)
+
+    khartes = Khartes(app)
+    app.exec()
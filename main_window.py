@@ -57,7 +57,7 @@ from volume import (
         OpacitySelectorDelegate,
         MinMaxSelectorDelegate,
         ColorSelectorDelegate)
-from volume_zarr import CachedZarrVolume
+from volume_zarr import CachedZarrVolume, DecodedChunkDiskCache
 from ppm import Ppm
 from utils import Utils
 from gl_data_window import GLDataWindow
@@ -357,11 +357,12 @@ class ReparameterizeActiveFragmentButton(QPushButton):
         self.main_window = main_window
         self.setStyleSheet("QPushButton { %s; padding: 5; }"%self.main_window.highlightedBackgroundStyle())
         self.setEnabled(False)
-        self.setToolTip("Recalculate uv of the currently active fragment")
+        self.setToolTip("Recalculate uv of the currently active fragment\n(shift-click to recalculate all of it, even if a working region is set)")
         self.clicked.connect(self.onButtonClicked)
 
     def onButtonClicked(self, s):
-        self.main_window.reparameterizeActiveFragment()
+        full = bool(self.main_window.app.keyboardModifiers() & Qt.ShiftModifier)
+        self.main_window.reparameterizeActiveFragment(full)
 
 class RefineActiveFragmentButton(QPushButton):
     def __init__(self, main_window, parent=None):
@@ -582,6 +583,75 @@ class StreamCacheDirectoryButton(QPushButton):
         # self.directory_is_valid = True
         self.main_window.setStreamCacheDirectory(cdir)
 
+class StreamCacheSizeGb(QWidget):
+    def __init__(self, main_window, parent=None):
+        super(StreamCacheSizeGb, self).__init__(parent)
+        self.main_window = main_window
+        layout = QHBoxLayout()
+        layout.setContentsMargins(0,0,0,0)
+        self.setLayout(layout)
+        self.edit = QLineEdit()
+        fm = self.edit.fontMetrics()
+        w = 7*fm.horizontalAdvance('0')
+        self.edit.setFixedWidth(w)
+        self.edit.editingFinished.connect(self.onEditingFinished)
+        self.edit.textEdited.connect(self.onTextEdited)
+        layout.addWidget(self.edit)
+        label = QLabel("Stream cache size (Gb)")
+        layout.addWidget(label)
+        layout.addStretch()
+        self.setting = "stream"
+        self.param = "cache_size_gb"
+        self.setToCacheSize()
+        enabled = main_window.draw_settings[self.setting]["use_cache_directory"]
+        self.setEnabled(enabled)
+        main_window.draw_settings_widgets[self.setting][self.param] = self
+
+    def setToCacheSize(self):
+        cache_size = self.main_window.draw_settings[self.setting][self.param]
+        txt = self.floatToText(cache_size)
+        self.edit.setText(txt)
+        self.onTextEdited(txt)
+
+    def floatToText(self, value):
+        return "%.1f"%value
+
+    def onEditingFinished(self):
+        txt = self.edit.text()
+        valid, size_gb = self.parseText(txt)
+        if valid:
+            self.main_window.setStreamCacheSizeGb(size_gb)
+
+    def parseText(self, txt):
+        valid = True
+        f = 0
+        try:
+            f = float(txt)
+        except:
+            valid = False
+        if f < 1:
+            valid = False
+        return valid, f
+
+    def onTextEdited(self, txt):
+        valid, f = self.parseText(txt)
+        if valid:
+            self.edit.setStyleSheet("")
+        else:
+            self.edit.setStyleSheet("QLineEdit { color: red }")
+
+class PurgeStreamCacheButton(QPushButton):
+    def __init__(self, main_window, parent=None):
+        super(PurgeStreamCacheButton, self).__init__("Purge stream cache", parent)
+        self.main_window = main_window
+        self.setToolTip("Deletes the decoded chunks stored in the stream cache directory")
+        enabled = main_window.draw_settings["stream"]["use_cache_directory"]
+        self.setEnabled(enabled)
+        self.clicked.connect(self.onButtonClicked)
+
+    def onButtonClicked(self, s):
+        self.main_window.purgeStreamCache()
+
 class VolBoxesVisibleCheckBox(QCheckBox):
     def __init__(self, main_window, parent=None):
         super(VolBoxesVisibleCheckBox, self).__init__("Volume Boxes Visible", parent)
@@ -998,6 +1068,7 @@ class MainWindow(QMainWindow):
         "stream": {
             "cache_directory": "",
             "use_cache_directory": False,
+            "cache_size_gb": DecodedChunkDiskCache.default_max_size_gb,
         },
     }
 
@@ -1781,6 +1852,12 @@ class MainWindow(QMainWindow):
         scd = StreamCacheDirectoryButton(self)
         self.settings_stream_cache_directory = scd
         slices_layout.addWidget(scd)
+        scs = StreamCacheSizeGb(self)
+        self.settings_stream_cache_size = scs
+        slices_layout.addWidget(scs)
+        psc = PurgeStreamCacheButton(self)
+        self.settings_purge_stream_cache = psc
+        slices_layout.addWidget(psc)
 
         more_vbox = QVBoxLayout()
         hlayout.addLayout(more_vbox)
@@ -1876,8 +1953,47 @@ class MainWindow(QMainWindow):
         self.draw_settings["stream"]["use_cache_directory"] = value
         self.settings_use_stream_cache.setChecked(self.getUseStreamCache())
         self.settings_stream_cache_directory.setEnabled(self.getUseStreamCache())
+        self.settings_stream_cache_size.setEnabled(self.getUseStreamCache())
+        self.settings_purge_stream_cache.setEnabled(self.getUseStreamCache())
         self.settingsSaveDrawSettings()
 
+    def getStreamCacheSizeGb(self):
+        return self.draw_settings["stream"]["cache_size_gb"]
+
+    def setStreamCacheSizeGb(self, value):
+        old_value = self.getStreamCacheSizeGb()
+        if old_value == value:
+            return
+        self.draw_settings["stream"]["cache_size_gb"] = value
+        self.settings_stream_cache_size.setToCacheSize()
+        self.settingsSaveDrawSettings()
+        # apply the new limit to a cache that is already in use
+        cdir = self.getStreamCacheDirectory()
+        if self.getUseStreamCache() and cdir != "" and Path(cdir).is_dir():
+            DecodedChunkDiskCache.getCache(cdir, value)
+
+    # Returns the options to pass to load_zarr, or None
+    # if the stream cache is not in use
+    def getStreamCacheOptions(self):
+        cdir = self.getStreamCacheDirectory()
+        if not self.getUseStreamCache() or cdir == "":
+            return None
+        return {
+                "stream_cache_directory": cdir,
+                "stream_cache_size_gb": self.getStreamCacheSizeGb(),
+                }
+
+    def purgeStreamCache(self):
+        cdir = self.getStreamCacheDirectory()
+        if cdir == "" or not Path(cdir).is_dir():
+            QMessageBox.warning(self, "khartes", "No stream cache directory has been selected", QMessageBox.Ok)
+            return
+        ret = QMessageBox.question(self, "khartes", "Delete all the chunks stored in\n%s ?"%cdir, QMessageBox.Ok|QMessageBox.Cancel)
+        if ret != QMessageBox.Ok:
+            return
+        freed = DecodedChunkDiskCache.purgeDirectory(cdir)
+        print("Purged %.2f Gb from stream cache %s"%(freed/2**30, cdir))
+
     def getVolBoxesVisible(self):
         if self.project_view is None:
             return
@@ -2213,7 +2329,9 @@ class MainWindow(QMainWindow):
         index = pv.project.fragments.index(frag)
         self.fragments_table.model().scrollToRow(index)
 
-    def reparameterizeActiveFragment(self):
+    # If full is True, the whole fragment is reparameterized
+    # even if a working region is set
+    def reparameterizeActiveFragment(self, full=False):
         pv = self.project_view
         if pv is None:
             print("Warning, cannot reparameterize fragment without project")
@@ -2226,7 +2344,8 @@ class MainWindow(QMainWindow):
             return
         # mf = mfv.fragment
         # print("call reparam")
-        mfv.reparameterize()
+        if full or not mfv.reparameterizeWorkingRegion():
+            mfv.reparameterize()
         # print("call sstp")
         # mfv.prev_pt_count = 0
         # mfv.setScaledTexturePoints(similar=False, recurse=3)
@@ -2629,6 +2748,8 @@ class MainWindow(QMainWindow):
             return
         # if self.tiff_loader is not None:
         #     self.tiff_loader.close()
+        if self.project_view is not None:
+            self.project_view.project.saveEmptyChunkIndexes()
         e.accept()
 
     # returns True if ok to continue, False if not ok
@@ -2813,6 +2934,8 @@ class MainWindow(QMainWindow):
         for volzarr in old_vpath.glob("*.volzarr"):
             print ("volzarr:", volzarr.name)
             shutil.copy2(volzarr, new_vpath / volzarr.name)
+        for emptychunks in old_vpath.glob("*.emptychunks"):
+            shutil.copy2(emptychunks, new_vpath / emptychunks.name)
 
         old_prj.path = new_prj.path
         old_prj.volumes_path = new_prj.volumes_path
@@ -3264,10 +3387,8 @@ class MainWindow(QMainWindow):
         print(f"Loading project from {fname}")
         loading = self.showLoading()
         self.unsetProjectView()
-        load_zarr_options = None
         # print("LP", self.use_stream_cache_directory, self.stream_cache_directory)
-        if self.getUseStreamCache() and self.getStreamCacheDirectory() != "":
-            load_zarr_options = {"stream_cache_directory": self.getStreamCacheDirectory()}
+        load_zarr_options = self.getStreamCacheOptions()
 
         pv = ProjectView.open(fname, load_zarr_options)
         if not pv.valid:
@@ -0,0 +1,252 @@
+import numpy as np
+from scipy import sparse
+
+'''
+MeshTopology holds the adjacency information of a triangle
+mesh: for each point, the trgls that use it (in CSR form:
+vt_indptr and vt_indices), and for each trgl, its (up to) 3
+neighboring trgls.  It is shared by the functions that used
+to recompute this information from scratch every time they
+were called (trglsAroundPoint scanned all the trgls, and
+findNeighbors sorted all the edges).
+
+A MeshTopology is valid for a given trgls array (self.trgls);
+the owner of the trgls array checks that the topology's trgls
+array is the same object as the current one, and creates a
+new topology otherwise.
+
+Edits to the mesh (see TrglFragmentView.applyTrglDiff) delete
+some rows of the trgls array, and append new trgls at the end;
+replaceTrgls updates the topology to match, without rebuilding
+the CSR arrays: the deleted rows are recorded (self.removed,
+in terms of the rows of the trgls array that the CSR arrays
+were built from), and the appended trgls (self.trgls[nkept:])
+are few enough to be scanned directly.  Likewise, pointDeleted
+records points that have been deleted (the trgls array is
+renumbered in place when that happens).  Once the changes
+amount to more than max_change_fraction of the trgls, the CSR
+arrays are rebuilt.
+'''
+class MeshTopology:
+
+    max_change_fraction = .05
+
+    # neighbors, if given, is the result of findNeighbors(trgls)
+    def __init__(self, trgls, neighbors=None):
+        self.trgls = trgls
+        self.build(neighbors)
+
+    def build(self, neighbors=None):
+        trgls = np.asarray(self.trgls)
+        self.vt_indptr, self.vt_indices = MeshTopology.vertexTrglsCsr(trgls)
+        # number of trgls, and number of points, when the
+        # CSR arrays were built
+        self.nbase = len(trgls)
+        self.npts_base = len(self.vt_indptr)-1
+        # rows (of the original trgls array) that have
+        # since been deleted, sorted
+        self.removed = np.zeros(0, dtype=np.int64)
+        # points (numbered as in the original trgls array) that
+        # have since been deleted, sorted
+        self.deleted_pts = np.zeros(0, dtype=np.int64)
+        # findNeighbors of the original trgls array; computed
+        # when first needed.  The original array may be
+        # renumbered in place (see pointDeleted), which
+        # doesn't change its neighbors.
+        self.base_trgls = trgls
+        self.base_neighbors = neighbors
+        self.current_neighbors = None
+        if len(trgls) == 0 or (neighbors is not None and len(neighbors) == len(trgls)):
+            self.current_neighbors = neighbors
+
+    # class function
+    # returns indptr, indices: the trgls that use point i
+    # are indices[indptr[i]:indptr[i+1]], in increasing order
+    def vertexTrglsCsr(trgls):
+        flat = np.asarray(trgls, dtype=np.int64).flatten()
+        npts = 0
+        if len(flat) > 0:
+            npts = int(flat.max())+1
+        order = np.argsort(flat, kind='stable')
+        indices = order // 3
+        counts = np.bincount(flat, minlength=npts)
+        indptr = np.zeros(npts+1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        return indptr, indices
+
+    # class function
+    # For each trgl, the indices of the 3 neighboring trgls
+    # (the first is the trgl on the other side of the edge
+    # opposite vertex 0, and so on), or -1 if there is no
+    # neighbor on that side.
+    def findNeighbors(trgls):
+        trgls = np.asarray(trgls, dtype=np.int64).reshape(-1, 3)
+        nt = len(trgls)
+        neighbors = np.full((nt, 3), -1, dtype=np.int32)
+        if nt == 0:
+            return neighbors
+        npts = int(trgls.max())+1
+        # edges in the order (v0,v1), (v1,v2), (v2,v0); each
+        # one is opposite vertex 2, 0, 1 respectively
+        ea = trgls[:, (0,1,2)].T.flatten()
+        eb = trgls[:, (1,2,0)].T.flatten()
+        opposite = np.repeat(np.array((2,0,1), dtype=np.int64), nt)
+        tindex = np.tile(np.arange(nt, dtype=np.int64), 3)
+        lo = np.minimum(ea, eb)
+        hi = np.maximum(ea, eb)
+        # sort by edge, and for a given edge, put the
+        # reversed edges first.  An edge shared by more than
+        # two trgls is paired up in sorted order, so the ties
+        # are broken as in the previous implementation
+        # (BaseFragment.findNeighbors): an unstable sort by
+        # direction, followed by a stable sort by edge
+        direction = np.where(ea > eb, -1, 1)
+        order = np.argsort(direction)
+        ekey = lo*npts + hi
+        order = order[np.argsort(ekey[order], kind='stable')]
+        ekey = ekey[order]
+        duprows = np.nonzero(ekey[1:] == ekey[:-1])[0]
+        eminus = order[duprows]
+        eplus = order[duprows+1]
+        neighbors[tindex[eplus], opposite[eplus]] = tindex[eminus]
+        neighbors[tindex[eminus], opposite[eminus]] = tindex[eplus]
+        return neighbors
+
+    # number of rows of self.trgls that come from the trgls
+    # array that the CSR arrays were built from; the rest
+    # have been appended since
+    def nkept(self):
+        return self.nbase - len(self.removed)
+
+    # class function
+    # sorted_gone is a sorted list of the items that have
+    # been removed from a list; converts indices in the
+    # current list to indices in the original list
+    def originalIndices(sorted_gone, current):
+        current = np.asarray(current, dtype=np.int64)
+        if len(sorted_gone) == 0:
+            return current
+        shifted = sorted_gone - np.arange(len(sorted_gone))
+        return current + np.searchsorted(shifted, current, side='right')
+
+    # returns a list of the indices of the trgls that have
+    # point index as a vertex, in increasing order
+    # (the same as BaseFragment.trglsAroundPoint)
+    def trglsAroundPoint(self, index):
+        nkept = self.nkept()
+        tindexes = np.zeros(0, dtype=np.int64)
+        pt = MeshTopology.originalIndices(self.deleted_pts, index)
+        if pt < self.npts_base:
+            tindexes = self.vt_indices[self.vt_indptr[pt]:self.vt_indptr[pt+1]]
+            removed = self.removed
+            if len(removed) > 0:
+                tindexes = tindexes[~np.isin(tindexes, removed)]
+                tindexes = tindexes - np.searchsorted(removed, tindexes)
+        added = self.trgls[nkept:]
+        aindexes = np.nonzero((added == index).any(axis=1))[0] + nkept
+        return np.concatenate((tindexes, aindexes)).tolist()
+
+    # returns an array of the indices of the trgls that have
+    # any of the given points as a vertex, sorted and without
+    # duplicates
+    def trglsAroundPoints(self, points):
+        points = np.unique(np.asarray(points, dtype=np.int64))
+        nkept = self.nkept()
+        pts = MeshTopology.originalIndices(self.deleted_pts, points)
+        pts = pts[pts < self.npts_base]
+        starts = self.vt_indptr[pts]
+        counts = self.vt_indptr[pts+1] - starts
+        # concatenation of the ranges starts[i]:starts[i]+counts[i]
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+        tindexes = self.vt_indices[offsets + np.arange(offsets.shape[0])]
+        removed = self.removed
+        if len(removed) > 0:
+            tindexes = tindexes[~np.isin(tindexes, removed)]
+            tindexes = tindexes - np.searchsorted(removed, tindexes)
+        added = self.trgls[nkept:]
+        aindexes = np.nonzero(np.isin(added, points).any(axis=1))[0] + nkept
+        return np.unique(np.concatenate((tindexes, aindexes)))
+
+    # Called after the trgls in rows orows of self.trgls
+    # have been deleted, and new trgls have been appended;
+    # new_trgls is the resulting trgls array
+    def replaceTrgls(self, new_trgls, orows):
+        orows = np.sort(np.asarray(orows, dtype=np.int64))
+        nkept = self.nkept()
+        # deleted rows that were appended after the CSR
+        # arrays were built need no special treatment
+        base_rows = orows[orows < nkept]
+        if len(base_rows) > 0:
+            original = MeshTopology.originalIndices(self.removed, base_rows)
+            self.removed = np.union1d(self.removed, original)
+        self.trgls = new_trgls
+        self.current_neighbors = None
+        nadded = len(new_trgls) - self.nkept()
+        if len(self.removed) + nadded > self.max_change_fraction*max(self.nbase, 1000):
+            self.build()
+
+    # Called after point index has been deleted, and the
+    # points in self.trgls have been renumbered accordingly;
+    # no trgl should use the deleted point
+    def pointDeleted(self, index):
+        pt = int(MeshTopology.originalIndices(self.deleted_pts, index))
+        if pt < self.npts_base:
+            self.deleted_pts = np.union1d(self.deleted_pts, [pt])
+
+    def baseNeighbors(self):
+        if self.base_neighbors is None:
+            self.base_neighbors = MeshTopology.findNeighbors(self.base_trgls)
+        return self.base_neighbors
+
+    # returns the neighbors (see findNeighbors) of self.trgls
+    def neighbors(self):
+        if self.current_neighbors is not None:
+            return self.current_neighbors
+        base = self.baseNeighbors()
+        removed = self.removed
+        if len(removed) == 0 and self.nkept() == len(self.trgls):
+            self.current_neighbors = base
+            return base
+        kept = np.ones(self.nbase, dtype=np.bool_)
+        kept[removed] = False
+        nbrs = base[kept].astype(np.int64)
+        valid = nbrs >= 0
+        vnbrs = np.where(valid, nbrs, 0)
+        valid &= kept[vnbrs]
+        nbrs = np.where(valid, vnbrs - np.searchsorted(removed, vnbrs), -1)
+        # The appended trgls can only be neighbors of each
+        # other, or of kept trgls that have an edge without a
+        # neighbor (either because it was on the boundary
+        # of the mesh, or because its neighbor was deleted);
+        # match the edges of these trgls
+        trgls = self.trgls
+        nkept = len(nbrs)
+        local = np.concatenate((
+            np.nonzero((nbrs < 0).any(axis=1))[0],
+            np.arange(nkept, len(trgls))))
+        nbrs = np.concatenate((nbrs, np.full((len(trgls)-nkept, 3), -1, dtype=np.int64)))
+        lnbrs = MeshTopology.findNeighbors(trgls[local])
+        found = lnbrs >= 0
+        rows = np.broadcast_to(local[:,np.newaxis], lnbrs.shape)
+        cols = np.broadcast_to(np.arange(3), lnbrs.shape)
+        nbrs[rows[found], cols[found]] = local[lnbrs[found]]
+        self.current_neighbors = nbrs.astype(np.int32)
+        return self.current_neighbors
+
+    # returns a sparse (CSR) matrix, nt by nt, with a non-zero
+    # element for each pair of neighboring trgls; if
+    # include_self is True, each trgl is also its own neighbor
+    def trglGraph(self, include_self=False):
+        neighbors = self.neighbors()
+        nt = len(neighbors)
+        if include_self:
+            neighbors = np.concatenate((neighbors, np.arange(nt, dtype=neighbors.dtype)[:,np.newaxis]), axis=1)
+        ncols = neighbors.shape[1]
+        tindex = np.arange(ncols*nt)//ncols
+        nindex = neighbors.flatten()
+        is_valid = (nindex > -1)
+        tindex = tindex[is_valid]
+        nindex = nindex[is_valid]
+        ones = np.full(nindex.shape[0], 1)
+        return sparse.csr_array((ones, (tindex, nindex)), shape=(nt,nt))
+
@@ -1,4 +1,6 @@
 import pathlib
+import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from scipy.interpolate import RegularGridInterpolator
 
@@ -6,11 +8,14 @@ class Ppm():
 
     def __init__(self):
         self.data = None
-        self.ijks = None
-        self.normals = None
-        self.ijk_interpolator = None
-        self.normal_interpolator = None
+        # ijks, normals, and the interpolators are created
+        # on first use (see the properties below)
+        self._ijk_interpolator = None
+        self._normal_interpolator = None
         self.data_header = None
+        # byte offset of the start of the data in the ppm file
+        # (set by loadPpm)
+        self.data_offset = None
         self.valid = False
         self.error = "no error message set"
 
@@ -21,31 +26,122 @@ class Ppm():
 
     no_data = (0.,0.,0.)
 
+    # number of points that layerIjksToScrollIjks processes
+    # at a time; small enough that the temporary arrays stay 
+    # in cache
+    eval_chunk = 16384
+    # number of threads used by layerIjksToScrollIjks
+    eval_threads = min(8, os.cpu_count() or 1)
+
+    # The ijks and normals are views into self.data (which 
+    # is memory-mapped), so creating them doesn't copy
+    # or read anything.
+    @property
+    def ijks(self):
+        if self.data is None:
+            return None
+        return self.data[:,:,:3]
+
+    @property
+    def normals(self):
+        if self.data is None:
+            return None
+        return self.data[:,:,3:]
+
+    def createInterpolator(self, values):
+        ii = np.arange(self.height)
+        jj = np.arange(self.width)
+        return RegularGridInterpolator((ii, jj), values, fill_value=0., bounds_error=False)
+
+    @property
+    def ijk_interpolator(self):
+        if self.data is None:
+            return None
+        if self._ijk_interpolator is None:
+            self._ijk_interpolator = self.createInterpolator(self.ijks)
+        return self._ijk_interpolator
+
+    @property
+    def normal_interpolator(self):
+        if self.data is None:
+            return None
+        if self._normal_interpolator is None:
+            self._normal_interpolator = self.createInterpolator(self.normals)
+        return self._normal_interpolator
+
     # lijk (layer ijk) is in layer's global coordinates
     def layerIjksToScrollIjks(self, lijks):
         print("litsi")
         if self.data is None:
             print("litsi no data")
             return lijks
-        '''
-        li,lj,lk = lijk
-        if li < 0 or lj < 0:
-            return Ppm.no_data
-        if li >= self.width:
-            return Ppm.no_data
-        if lj >= self.height:
-            return Ppm.no_data
-        '''
-        # sijk = np.zeros((lijk.shape), dtype=lijk.dtype)
-        # sijks = self.ijk_interpolator(lijks[:,0:2])
         ijs = lijks[:,(2,0)]
-        ks = lijks[:,1,np.newaxis]
-        sijks = self.ijk_interpolator(ijs)
-        norms = self.normal_interpolator(ijs)
-        print(lijks.shape, sijks.shape, norms.shape, ks.shape)
-        sijks += norms*(ks-32)
+        ks = lijks[:,1]
+        sijks = np.zeros((len(lijks), 3), dtype=np.float64)
+        n = len(lijks)
+        chunk = Ppm.eval_chunk
+        starts = range(0, n, chunk)
+        def evalChunk(start):
+            end = min(start+chunk, n)
+            # ijks and normals, interpolated in a single pass
+            v = self.bilinear(ijs[start:end])
+            sijks[start:end] = v[:,:3] + v[:,3:]*(ks[start:end,np.newaxis]-32)
+        nthreads = min(Ppm.eval_threads, len(starts))
+        if nthreads > 1:
+            with ThreadPoolExecutor(max_workers=nthreads) as executor:
+                # list() to make sure any exceptions are raised
+                list(executor.map(evalChunk, starts))
+        else:
+            for start in starts:
+                evalChunk(start)
+        print(lijks.shape, sijks.shape)
         return sijks
 
+    # Bilinear interpolation of all 6 channels of self.data
+    # at the points ijs (an array of shape (n,2), in 
+    # (row, column) order).  Points that lie outside of the
+    # grid are set to 0.
+    # This gives the same results as RegularGridInterpolator
+    # with method "linear" and fill_value 0 (see
+    # ijk_interpolator), but is much faster, since
+    # it takes advantage of the grid being regular.
+    def bilinear(self, ijs):
+        height, width = self.height, self.width
+        flat = np.asarray(self.data).reshape(-1, 6)
+        # np.take is considerably faster than fancy indexing, 
+        # but only if the data is aligned, which depends on 
+        # the length of the ppm header
+        if flat.flags.aligned:
+            gather = lambda idx: np.take(flat, idx, axis=0)
+        else:
+            gather = lambda idx: flat[idx]
+        fi = ijs[:,0]
+        fj = ijs[:,1]
+        inside = (fi >= 0) & (fi <= height-1) & (fj >= 0) & (fj <= width-1)
+        # Points on the last row or column are interpolated 
+        # from the cell that ends there
+        i0 = np.clip(np.floor(fi), 0, max(height-2, 0))
+        j0 = np.clip(np.floor(fj), 0, max(width-2, 0))
+        # outside points (including NaNs) are evaluated at (0,0) 
+        # and zeroed below
+        i0[~inside] = 0
+        j0[~inside] = 0
+        di = (fi - i0)[:,np.newaxis]
+        dj = (fj - j0)[:,np.newaxis]
+        i0 = i0.astype(np.int64)
+        j0 = j0.astype(np.int64)
+        idx00 = i0*width + j0
+        idx10 = idx00 + (np.minimum(i0+1, height-1) - i0)*width
+        jstep = np.minimum(j0+1, width-1) - j0
+        v00 = gather(idx00)
+        v01 = gather(idx00+jstep)
+        v10 = gather(idx10)
+        v11 = gather(idx10+jstep)
+        v0 = v00 + (v01-v00)*dj
+        v1 = v10 + (v11-v10)*dj
+        result = v0 + (v1-v0)*di
+        result[~inside] = 0.
+        return result
 
     def loadData(self):
         if self.data is not None:
@@ -59,49 +155,33 @@ class Ppm():
             print(err)
             return Ppm.createErrorPpm(err)
 
+        # The data section is memory-mapped rather than read, 
+        # so that loading is immediate, and only the parts of 
+        # the file that are actually used are brought into memory
+        height = self.height
+        width = self.width
+        le = height*width*8*6
         try:
-            fd = self.path.open("rb")
-        except Exception as e:
-            err="Failed to open ppm file %s: %s"%(fstr, e)
-            print(err)
-            return Ppm.createErrorPpm(err)
-
-        try:
-            bdata = fd.read()
+            lbd = self.path.stat().st_size - self.data_offset
         except Exception as e:
             err="Failed to read ppm file %s: %s"%(fstr, e)
             print(err)
             return Ppm.createErrorPpm(err)
 
-        index = bdata.find(b'<>\n')
-        if index < 0:
-            err="Ppm file %s does not have a header"%fstr
-            print(err)
-            return Ppm.createErrorPpm(err)
-
-        bdata = bdata[index+3:]
-        lbd = len(bdata)
-        height = self.height
-        width = self.width
-        le = height*width*8*6
         if lbd != le:
             err="Ppm file %s expected %d bytes of data, got %d"%(fstr, le, lbd)
             print(err)
             return Ppm.createErrorPpm(err)
 
-        raw = np.frombuffer(bdata, dtype=np.float64)
-        self.data = np.reshape(raw, (height,width,6))
-        self.ijks = self.data[:,:,:3]
-        self.normals = self.data[:,:,3:]
+        try:
+            self.data = np.memmap(fstr, dtype=np.float64, mode='r', offset=self.data_offset, shape=(height,width,6))
+        except Exception as e:
+            err="Failed to map ppm file %s: %s"%(fstr, e)
+            print(err)
+            return Ppm.createErrorPpm(err)
+        self._ijk_interpolator = None
+        self._normal_interpolator = None
         print(self.ijks.shape, self.normals.shape)
-        # print(self.ijks[0,0,:],self.normals[0,0,:])
-        # print(self.ijks[3000,3000,:],self.normals[3000,3000,:])
-        ii = np.arange(height)
-        jj = np.arange(width)
-        self.ijk_interpolator = RegularGridInterpolator((ii, jj), self.ijks, fill_value=0., bounds_error=False)
-        self.normal_interpolator = RegularGridInterpolator((ii, jj), self.normals, fill_value=0., bounds_error=False)
-
-
 
     # reads and loads the header of the ppm file
     def loadPpm(filename):
@@ -188,6 +268,7 @@ class Ppm():
         ppm.width = width
         ppm.path = filename
         ppm.name = filename.stem
+        ppm.data_offset = index+3
         print("created ppm %s width %d height %d"%(ppm.name, ppm.width, ppm.height))
         return ppm
 
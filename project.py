@@ -594,6 +594,7 @@ class Project:
             print(e)
             print("failed to preserve previous version")
         BaseFragment.saveList(self.fragments, self.fragments_path, "all")
+        self.saveEmptyChunkIndexes()
 
         info = {}
         # TODO: set modified-date in info
@@ -756,6 +757,16 @@ class Project:
             v.setVoxelSizeUm(vs)
         self.notifyModified()
 
+    # Saves, for each zarr volume, the list of chunks
+    # that are known to be empty
+    def saveEmptyChunkIndexes(self):
+        for v in self.volumes:
+            if v.is_zarr:
+                # volumes_path changes when the project is
+                # saved under a new name
+                v.setEmptyChunkIndexDirectory(self.volumes_path)
+                v.saveEmptyChunkIndex()
+
     def hasStreamingVolume(self):
         for v in self.volumes:
             # print("hsv", v.name, v.is_streaming)
@@ -782,6 +793,12 @@ class Project:
                 filename.unlink()
         except Exception as e:
             print(f"Warning: Failed to remove file {filename}: {e}")
+        if volume.is_zarr and volume.empty_index_path is not None:
+            ipath = volume.empty_index_path
+            try:
+                ipath.unlink(missing_ok=True)
+            except Exception as e:
+                print(f"Warning: Failed to remove file {ipath}: {e}")
         
     def removeVolume(self, volume):
         if volume in self.volumes:
@@ -1,6 +1,7 @@
 import sys
 import pathlib
 import math
+from collections import OrderedDict
 
 import cv2
 import numpy as np
@@ -53,7 +54,15 @@ class ST(object):
         timage = (self.image*65535).astype(np.uint16)
         cv2.imwrite(str(fname), timage)
 
-    def computeEigens(self):
+    # Radius, in pixels, of the filters used by computeEigens
+    # (6 for the derivative kernel, 32 for the Gaussian blur);
+    # the eigens at a pixel depend only on the image within
+    # this distance of the pixel
+    filter_radius = 38
+
+    # If interpolators is False, the interpolators are not
+    # created (see createInterpolators)
+    def computeEigens(self, interpolators=True):
         tif = self.image
         sigma0 = 1.  # value used by Hale
         sigma0 = 2.
@@ -164,8 +173,19 @@ class ST(object):
         self.linearity = linearity
         self.coherence = coherence
 
+        if interpolators:
+            self.createInterpolators()
+
+    def createInterpolators(self):
         self.lambda_u_interpolator = ST.createInterpolator(self.lambda_u)
         self.lambda_v_interpolator = ST.createInterpolator(self.lambda_v)
+        # TODO: vector_u can abruptly change sign in areas of
+        # near-vertical layers, in whichy case linear interpolation
+        # of vector_u is invalid.  To avoid this, vector_u (and vector_v) 
+        # should be computed, instead of interpolated, at each interpolation
+        # point, from interpolated lambda_u and lambda_v.  Or do
+        # the lambdas need to be computed instead of interpolated
+        # as well?
         self.vector_u_interpolator = ST.createInterpolator(self.vector_u)
         self.vector_v_interpolator = ST.createInterpolator(self.vector_v)
         self.grad_interpolator = ST.createInterpolator(self.grad)
@@ -798,10 +818,10 @@ class ST(object):
         interp = RegularGridInterpolator((np.arange(ar.shape[0]), np.arange(ar.shape[1])), ar, method='linear', bounds_error=False, fill_value=0.)
         return interp
 
-    def saveEigens(self, fname):
-        if self.lambda_u is None:
-            print("saveEigens: eigenvalues not computed yet")
-            return
+    # returns an array of shape (h, w, 8) holding lambda_u,
+    # lambda_v, vector_u, vector_v, and grad; this is the
+    # format used by saveEigens and setEigensFromArray
+    def eigensArray(self):
         lu = self.lambda_u
         lv = self.lambda_v
         vu = self.vector_u
@@ -809,7 +829,13 @@ class ST(object):
         grad = self.grad
         # print(lu.shape, lu[np.newaxis,:,:].shape)
         # print(vu.shape)
-        st_all = np.concatenate((lu[:,:,np.newaxis], lv[:,:,np.newaxis], vu, vv, grad), axis=2)
+        return np.concatenate((lu[:,:,np.newaxis], lv[:,:,np.newaxis], vu, vv, grad), axis=2)
+
+    def saveEigens(self, fname):
+        if self.lambda_u is None:
+            print("saveEigens: eigenvalues not computed yet")
+            return
+        st_all = self.eigensArray()
         # turn off the default gzip compression
         header = {"encoding": "raw",}
         nrrd.write(str(fname), st_all, header, index_order='C')
@@ -830,7 +856,10 @@ class ST(object):
         except Exception as e:
             print("Error while loading",fname,e)
             return
+        self.setEigensFromArray(data)
 
+    # data is in the format returned by eigensArray
+    def setEigensFromArray(self, data):
         self.lambda_u = data[:,:,0]
         self.lambda_v = data[:,:,1]
         self.vector_u = data[:,:,2:4]
@@ -845,19 +874,180 @@ class ST(object):
         # print("lambda_u", self.lambda_u.shape, self.lambda_u.dtype)
         # print("vector_u", self.vector_u.shape, self.vector_u.dtype)
 
-        self.lambda_u_interpolator = ST.createInterpolator(self.lambda_u)
-        self.lambda_v_interpolator = ST.createInterpolator(self.lambda_v)
-        # TODO: vector_u can abruptly change sign in areas of
-        # near-vertical layers, in whichy case linear interpolation
-        # of vector_u is invalid.  To avoid this, vector_u (and vector_v) 
-        # should be computed, instead of interpolated, at each interpolation
-        # point, from interpolated lambda_u and lambda_v.  Or do
-        # the lambdas need to be computed instead of interpolated
-        # as well?
-        self.vector_u_interpolator = ST.createInterpolator(self.vector_u)
-        self.vector_v_interpolator = ST.createInterpolator(self.vector_v)
-        self.grad_interpolator = ST.createInterpolator(self.grad)
-        self.isotropy_interpolator = ST.createInterpolator(self.isotropy)
-        self.linearity_interpolator = ST.createInterpolator(self.linearity)
-        self.coherence_interpolator = ST.createInterpolator(self.coherence)
+        self.createInterpolators()
 
+'''
+LRU cache, with a memory budget, of the eigens (see
+ST.computeEigens) of the slices of a volume.  Used by
+DataWindow.autoInterpolate and DataWindow.autoExtrapolateOld,
+so that repeated calls on the same slice do not recompute
+the eigens, and so that when the region of interest grows,
+only the new parts of the region are computed.
+
+The eigens are stored in tiles of tile_size by tile_size
+pixels (in slice coordinates); adjacent missing tiles are
+computed together.  The key of a tile is
+(volume, direction, axis, slice index, tile i, tile j).
+Each tile is computed from the part of the slice that extends
+ST.filter_radius pixels beyond the tile (clipped to the
+readable part of the slice), so the eigens in a tile are the
+same as if they had been computed from the whole slice.
+A tile is recomputed if the readable part of the slice has
+changed in a way that affects it.
+
+Only the tiles of a single volume are kept, so that the
+cache does not keep the data of an unloaded volume alive.
+'''
+class STTileCache():
+    default_max_mb = 256
+    tile_size = 128
+    # dtype of the stored eigens; np.float32 halves the
+    # memory use (the eigens are computed in this type as well)
+    dtype = np.float64
+
+    def __init__(self, max_mb=None):
+        if max_mb is None:
+            max_mb = STTileCache.default_max_mb
+        self.max_bytes = int(max_mb*2**20)
+        # each value is (data rect, image, eigens array)
+        self.tiles = OrderedDict()
+        self.nbytes = 0
+        self.volume = None
+        # (key, rect, bounds) of the ST returned by the
+        # previous call to getST, and the ST itself
+        self.last_request = None
+        self.last_st = None
+        self.hits = 0
+        self.misses = 0
+
+    def setMaxMb(self, max_mb):
+        self.max_bytes = int(max_mb*2**20)
+        self.evict()
+
+    def clear(self):
+        self.tiles.clear()
+        self.nbytes = 0
+        self.last_request = None
+        self.last_st = None
+
+    def evict(self):
+        while self.nbytes > self.max_bytes and len(self.tiles) > 0:
+            key, (rect, image, eigens) = self.tiles.popitem(last=False)
+            self.nbytes -= image.nbytes + eigens.nbytes
+
+    # returns the part of tile (ti, tj) that is in bounds, and
+    # the part of the slice that the eigens in the tile depend on
+    def tileRects(self, ti, tj, bounds):
+        ts = self.tile_size
+        r = ST.filter_radius
+        (bx0,by0),(bx1,by1) = bounds
+        tx0, ty0 = max(ti*ts, bx0), max(tj*ts, by0)
+        tx1, ty1 = min((ti+1)*ts, bx1), min((tj+1)*ts, by1)
+        drect = ((max(tx0-r, bx0), max(ty0-r, by0)), (min(tx1+r, bx1), min(ty1+r, by1)))
+        return ((tx0,ty0),(tx1,ty1)), drect
+
+    # returns the cached tile, or None if it is not cached,
+    # or was computed from a different part of the slice
+    def cachedTile(self, tkey, drect):
+        tile = self.tiles.get(tkey, None)
+        if tile is None or tile[0] != drect or tile[1].dtype != self.dtype:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.tiles.move_to_end(tkey)
+        return tile
+
+    # Computes the tiles (ti, tj) for ti0 <= ti <= ti1 and
+    # tj0 <= tj <= tj1, and caches them if the data was complete;
+    # returns a dict of the tiles, keyed by (ti, tj), and whether
+    # the data was complete
+    def computeTiles(self, key, ti0, ti1, tj0, tj1, bounds, reader):
+        (dx0,dy0),_ = self.tileRects(ti0, tj0, bounds)[1]
+        _,(dx1,dy1) = self.tileRects(ti1, tj1, bounds)[1]
+        data, complete = reader(dx0, dy0, dx1, dy1)
+        st = ST(data.astype(self.dtype)/65535.)
+        st.computeEigens(interpolators=False)
+        eigens = st.eigensArray()
+        tiles = {}
+        for tj in range(tj0, tj1+1):
+            for ti in range(ti0, ti1+1):
+                trect, drect = self.tileRects(ti, tj, bounds)
+                (tx0,ty0),(tx1,ty1) = trect
+                crop = (slice(ty0-dy0, ty1-dy0), slice(tx0-dx0, tx1-dx0))
+                tile = (drect, st.image[crop].copy(), eigens[crop].copy())
+                tiles[(ti, tj)] = tile
+                if not complete:
+                    continue
+                tkey = key + (ti, tj)
+                old = self.tiles.pop(tkey, None)
+                if old is not None:
+                    self.nbytes -= old[1].nbytes + old[2].nbytes
+                self.tiles[tkey] = tile
+                self.nbytes += tile[1].nbytes + tile[2].nbytes
+        return tiles, complete
+
+    # Returns an ST, with eigens and interpolators created,
+    # of the part of a slice given by rect, ((x0,y0),(x1,y1)).
+    # key is (volume, direction, axis, slice index).
+    # bounds, in the same form as rect, is the readable part
+    # of the slice; it must contain rect.
+    # reader(x0, y0, x1, y1) returns the slice data (uint16,
+    # indexed [y,x]) in that range, and a flag that is False
+    # if some of the data was not available yet (in which case
+    # the tiles made from the data are not cached).
+    def getST(self, key, rect, bounds, reader):
+        (x0,y0),(x1,y1) = rect
+        request = (key, rect, bounds)
+        if request == self.last_request:
+            self.hits += 1
+            return self.last_st
+        if key[0] is not self.volume:
+            self.clear()
+            self.volume = key[0]
+        ts = self.tile_size
+        image = np.zeros((y1-y0, x1-x0), dtype=self.dtype)
+        eigens = np.zeros((y1-y0, x1-x0, 8), dtype=self.dtype)
+        complete = True
+        tis = range(x0//ts, (x1-1)//ts+1)
+        tjs = range(y0//ts, (y1-1)//ts+1)
+        tiles = {}
+        # runs of adjacent missing tiles in each row of tiles;
+        # runs that cover the same columns in adjacent rows are
+        # combined into blocks, each of which is computed from
+        # a single read of the slice
+        blocks = {}
+        for tj in tjs:
+            run = None
+            for ti in tis:
+                tile = self.cachedTile(key+(ti, tj), self.tileRects(ti, tj, bounds)[1])
+                tiles[(ti, tj)] = tile
+                if tile is None:
+                    if run is None:
+                        run = [ti, ti]
+                    run[1] = ti
+                if run is not None and (tile is not None or ti == tis[-1]):
+                    block = blocks.pop((run[0], run[1], tj-1), None)
+                    if block is None:
+                        block = (run[0], run[1], tj, tj)
+                    blocks[(run[0], run[1], tj)] = block[:3] + (tj,)
+                    run = None
+        for ti0, ti1, tj0, tj1 in blocks.values():
+            computed, bcomplete = self.computeTiles(key, ti0, ti1, tj0, tj1, bounds, reader)
+            tiles.update(computed)
+            complete = complete and bcomplete
+        # copy the parts of the tiles that are in rect
+        for (ti, tj), tile in tiles.items():
+            (tx0,ty0),(tx1,ty1) = self.tileRects(ti, tj, bounds)[0]
+            cx0, cy0 = max(tx0, x0), max(ty0, y0)
+            cx1, cy1 = min(tx1, x1), min(ty1, y1)
+            image[cy0-y0:cy1-y0, cx0-x0:cx1-x0] = tile[1][cy0-ty0:cy1-ty0, cx0-tx0:cx1-tx0]
+            eigens[cy0-y0:cy1-y0, cx0-x0:cx1-x0] = tile[2][cy0-ty0:cy1-ty0, cx0-tx0:cx1-tx0]
+        self.evict()
+        st = ST(image)
+        st.setEigensFromArray(eigens)
+        self.last_request = None
+        self.last_st = None
+        if complete:
+            self.last_request = request
+            self.last_st = st
+        return st
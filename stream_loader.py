@@ -321,13 +321,10 @@ class ZarrStreamLoader(QMainWindow):
             new_volume = CachedZarrVolume.createFromZarr(project, pdir, volume_name, vcrender)
         """
         # new_volume = CachedZarrVolume.createFromZarr(project, pdir, volume_name, vcrender)
-        options = None
-        use_cache = self.main_window.getUseStreamCache()
-        cache_dir = self.main_window.getStreamCacheDirectory()
-        # print("uc, cd", use_cache, cache_dir)
-        if use_cache and cache_dir != "":
-            print("using stream cache directory", cache_dir)
-            options = {"stream_cache_directory": cache_dir}
+        options = self.main_window.getStreamCacheOptions()
+        # print("options", options)
+        if options is not None:
+            print("using stream cache directory", options["stream_cache_directory"])
         new_volume = CachedZarrVolume.createFromZarr(project, pdir, volume_name, vcrender, options)
         loading = None
 
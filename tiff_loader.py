@@ -629,8 +629,8 @@ class TiffLoader(QMainWindow):
             msg.setIcon(QMessageBox.Warning)
             msg.setStandardButtons(QMessageBox.Ok|QMessageBox.Cancel)
             msg.setDefaultButton(QMessageBox.Ok)
-            msg.setText("The new volume will occupy %.1f Gb of RAM.  Proceed?"%gb)
-            msg.setDetailedText("If your computer does not have sufficient memory, this application (or other applications that use the new volume) may crash.\nThis is just a general warning; I have no way of knowing how much memory your computer actually has.")
+            msg.setText("The new volume will occupy %.1f Gb of disk space.  Proceed?"%gb)
+            msg.setDetailedText("The TIFF files are written directly to the new volume file, so little memory is needed while it is being created.  However, viewing the full volume will be slow if your computer does not have enough memory to hold most of it.\nThis is just a general warning; I have no way of knowing how much memory your computer actually has.")
             answer = msg.exec()
             # print("answer %x"%answer)
             if answer == QMessageBox.Cancel:
@@ -11,9 +11,10 @@ import scipy
 import cv2
 
 from utils import Utils
-from base_fragment import BaseFragment, BaseFragmentView
+from base_fragment import BaseFragment, BaseFragmentView, PointBuffer
+from mesh_topology import MeshTopology
 from fragment import Fragment, FragmentView
-from uv_mapper import UVMapper
+from uv_mapper import UVMapper, PartitionedUVMapper
 
 from PyQt5.QtGui import QColor
 
@@ -26,6 +27,19 @@ class TrglFragment(BaseFragment):
         self.direction = 0
         self.params = {}
         self.type = BaseFragment.Type.TRGL_FRAGMENT
+        # see topology()
+        self.mesh_topology = None
+
+    # Whether TrglFragment.load should keep a binary copy of 
+    # the loaded arrays next to each OBJ file (see readObjCache)
+    use_obj_cache = True
+    # Whether the OBJ files written when the project is saved
+    # include vertex normals ("vn" lines); these are not
+    # needed by khartes, but may be used by other programs
+    save_normals = True
+    # Size of the blocks read by parseObj
+    obj_block_size = 32*2**20
+    obj_cache_version = 2
 
     # class function
     # expected to return a list of fragments, but always
@@ -34,12 +48,351 @@ class TrglFragment(BaseFragment):
         print("loading obj file", obj_file)
         pname = Path(obj_file)
         try:
-            fd = pname.open("r")
+            fd = pname.open("rb")
         except:
             return None
 
         name = pname.stem
+
+        cache = None
+        if TrglFragment.use_obj_cache:
+            cache = TrglFragment.readObjCache(pname)
+        if cache is not None:
+            created = cache["created"]
+            frag_name = cache["name"]
+        else:
+            parsed = TrglFragment.parseObj(fd)
+            if parsed is None:
+                # unusual formatting; parse line by line
+                fd.close()
+                fd = pname.open("r")
+                parsed = TrglFragment.parseObjLines(fd)
+            vrt, tvrt, vtrg, tvtrg, created, frag_name = parsed
+            print("tf obj reader", len(vrt), len(tvrt), len(vtrg))
+            otvrt = np.zeros((len(vrt), 2), dtype=np.float32)
+            # otvrt will contain uv values that are listed
+            # in the same order as the xyz values in vrt.
+            otvrt[vtrg.flatten()] = tvrt[tvtrg.flatten()]
+        fd.close()
         
+        if frag_name == "":
+        #     frag_name = name.replace("_",":").replace("p",".")
+            frag_name = name
+        trgl_frag = TrglFragment(frag_name)
+        if cache is not None:
+            trgl_frag.gpoints = cache["gpoints"]
+            trgl_frag.gtpoints = cache["gtpoints"]
+            trgl_frag.trgls = cache["trgls"]
+        else:
+            trgl_frag.gpoints = vrt
+            trgl_frag.gtpoints = otvrt
+            trgl_frag.trgls = vtrg
+        if created == "":
+            ts = Utils.vcToTimestamp(name)
+            if ts is not None:
+                created = ts
+            else:
+                # make sure each imported surface has a unique time stamp
+                time.sleep(2)
+        if created != "":
+            trgl_frag.created = created
+        trgl_frag.params = {}
+        
+        mname = pname.with_suffix(".mtl")
+        fd = None
+        color = None
+        try:
+            fd = mname.open("r")
+        except:
+            print("failed to open mtl file",mname.name)
+            pass
+
+        if fd is not None:
+            for line in fd:
+                words = line.split()
+                # print("words[0]", words[0])
+                if len(words) == 4 and words[0] == "Kd":
+                    try:
+                        # print("words", words)
+                        r = float(words[1])
+                        g = float(words[2])
+                        b = float(words[3])
+                    except:
+                        continue
+                    # print("rgb", r,g,b)
+                    color = QColor.fromRgbF(r,g,b)
+                    break
+
+        if color is None:
+            color = Utils.getNextColor()
+        trgl_frag.setColor(color, no_notify=True)
+        trgl_frag.valid = True
+        if cache is not None and cache["rescaled"]:
+            # the cached gtpoints have already been rescaled
+            trgl_frag.neighbors = cache["neighbors"]
+            trgl_frag.mesh_topology = MeshTopology(trgl_frag.trgls, trgl_frag.neighbors)
+            print(trgl_frag.name, trgl_frag.color.name(), trgl_frag.gpoints.shape, trgl_frag.gtpoints.shape, trgl_frag.trgls.shape, "(from cache)")
+            return [trgl_frag]
+        # A cache that was written by save holds the arrays as
+        # they were read from the file, which still need to be
+        # processed in the same way as the parsed arrays
+        trgl_frag.neighbors = BaseFragment.findNeighbors(trgl_frag.trgls)
+        trgl_frag.mesh_topology = MeshTopology(trgl_frag.trgls, trgl_frag.neighbors)
+        print(trgl_frag.name, trgl_frag.color.name(), trgl_frag.gpoints.shape, trgl_frag.gtpoints.shape, trgl_frag.trgls.shape)
+        # print("tindexes", BaseFragment.trglsAroundPoint(100, trgl_frag.trgls))
+        if len(trgl_frag.gtpoints) > 0:
+            tmp_fv = trgl_frag.createView(None)
+            tmp_fv.vpoints = trgl_frag.gpoints
+            tmp_fv.setScaledTexturePoints(similar=False, recurse=3)
+            tmp_fv.printGtpoints("load before")
+            trgl_frag.gtpoints = tmp_fv.stpoints
+            tmp_fv.printGtpoints("load after")
+
+        if TrglFragment.use_obj_cache:
+            TrglFragment.writeObjCache(pname, trgl_frag, created, frag_name)
+
+        return [trgl_frag]
+
+    # class function
+    # The cache file for an OBJ file is an (uncompressed) npz 
+    # file next to it, containing the arrays created by load,
+    # after all the post-processing (neighbors, rescaled texture
+    # points).  It is valid only as long as the size and 
+    # modification time of the OBJ file are unchanged.
+    # Project.save moves the old OBJ files (and their caches)
+    # out of the fragments directory, so the cache for each
+    # new OBJ file is written by save (see writeSavedObjCache);
+    # that cache holds the arrays before post-processing (its
+    # "rescaled" flag is False), so the first load after a save
+    # does the post-processing and rewrites the cache.
+    # The arrays are copied into memory rather than kept
+    # memory-mapped, because Project.save renames all the
+    # files in the fragments directory, which would fail
+    # on Windows if a file were still mapped.
+    def objCachePath(pname):
+        return pname.with_name(pname.name+".npz")
+
+    # class function
+    def objFileStamp(pname):
+        st = pname.stat()
+        return np.array((st.st_size, st.st_mtime_ns), dtype=np.int64)
+
+    # class function
+    # returns a dict, or None if there is no valid cache
+    def readObjCache(pname):
+        cpath = TrglFragment.objCachePath(pname)
+        if not cpath.exists():
+            return None
+        try:
+            with np.load(cpath, allow_pickle=False) as npz:
+                if int(npz["version"]) != TrglFragment.obj_cache_version:
+                    return None
+                if not np.array_equal(npz["stamp"], TrglFragment.objFileStamp(pname)):
+                    print("obj cache %s is out of date"%cpath.name)
+                    return None
+                cache = {key: npz[key] for key in ("gpoints", "gtpoints", "trgls", "neighbors")}
+                cache["created"] = str(npz["created"])
+                cache["name"] = str(npz["name"])
+                cache["rescaled"] = bool(npz["rescaled"])
+        except Exception as e:
+            print("Could not read obj cache %s: %s"%(cpath, e))
+            return None
+        return cache
+
+    # class function
+    # rescaled is False if the fragment's arrays are those read
+    # from the OBJ file, before the post-processing that load does
+    def writeObjCache(pname, frag, created, frag_name, rescaled=True):
+        cpath = TrglFragment.objCachePath(pname)
+        tpath = cpath.with_name(cpath.name+".tmp.npz")
+        try:
+            np.savez(tpath, 
+                    version=TrglFragment.obj_cache_version,
+                    stamp=TrglFragment.objFileStamp(pname),
+                    gpoints=frag.gpoints, gtpoints=frag.gtpoints,
+                    trgls=frag.trgls, neighbors=frag.neighbors,
+                    created=np.array(created), name=np.array(frag_name),
+                    rescaled=np.array(rescaled))
+            tpath.replace(cpath)
+        except Exception as e:
+            print("Could not write obj cache %s: %s"%(cpath, e))
+            tpath.unlink(missing_ok=True)
+
+    # class function
+    # Parses an OBJ file (fd is opened in binary mode), 
+    # processing it in large blocks, with all the 
+    # lines of a given type converted at once by numpy.
+    # Returns (vrt, tvrt, vtrg, tvtrg, created, frag_name),
+    # or None if the file contains lines that the block parser
+    # doesn't handle (for instance, non-triangular faces, or
+    # a mix of formats within the 'f' lines); in that 
+    # case, parseObjLines should be used instead.
+    def parseObj(fd):
+        vrts = []
+        tvrts = []
+        trgs = []
+        created = ""
+        frag_name = ""
+        rest = b""
+        while True:
+            block = fd.read(TrglFragment.obj_block_size)
+            at_end = (len(block) == 0)
+            buf = rest + block
+            if at_end:
+                if len(buf) == 0:
+                    break
+                if buf[-1:] != b"\n":
+                    buf += b"\n"
+                rest = b""
+            else:
+                # process only complete lines
+                last = buf.rfind(b"\n")
+                if last < 0:
+                    rest = buf
+                    continue
+                rest = buf[last+1:]
+                buf = buf[:last+1]
+            result = TrglFragment.parseObjBlock(buf)
+            if result is None:
+                return None
+            vrt, tvrt, trg, comments = result
+            vrts.append(vrt)
+            tvrts.append(tvrt)
+            trgs.append(trg)
+            for words in comments:
+                if len(words) > 2: 
+                    if words[1] == "Created:":
+                        created = words[2]
+                    if words[1] == "Name:":
+                        frag_name = words[2]
+            if at_end:
+                break
+
+        vrt = np.concatenate([np.zeros((0,3), dtype=np.float32)]+vrts)
+        tvrt = np.concatenate([np.zeros((0,2), dtype=np.float32)]+tvrts)
+        # vertex and texture-vertex indices of the triangles
+        # have to be consistent throughout the file
+        ncols = set(trg.shape[1] for trg in trgs if len(trg) > 0)
+        if len(ncols) > 1:
+            return None
+        if len(ncols) == 0:
+            vtrg = np.zeros((0,3), dtype=np.int32)
+            tvtrg = np.zeros((0,3), dtype=np.int32)
+        else:
+            trg = np.concatenate([trg for trg in trgs if len(trg) > 0])
+            k = trg.shape[1]//3
+            trg = trg.reshape(-1, 3, k)
+            vtrg = trg[:,:,0].astype(np.int32)-1
+            if k > 1:
+                tvtrg = trg[:,:,1].astype(np.int32)-1
+            else:
+                tvtrg = vtrg.copy()
+        return vrt, tvrt, vtrg, tvtrg, created, frag_name
+
+    # class function
+    # Parses a block of complete lines of an OBJ file.
+    # Returns (vrt, tvrt, trg, comments), where trg has 3*k 
+    # columns (k being the number of '/'-separated 
+    # indices per triangle vertex), and comments is a list
+    # of the words of each comment line; or None if the
+    # block has to be parsed line by line.
+    def parseObjBlock(buf):
+        arr = np.frombuffer(buf, dtype=np.uint8)
+        nls = np.flatnonzero(arr == ord('\n'))
+        starts = np.concatenate(([0], nls[:-1]+1))
+        # whitespace (space, tab, cr, nl)
+        ws = (arr == 32) | (arr == 9) | (arr == 13) | (arr == 10)
+        # number of words in each line
+        word_start = ~ws
+        word_start[1:] &= ws[:-1]
+        nwords = np.add.reduceat(word_start, starts, dtype=np.int32)
+        c0 = arr[starts]
+        # next character (the line has at least its newline)
+        c1 = arr[np.minimum(starts+1, len(arr)-1)]
+        c1_ws = ws[np.minimum(starts+1, len(arr)-1)]
+        c2_ws = ws[np.minimum(starts+2, len(arr)-1)]
+        # the line-by-line parser strips lines before 
+        # looking at them; leave that case to it
+        if (ws[starts] & (nwords > 0)).any():
+            return None
+        is_comment = (c0 == ord('#'))
+        is_v = (c0 == ord('v')) & c1_ws
+        is_vt = (c0 == ord('v')) & (c1 == ord('t')) & c2_ws
+        is_f = (c0 == ord('f')) & c1_ws
+        lengths = np.diff(np.append(starts, len(arr)))
+
+        # vertices: 'v x y z', or 'v x y z r g b'
+        vrt = np.zeros((0,3), dtype=np.float32)
+        if is_v.any():
+            vw = nwords[is_v]
+            if (vw != vw[0]).any() or vw[0] not in (4, 7):
+                return None
+            values = TrglFragment.objLineValues(arr, starts, lengths, is_v, 1, np.float64)
+            if values is None or len(values) != len(vw)*(vw[0]-1):
+                return None
+            vrt = values.reshape(-1, vw[0]-1)[:,:3].astype(np.float32)
+
+        # texture vertices: 'vt u v'
+        tvrt = np.zeros((0,2), dtype=np.float32)
+        if is_vt.any():
+            if (nwords[is_vt] != 3).any():
+                return None
+            values = TrglFragment.objLineValues(arr, starts, lengths, is_vt, 2, np.float64)
+            if values is None or len(values) != 2*is_vt.sum():
+                return None
+            tvrt = values.reshape(-1, 2).astype(np.float32)
+
+        # triangles: 'f v v v', 'f v/vt v/vt v/vt', 
+        # or 'f v/vt/vn v/vt/vn v/vt/vn'
+        trg = np.zeros((0,3), dtype=np.int64)
+        if is_f.any():
+            if (nwords[is_f] != 4).any():
+                return None
+            slash = (arr == ord('/'))
+            nslash = np.add.reduceat(slash, starts, dtype=np.int32)[is_f]
+            if (nslash != nslash[0]).any() or nslash[0] not in (0, 3, 6):
+                return None
+            # empty indices, such as in 'v//vn'
+            if (slash[1:] & slash[:-1]).any():
+                return None
+            values = TrglFragment.objLineValues(arr, starts, lengths, is_f, 1, np.int64, slash)
+            ncols = 3*(nslash[0]//3+1)
+            if values is None or len(values) != ncols*len(nslash):
+                return None
+            trg = values.reshape(-1, ncols)
+
+        comments = []
+        for i in np.flatnonzero(is_comment):
+            line = buf[starts[i]:starts[i]+lengths[i]]
+            comments.append(line.decode('utf-8', errors='replace').split())
+        return vrt, tvrt, trg, comments
+
+    # class function
+    # Converts the numbers in the selected lines (after 
+    # skipping the first 'skip' characters of each line) into
+    # a flat array.  Characters flagged in 'separators' are
+    # treated as whitespace.
+    def objLineValues(arr, starts, lengths, selected, skip, dtype, separators=None):
+        # mask of the characters of the selected lines
+        chars = np.repeat(selected, lengths)
+        # skip the line type
+        for i in range(skip):
+            chars[starts[selected]+i] = False
+        text = arr[chars]
+        if separators is not None:
+            text = text.copy()
+            text[separators[chars]] = ord(' ')
+        try:
+            values = np.fromstring(text.tobytes(), dtype=dtype, sep=' ')
+        except ValueError:
+            # text that isn't a number
+            return None
+        return values
+
+    # class function
+    # Line-by-line OBJ parser (fd is opened in text mode).
+    # Returns the same values as parseObj.
+    def parseObjLines(fd):
         # v list
         vrtl = []
         # tv list
@@ -72,10 +425,6 @@ class TrglFragment(BaseFragment):
                     tvrtl.append([float(w) for w in words[1:]])
             elif words[0] == 'f':
                 if len(words) == 4:
-                    # old code:
-                    # # implicit assumption that v == vt
-                    # trgl.append([int(w.split('/')[0])-1 for w in words[1:]])
-
                     # in the 'f' lines, v and vt may be different.
                     # save both for later processing
                     vs = []
@@ -92,9 +441,6 @@ class TrglFragment(BaseFragment):
                     vtrgl.append(vs)
                     tvtrgl.append(tvs)
 
-
-        print("tf obj reader", len(vrtl), len(tvrtl), len(vtrgl))
-
         if len(vtrgl) > 0:
             vtrg = np.array(vtrgl, dtype=np.int32)
             tvtrg = np.array(tvtrgl, dtype=np.int32)
@@ -109,92 +455,24 @@ class TrglFragment(BaseFragment):
             tvrt = np.array(tvrtl, dtype=np.float32)
         else:
             tvrt = np.zeros((0,2), dtype=np.float32)
-        otvrt = np.zeros((len(vrt), 2), dtype=np.float32)
-        # otvrt will contain uv values that are listed
-        # in the same order as the xyz values in vrt.
-        # print(vtrg[:3])
-        # print(tvtrg[:3])
-        otvrt[vtrg.flatten()] = tvrt[tvtrg.flatten()]
-        # print("otvrt")
-        # print(otvrt[:5])
-        
-        if frag_name == "":
-        #     frag_name = name.replace("_",":").replace("p",".")
-            frag_name = name
-        trgl_frag = TrglFragment(frag_name)
-        '''
-        if len(vrtl) > 0:
-            trgl_frag.gpoints = np.array(vrtl, dtype=np.float32)
-        else:
-            trgl_frag.gpoints = np.zeros((0,3), dtype=np.float32)
-        if len(tvrtl) > 0:
-            trgl_frag.gtpoints = np.array(tvrtl, dtype=np.float32)
-        else:
-            trgl_frag.gtpoints = np.zeros((0,2), dtype=np.float32)
-        if len(trgl) > 0:
-            trgl_frag.trgls = np.array(trgl, dtype=np.int32)
-        else:
-            trgl_frag.trgls = np.zeros((0,3), dtype=np.int32)
-        '''
-        trgl_frag.gpoints = vrt
-        trgl_frag.gtpoints = otvrt
-        trgl_frag.trgls = vtrg
-        if created == "":
-            ts = Utils.vcToTimestamp(name)
-            if ts is not None:
-                created = ts
-            else:
-                # make sure each imported surface has a unique time stamp
-                time.sleep(2)
-        if created != "":
-            trgl_frag.created = created
-        trgl_frag.params = {}
-        
-        mname = pname.with_suffix(".mtl")
-        fd = None
-        color = None
-        try:
-            fd = mname.open("r")
-        except:
-            print("failed to open mtl file",mname.name)
-            pass
-
-        if fd is not None:
-            for line in fd:
-                words = line.split()
-                # print("words[0]", words[0])
-                if len(words) == 4 and words[0] == "Kd":
-                    try:
-                        # print("words", words)
-                        r = float(words[1])
-                        g = float(words[2])
-                        b = float(words[3])
-                    except:
-                        continue
-                    # print("rgb", r,g,b)
-                    color = QColor.fromRgbF(r,g,b)
-                    break
-
-        if color is None:
-            color = Utils.getNextColor()
-        trgl_frag.setColor(color, no_notify=True)
-        trgl_frag.valid = True
-        trgl_frag.neighbors = BaseFragment.findNeighbors(trgl_frag.trgls)
-        print(trgl_frag.name, trgl_frag.color.name(), trgl_frag.gpoints.shape, trgl_frag.gtpoints.shape, trgl_frag.trgls.shape)
-        # print("tindexes", BaseFragment.trglsAroundPoint(100, trgl_frag.trgls))
-        if len(trgl_frag.gtpoints) > 0:
-            tmp_fv = trgl_frag.createView(None)
-            tmp_fv.vpoints = trgl_frag.gpoints
-            tmp_fv.setScaledTexturePoints(similar=False, recurse=3)
-            tmp_fv.printGtpoints("load before")
-            trgl_frag.gtpoints = tmp_fv.stpoints
-            tmp_fv.printGtpoints("load after")
-
-        return [trgl_frag]
+        return vrt, tvrt, vtrg, tvtrg, created, frag_name
 
     def createView(self, project_view):
         return TrglFragmentView(project_view, self)
 
+    # Returns the MeshTopology (point-to-trgl and trgl-to-trgl
+    # adjacency) of self.trgls, which is shared by all the
+    # functions that need it.  Edits that go through
+    # TrglFragmentView.applyTrglDiff update the topology;
+    # if self.trgls has been replaced some other way,
+    # a new topology is created.
+    def topology(self):
+        topology = self.mesh_topology
+        if topology is None or topology.trgls is not self.trgls:
+            topology = MeshTopology(self.trgls)
+            self.mesh_topology = topology
+        return topology
+
     def createCopy(self, name):
         frag = TrglFragment(name)
         frag.setColor(self.color, no_notify=True)
@@ -215,7 +493,7 @@ class TrglFragment(BaseFragment):
                 cfixed = frag.created.replace(':',"_").replace('.',"p")
             print("tsl", frag.name)
             fpath = path / cfixed
-            frag.save(fpath)
+            frag.save(fpath, normals=TrglFragment.save_normals, obj_cache=TrglFragment.use_obj_cache)
 
     # class function
     def saveListAsObjMesh(fvs, path, infill, ppm, class_count):
@@ -234,7 +512,33 @@ class TrglFragment(BaseFragment):
 
         return ""
 
-    def save(self, fpath, ppm=None, fv=None):
+    # Writes the cache file (see readObjCache) of the OBJ file
+    # that save has just written, so that the next load doesn't
+    # need to parse it.  vrts and tpts are the arrays that were
+    # written.  The cache holds the arrays as load would parse
+    # them; load still rescales the texture points (this is
+    # too slow to do every time the project is saved), and
+    # then replaces the cache with the rescaled arrays.
+    def writeSavedObjCache(self, obj_path, vrts, tpts):
+        loaded = TrglFragment(self.name)
+        # values as they are read back from the "%f" fields
+        loaded.gpoints = np.round(np.asarray(vrts, dtype=np.float64), 6).astype(np.float32)
+        loaded.gtpoints = np.round(np.asarray(tpts, dtype=np.float64), 6).astype(np.float32)
+        loaded.trgls = np.asarray(self.trgls, dtype=np.int32)
+        # load finds the neighbors
+        loaded.neighbors = np.zeros((0,3), dtype=np.int32)
+        # the comment lines, as parsed by load
+        words = ("# Created: %s"%self.created).split()
+        created = words[2] if len(words) > 2 else ""
+        words = ("# Name: %s"%self.name).split()
+        frag_name = words[2] if len(words) > 2 else ""
+        TrglFragment.writeObjCache(obj_path, loaded, created, frag_name, rescaled=False)
+
+    # If normals is False, the "vn" lines are not written 
+    # (this saves time, and khartes doesn't read them)
+    # If obj_cache is True, the cache file of the OBJ file
+    # is written as well (see writeSavedObjCache)
+    def save(self, fpath, ppm=None, fv=None, normals=True, obj_cache=False):
         obj_path = fpath.with_suffix(".obj")
         name = fpath.name
         stem = fpath.stem
@@ -245,15 +549,19 @@ class TrglFragment(BaseFragment):
         print("# Created: %s"%self.created, file=of)
         print("# Name: %s"%self.name, file=of)
         print("# Vertices: %d"%len(self.gpoints), file=of)
-        ns = BaseFragment.pointNormals(self.gpoints, self.trgls)
+        ns = None
+        if normals:
+            ns = BaseFragment.pointNormals(self.gpoints, self.trgls)
         vrts = self.gpoints
         if ppm is not None:
             vrts = ppm.layerIjksToScrollIjks(vrts)
-        for i, pt in enumerate(vrts):
-            print("v %f %f %f"%(pt[0], pt[1], pt[2]), file=of)
-            if ns is not None:
-                n = ns[i]
-                print("vn %f %f %f"%(n[0], n[1], n[2]), file=of)
+        if ns is not None:
+            # float32 normals, so that writeObjRows can use
+            # its fast path (it requires float32-exact values)
+            ns = ns.astype(np.float32)
+            BaseFragment.writeObjRows(of, "v %f %f %f\nvn %f %f %f\n", np.concatenate((vrts, ns), axis=1))
+        else:
+            BaseFragment.writeObjRows(of, "v %f %f %f\n", vrts)
         print("# Color and texture information", file=of)
         # print("mtllib %s.mtl"%self.name, file=of)
         print("mtllib %s.mtl"%stem, file=of)
@@ -353,24 +661,23 @@ class TrglFragment(BaseFragment):
                     tpts[(tpts<0).any(axis=1), :] = -1.e+3
                 '''
     
-            for i, pt in enumerate(tpts):
-                print("vt %f %f"%(pt[0], pt[1]), file=of)
-                '''
-                # diagnostics
-                if i < 2 or i > len(tpts)-3:
-                    print("vt %f %f"%(pt[0], pt[1]))
-                '''
+            BaseFragment.writeObjRows(of, "vt %f %f\n", tpts)
 
         print("# Faces: %d"%len(self.trgls), file=of)
-        for trgl in self.trgls:
-            ostr = "f"
-            for i in range(3):
-                v = trgl[i]+1
-                if has_texture:
-                    ostr += " %d/%d/%d"%(v,v,v)
-                else:
-                    ostr += " %d/%d"%(v,v)
-            print(ostr, file=of)
+        # each vertex index is repeated, once for the texture
+        # vertex and once for the normal, if these were written:
+        # "v/v/v", "v/v", "v//v", or "v"
+        if has_texture and ns is not None:
+            BaseFragment.writeObjRows(of, "f %d/%d/%d %d/%d/%d %d/%d/%d\n", np.repeat(self.trgls+1, 3, axis=1))
+        elif has_texture:
+            BaseFragment.writeObjRows(of, "f %d/%d %d/%d %d/%d\n", np.repeat(self.trgls+1, 2, axis=1))
+        elif ns is not None:
+            BaseFragment.writeObjRows(of, "f %d//%d %d//%d %d//%d\n", np.repeat(self.trgls+1, 2, axis=1))
+        else:
+            BaseFragment.writeObjRows(of, "f %d %d %d\n", self.trgls+1)
+        of.close()
+        if obj_cache and has_texture:
+            self.writeSavedObjCache(obj_path, vrts, tpts)
         mtl_path = fpath.with_suffix(".mtl")
         try:
             of = mtl_path.open("w")
@@ -428,7 +735,11 @@ class TrglFragment(BaseFragment):
     # there are intersected triangles.
     # The second return value is a vector, as long as the first
     # array, with the trgl index of each intersected triangle.
-    def findIntersections(pts, trgls, axis, position):
+    # If index (a TrglAxisIndex created from pts and trgls) is
+    # given, only the triangles that the index reports as
+    # possibly crossing the plane are examined; the results
+    # are the same as without the index.
+    def findIntersections(pts, trgls, axis, position, index=None):
         gpts = pts
         # print("min", np.min(gpts, axis=0))
         # print("max", np.max(gpts, axis=0))
@@ -438,8 +749,14 @@ class TrglFragment(BaseFragment):
 
         # shift intersection plane slightly so that
         # no vertices lie on the plane
-        while len(gpts[gpts[:,axis]==position]) > 0:
-            position += .01
+        if index is not None:
+            while index.hasPointOnPlane(axis, position):
+                position += .01
+            candidates = index.candidates(axis, position)
+            trgls = trgls[candidates]
+        else:
+            while len(gpts[gpts[:,axis]==position]) > 0:
+                position += .01
         
         # print(axis, position)
         
@@ -528,9 +845,12 @@ class TrglFragment(BaseFragment):
         # print(i01)
         # print("i01", i01.shape)
 
-        trglist = np.indices((len(trgls),))[0]
-        # print(trgls.shape, trglist.shape, esor.shape)
-        trglist = trglist[esor]
+        if index is not None:
+            trglist = candidates[esor]
+        else:
+            trglist = np.indices((len(trgls),))[0]
+            # print(trgls.shape, trglist.shape, esor.shape)
+            trglist = trglist[esor]
 
         return i01, trglist
 
@@ -549,11 +869,30 @@ class TrglFragmentView(BaseFragmentView):
         self.all_stpoints = np.zeros((0,2))
         self.setStxyDefaults()
         self.normals = None
+        # Per-trgl normal vectors and their per-point sums,
+        # from which self.normals is computed; see
+        # computeNormals and updateNormals
+        self.trgl_normal_vectors = None
+        self.normal_sums = None
+        self.normals_version = None
         self.normal_offset = 0.
         # self.half_width_multiplier = 10
         self.half_width_multiplier = 5
         if len(trgl_fragment.trgls) == 0:
             self.mesh_visible = False
+        # TrglAxisIndex of self.fpoints and self.trgls(),
+        # created as needed by getLinesOnSlice
+        self.axis_index = None
+
+    # class variables
+    # If incremental_normals is True, an edit updates only
+    # the normals of the points near the edit; otherwise all
+    # the normals are recomputed after every edit.
+    incremental_normals = True
+    # If validate_normals is True, the incrementally updated
+    # normals are compared with fully recomputed ones, and any
+    # differences are reported
+    validate_normals = False
 
     def allowAutoExtrapolation(self):
         return False
@@ -561,16 +900,203 @@ class TrglFragmentView(BaseFragmentView):
     def allowAutoInterpolation(self):
         return False
 
-    def setLocalPoint(self, index):
+    # new_point is True if the point has just been added
+    # (so it has no previous position)
+    def setLocalPoint(self, index, new_point=False):
         self.local_points_modified = Utils.timestamp()
+        old_pt = None
+        if not new_point:
+            old_pt = self.fpoints[index].copy()
         self.vpoints[index, :3] = self.cur_volume_view.globalPositionToTransposedIjk(self.fragment.gpoints[index])
         self.vpoints[index, 3] = index
         self.fpoints[index] = self.vpoints[index, :3]
+        trgls = self.trgls()
+        tindexes = self.trglsAroundPoint(index)
+        if self.axis_index is not None and self.axis_index.pts is self.fpoints:
+            self.axis_index.pointMoved(index, tindexes)
+        if self.slice_cache.isVersion((self.fpoints, trgls)):
+            self.invalidateSlicesAroundPoint(index, old_pt, tindexes)
+        self.updateNormals(tindexes)
 
     def addLocalPoint(self, index):
-        self.vpoints = np.insert(self.vpoints, index, [0.]*4, axis=0)
-        self.fpoints = np.insert(self.fpoints, index, [0.]*3, axis=0)
-        self.setLocalPoint(index)
+        version_ok = self.slice_cache.isVersion((self.fpoints, self.trgls()))
+        normals_ok = self.normalsAreCurrent()
+        PointBuffer.insertInto(self, "vpoints", index, [[0.]*4])
+        PointBuffer.insertInto(self, "fpoints", index, [[0.]*3])
+        # Inserting a point (at the end of the list, which
+        # is where addPoint puts it) doesn't change any
+        # cross sections or normals by itself
+        at_end = (index == len(self.fpoints)-1)
+        if version_ok and at_end:
+            self.slice_cache.setVersion((self.fpoints, self.trgls()))
+        if normals_ok and at_end:
+            PointBuffer.insertInto(self, "normal_sums", index, [[0.]*3])
+            PointBuffer.insertInto(self, "normals", index, [[0.]*3])
+            self.normals_version = (self.fpoints, self.trgls())
+        self.setLocalPoint(index, True)
+
+    # The point normals (self.normals) are kept up to date
+    # as the mesh is edited.  self.trgl_normal_vectors holds
+    # the (unnormalized) normal vector of each trgl, and
+    # self.normal_sums holds, for each point, the sum of the
+    # vectors of the trgls that share that point, so that
+    # after an edit, only the vectors of the affected trgls, 
+    # and the normals of their vertices, need to be updated.
+    # Trgls that refer to a point that hasn't been added
+    # to fpoints yet (see addPoint) are given a zero vector
+    # until the point is added.
+    # This is valid for a given fpoints array and trgls array
+    # (normals_version); if either one has been replaced 
+    # other than by the edits below, the normals are
+    # recomputed from scratch.
+
+    def normalsAreCurrent(self):
+        version = self.normals_version
+        return (version is not None and version[0] is self.fpoints 
+                and version[1] is self.trgls())
+
+    # class function
+    # like BaseFragment.trglNormalVectors, but gives a zero 
+    # vector to trgls that refer to points beyond the end of pts
+    def trglNormalVectorsOfExisting(pts, trgls):
+        vecs = np.zeros((len(trgls), 3), dtype=np.float64)
+        if len(trgls) == 0:
+            return vecs
+        exists = (trgls < len(pts)).all(axis=1)
+        vecs[exists] = BaseFragment.trglNormalVectors(pts, trgls[exists])
+        return vecs
+
+    def computeNormals(self):
+        pts = self.fpoints[:,:3]
+        trgls = self.trgls()
+        vecs = TrglFragmentView.trglNormalVectorsOfExisting(pts, trgls)
+        exists = (trgls < len(pts)).all(axis=1)
+        sums = BaseFragment.sumTrglVectorsAtPoints(len(pts), trgls[exists], vecs[exists])
+        self.trgl_normal_vectors = vecs
+        self.normal_sums = sums
+        self.normals = BaseFragment.unitVectors(sums)
+        self.normals_version = (self.fpoints, trgls)
+
+    # Recomputes the vectors of the trgls in tindexes, whose
+    # vertices have moved, and the normals of their vertices
+    def updateNormals(self, tindexes):
+        if not TrglFragmentView.incremental_normals or not self.normalsAreCurrent():
+            self.computeNormals()
+            return
+        tindexes = np.asarray(tindexes, dtype=np.int64)
+        if len(tindexes) == 0:
+            return
+        trgls = self.trgls()
+        ltrgls = trgls[tindexes]
+        old_vecs = self.trgl_normal_vectors[tindexes]
+        new_vecs = TrglFragmentView.trglNormalVectorsOfExisting(self.fpoints[:,:3], ltrgls)
+        self.trgl_normal_vectors[tindexes] = new_vecs
+        self.addToNormalSums(ltrgls, new_vecs-old_vecs)
+
+    # Adds vecs (one per trgl in ltrgls) to the sums of the
+    # trgls' vertices, and recomputes the normals of those
+    # vertices
+    def addToNormalSums(self, ltrgls, vecs):
+        ltrgls = np.asarray(ltrgls, dtype=np.int64).reshape(-1, 3)
+        exists = (ltrgls < len(self.normal_sums)).all(axis=1)
+        ltrgls = ltrgls[exists]
+        vecs = vecs[exists]
+        for i in range(3):
+            np.add.at(self.normal_sums, ltrgls[:,i], vecs)
+        vrts = np.unique(ltrgls)
+        self.normals[vrts] = BaseFragment.unitVectors(self.normal_sums[vrts])
+        if TrglFragmentView.validate_normals:
+            self.checkNormals()
+
+    # Called by applyTrglDiff after the trgls in rows orows
+    # (of old_trgls) have been deleted and ntrgls have been 
+    # added at the end
+    def updateNormalsAfterTrglDiff(self, old_trgls, orows, otrgls, ntrgls):
+        version = self.normals_version
+        if (not TrglFragmentView.incremental_normals or version is None 
+                or version[0] is not self.fpoints or version[1] is not old_trgls):
+            self.computeNormals()
+            return
+        orows = np.asarray(orows, dtype=np.int64)
+        old_vecs = self.trgl_normal_vectors[orows]
+        ntrgls = np.asarray(ntrgls, dtype=np.int64).reshape(-1, 3)
+        new_vecs = TrglFragmentView.trglNormalVectorsOfExisting(self.fpoints[:,:3], ntrgls)
+        self.trgl_normal_vectors = np.concatenate((
+            np.delete(self.trgl_normal_vectors, orows, 0), new_vecs))
+        self.normals_version = (self.fpoints, self.trgls())
+        self.addToNormalSums(np.concatenate((old_trgls[orows], ntrgls)), 
+                np.concatenate((-old_vecs, new_vecs)))
+
+    # Validation mode: compares the incrementally updated 
+    # normals with fully recomputed ones
+    def checkNormals(self):
+        normals = self.normals
+        self.computeNormals()
+        if normals.shape != self.normals.shape:
+            print("checkNormals: shape mismatch", normals.shape, self.normals.shape)
+            return
+        if len(normals) == 0:
+            return
+        diff = np.abs(normals - self.normals).max()
+        if diff > 1.e-4:
+            print("checkNormals: max difference", diff)
+
+    # The slice cache (see getLinesOnSlice) holds cross sections
+    # that are valid for a given fpoints array and trgls array.
+    # The functions below remove only the cached cross sections
+    # that are affected by an edit.
+
+    # Removes the cross sections affected by moving point
+    # index (whose previous position, if any, is old_pt), 
+    # or by deleting it (if it is about to be deleted)
+    # tindexes, if given, is the list of trgls around
+    # the point
+    def invalidateSlicesAroundPoint(self, index, old_pt=None, tindexes=None):
+        trgls = self.trgls()
+        if tindexes is None:
+            tindexes = self.trglsAroundPoint(index)
+        vrts = np.append(trgls[tindexes].flatten(), index)
+        pts = self.fpoints[vrts]
+        if old_pt is not None:
+            pts = np.concatenate((pts, [old_pt]))
+        self.invalidateSlicesAroundPoints(pts)
+
+    # Removes the cross sections on slices that pass through 
+    # the bounding box of pts
+    def invalidateSlicesAroundPoints(self, pts):
+        pts = np.asarray(pts, dtype=np.float64).reshape(-1, 3)
+        if len(pts) == 0:
+            return
+        mins = np.nanmin(pts, axis=0)
+        maxs = np.nanmax(pts, axis=0)
+        # findIntersections moves the plane by .01 (possibly
+        # more than once) when a point lies exactly on it, 
+        # so slices just below the box are affected as well
+        ranges = [(mins[i]-1., maxs[i]) for i in range(3)]
+        self.slice_cache.invalidate(ranges)
+
+    # Called by applyTrglDiff after the trgls in rows orows
+    # (of old_trgls) have been deleted and ntrgls have been 
+    # added at the end
+    def invalidateSlicesAfterTrglDiff(self, old_trgls, orows, otrgls, ntrgls):
+        cache = self.slice_cache
+        if not cache.isVersion((self.fpoints, old_trgls)):
+            return
+        # vertices that haven't been added to fpoints yet
+        # (see addPoint) are handled by setLocalPoint
+        vrts = np.concatenate((np.asarray(otrgls).flatten(), np.asarray(ntrgls).flatten())).astype(np.int64)
+        vrts = vrts[vrts < len(self.fpoints)]
+        self.invalidateSlicesAroundPoints(self.fpoints[vrts])
+        # the remaining cross sections are still valid, but
+        # their trgl indices need to be updated
+        orows = np.sort(np.asarray(orows, dtype=np.int64))
+        for key, (plines, trglist) in list(cache.entries.items()):
+            if np.isin(trglist, orows).any():
+                del cache.entries[key]
+                continue
+            trglist = trglist - np.searchsorted(orows, trglist)
+            cache.entries[key] = (plines, trglist)
+        cache.setVersion((self.fpoints, self.trgls()))
 
     # TODO: if cur_volume_view changed, unset working region
     # NOTE that Fragment.setLocalPoints sets stpoints,
@@ -619,8 +1145,9 @@ class TrglFragmentView(BaseFragmentView):
         '''
         # timer = Utils.Timer()
         # print("computing normals")
-        # TODO: compute only modified normals
-        self.normals = BaseFragment.pointNormals(self.vpoints[:,:3], self.trgls())
+        # After an edit, only the modified normals are 
+        # recomputed (see updateNormals)
+        self.computeNormals()
         # timer.time("normals")
         
         # self.createTetras()
@@ -1023,8 +1550,6 @@ class TrglFragmentView(BaseFragmentView):
         self.stpoints = stp
         # self.stmin = stmin
         # self.stmax = stmax
-        self.stmin = stp.min(axis=0)
-        self.stmax = stp.max(axis=0)
         # self.xyzmin = xyzmin
         # self.xyzmax = xyzmax
         # print("shifted st min max", self.stmin, self.stmax)
@@ -1042,6 +1567,18 @@ class TrglFragmentView(BaseFragmentView):
                 self.setScaledTexturePoints(similar=similar, recurse=recurse-1)
                 return
 
+        self.updateStBounds()
+        self.retriangulateAll()
+        timer.time("retriangulate time")
+
+    # Recomputes the values that depend on the extent of
+    # self.stpoints: stmin, stmax, avg_st_len, and the outside
+    # points (which surround the st points, and are appended
+    # to them in all_stpoints)
+    def updateStBounds(self):
+        stp = self.stpoints
+        self.stmin = stp.min(axis=0)
+        self.stmax = stp.max(axis=0)
         # stsize = self.stmax-self.stmin
         # starea = (stsize*stsize).sum()
         # ptarea = starea / len(self.stpoints)
@@ -1055,8 +1592,6 @@ class TrglFragmentView(BaseFragmentView):
         self.outside_stpoints = self.outsidePoints(self.avg_st_len)
         # print("stp", stp.shape, "outside", self.outside_stpoints.shape)
         self.all_stpoints = np.concatenate((stp, self.outside_stpoints), axis=0)
-        self.retriangulateAll()
-        timer.time("retriangulate time")
 
     def setStxyDefaults(self):
         self.st_abcd = (1.,0.,0.,1.)
@@ -1116,6 +1651,10 @@ class TrglFragmentView(BaseFragmentView):
         pass
 
     def setWorkingRegion(self, index, max_angle):
+        # working_trgls has one element per row of this trgls
+        # array; edits to the mesh replace the array (see
+        # applyTrglDiff), after which the rows no longer match
+        self.working_region_trgls = self.trgls()
         if index < 0:
             # self.working_trgls = np.zeros((0, 3), dtype=np.int32)
             # self.working_vpoints = np.zeros((0,4), dtype=np.float32)
@@ -1215,8 +1754,26 @@ class TrglFragmentView(BaseFragmentView):
         plines = vpts.reshape(-1,2,3)
         return plines
         '''
-        ints, trglist = TrglFragment.findIntersections(self.fpoints, self.trgls(), axis, axis_pos)
+        trgls = self.trgls()
+        # The slice cache is emptied if fpoints or trgls has been
+        # replaced, except by the edits (moving, adding, and
+        # deleting points) that remove only the affected entries
+        cache = self.slice_cache
+        cache.checkVersion((self.fpoints, trgls))
+        key = ("getLinesOnSlice", axis, axis_pos)
+        found, result = cache.get(key)
+        if found:
+            return result
+        # The index is rebuilt whenever the point array or the
+        # trgl array has been replaced; points that are moved
+        # in place are reported to it by setLocalPoint
+        index = self.axis_index
+        if index is None or index.pts is not self.fpoints or index.trgls is not trgls:
+            index = TrglAxisIndex(self.fpoints, trgls)
+            self.axis_index = index
+        ints, trglist = TrglFragment.findIntersections(self.fpoints, trgls, axis, axis_pos, index)
         plines = ints.reshape(-1,2,3)
+        self.slice_cache.put(key, (plines, trglist))
         return plines, trglist
 
     def aligned(self):
@@ -1225,6 +1782,9 @@ class TrglFragmentView(BaseFragmentView):
     def trgls(self):
         return self.fragment.trgls
 
+    def trglsAroundPoint(self, pt_index):
+        return self.fragment.topology().trglsAroundPoint(pt_index)
+
     def outsidePoints(self, ptstep):
         stp = self.stpoints
         stmin = self.stmin
@@ -1321,6 +1881,11 @@ class TrglFragmentView(BaseFragmentView):
             print("rebuildStPoints succeeded", len(self.stpoints))
         self.fragment.notifyModified()
 
+    # Meshes with more trgls than this are reparameterized
+    # by PartitionedUVMapper, which flattens the mesh in
+    # overlapping pieces, instead of in one piece
+    partitioned_reparameterize_trgls = 2000000
+
     def reparameterize(self, rebuild_st_first=False):
         self.stpoints = None
         # print("rpm set stpoints to None")
@@ -1361,6 +1926,7 @@ class TrglFragmentView(BaseFragmentView):
         # print("rt before mapper")
         # print(self.trgls()[(self.trgls()==181).any(axis=1)])
         mapper = UVMapper(xyzs, trgls)
+        mapper.topology = self.fragment.topology()
         # print("rt after mapper")
         # print(self.trgls()[(self.trgls()==181).any(axis=1)])
 
@@ -1378,12 +1944,23 @@ class TrglFragmentView(BaseFragmentView):
             print("reparameterize: could not find boundary points!")
             return
         pt0, pt1 = ta
-        mapper.constraints = np.array([[pt0, 0., 0.], [pt1, 1., 0.]], dtype=np.float64)
-        weight = .000001
-        # mapper.ip_weights = np.full(self.stpoints.shape[0], weight)
-        mapper.ip_weights = np.full(self.fragment.gtpoints.shape[0], weight)
-        mapper.initial_points = self.fragment.gtpoints
-        adjusted_sts = mapper.computeUvsFromABF()
+        if len(trgls) > self.partitioned_reparameterize_trgls:
+            pmapper = PartitionedUVMapper(xyzs, trgls)
+            pmapper.topology = mapper.topology
+            adjusted_sts = pmapper.computeUvs()
+            if adjusted_sts is not None:
+                # move pt0 to (0,0) and pt1 to (1,0), as the
+                # constraints below would
+                zs = adjusted_sts[:,0] + 1j*adjusted_sts[:,1]
+                zs = (zs-zs[pt0])/(zs[pt1]-zs[pt0])
+                adjusted_sts = np.stack((zs.real, zs.imag), axis=1)
+        else:
+            mapper.constraints = np.array([[pt0, 0., 0.], [pt1, 1., 0.]], dtype=np.float64)
+            weight = .000001
+            # mapper.ip_weights = np.full(self.stpoints.shape[0], weight)
+            mapper.ip_weights = np.full(self.fragment.gtpoints.shape[0], weight)
+            mapper.initial_points = self.fragment.gtpoints
+            adjusted_sts = mapper.computeUvsFromABF()
         if adjusted_sts is None:
             print("reparameterize failed!")
             return
@@ -1399,6 +1976,99 @@ class TrglFragmentView(BaseFragmentView):
         # print(self.stpoints)
         self.fragment.notifyModified()
 
+    # If True, and a working region has been set (see
+    # setWorkingRegion), reparameterizeWorkingRegion only
+    # recomputes the uv coordinates in and around the
+    # working region
+    local_reparameterize = True
+    # number of rings of trgls, around the region, that are
+    # reparameterized along with the region
+    reparameterize_buffer_rings = 2
+
+    # Returns False if there is no working region, or if the mesh
+    # has been edited since the working region was set, in which
+    # case reparameterize should be called instead
+    def reparameterizeWorkingRegion(self):
+        if not self.local_reparameterize:
+            return False
+        region = self.working_trgls
+        if region is None or self.working_region_trgls is not self.trgls() or not region.any():
+            return False
+        return self.reparameterizeRegion(region)
+
+    # Recomputes the uv coordinates (gtpoints) of the points of
+    # the trgls in region (a bool array with one element per trgl,
+    # or a list of trgl indexes), and of the trgls within
+    # reparameterize_buffer_rings of the region.  The points that
+    # these trgls share with the rest of the mesh keep their
+    # current uv coordinates, so the rest of the mesh is not
+    # affected, and the cost depends on the size of the region
+    # rather than on the size of the mesh.
+    # Returns False, without changing anything, if the region (plus
+    # buffer) includes all of the mesh, so that there is nothing
+    # to pin it to; reparameterize should be called instead.
+    def reparameterizeRegion(self, region):
+        timer = Utils.Timer()
+        timer.active = False
+        trgls = self.trgls()
+        gpoints = self.fragment.gpoints
+        gtpoints = self.fragment.gtpoints
+        npt = len(gpoints)
+        if len(gtpoints) != npt or len(trgls) == 0:
+            return False
+        in_region = np.full(len(trgls), False)
+        in_region[region] = True
+        for i in range(self.reparameterize_buffer_rings):
+            used = np.full(npt, False)
+            used[trgls[in_region]] = True
+            in_region = used[trgls].any(axis=1)
+        if in_region.all():
+            return False
+        rtrgls = trgls[in_region]
+        # points used by the region's trgls
+        rpts = np.unique(rtrgls)
+        # of these, the ones that are also used by trgls
+        # outside the region
+        outside = np.full(npt, False)
+        outside[trgls[~in_region]] = True
+        pinned = np.nonzero(outside[rpts])[0]
+        if len(pinned) < 2:
+            return False
+        o2n = np.full(npt, -1, dtype=np.int64)
+        o2n[rpts] = np.arange(len(rpts))
+        timer.time("region")
+
+        mapper = UVMapper(gpoints[rpts], o2n[rtrgls])
+        constraints = np.zeros((len(pinned), 3), dtype=np.float64)
+        constraints[:, 0] = pinned
+        constraints[:, (1,2)] = gtpoints[rpts[pinned]]
+        mapper.constraints = constraints
+        mapper.initial_points = gtpoints[rpts].astype(np.float64)
+        # xyz-based LSCM, rather than ABF, because many points
+        # are pinned (see TrglPointSet.adjustSts)
+        uvs = mapper.computeUvsFromXyzs()
+        timer.time("mapper")
+        if uvs is None:
+            print("reparameterizeRegion failed!")
+            return True
+        self.fragment.gtpoints[rpts] = uvs
+        if self.stpoints is not None and len(self.stpoints) == npt:
+            self.stpoints[rpts] = self.uvsToStxys(uvs)
+            # the region may have moved past the old st bounds;
+            # the trgls are unchanged, so (unlike in
+            # setScaledTexturePoints) there is no need to
+            # retriangulate
+            self.updateStBounds()
+            timer.time("st bounds")
+        # the map image (see setMapImage) shows the old
+        # st coordinates
+        self.map_image = None
+        self.map_corners = None
+        if timer.active:
+            print("reparameterized", len(rtrgls), "of", len(trgls), "trgls")
+        self.fragment.notifyModified()
+        return True
+
 
     # This depends on self.fragment.trgls being
     # up to date
@@ -1519,12 +2189,21 @@ class TrglFragmentView(BaseFragmentView):
                 # print("un", ntrgls)
                 # self.replaceTrgls(otrgls, ntrgls)
                 # self.fragment.trgls = TrglPointSet.replaceTrgls(self.fragment.trgls, otrgls, ntrgls)
-                trgls = TrglPointSet.replaceTrgls(self.fragment.trgls, otrgls, ntrgls)
+                old_trgls = self.fragment.trgls
+                topology = self.fragment.topology()
+                orows = TrglPointSet.trglRows(old_trgls, otrgls)
+                trgls = None
+                if orows is not None:
+                    trgls = TrglPointSet.replaceTrgls(old_trgls, otrgls, ntrgls, orows)
                 if trgls is not None:
                     self.fragment.trgls = trgls
+                    topology.replaceTrgls(trgls, orows)
+                    self.invalidateSlicesAfterTrglDiff(old_trgls, orows, otrgls, ntrgls)
+                    self.updateNormalsAfterTrglDiff(old_trgls, orows, otrgls, ntrgls)
                 else:
                     print("applyTrglDiff: retriangulating")
                     self.retriangulateAll()
+                    self.computeNormals()
 
 
     def pointExists(self, stxy):
@@ -1601,12 +2280,12 @@ class TrglFragmentView(BaseFragmentView):
         half_width = self.half_width_multiplier*self.avg_st_len
         half_width = max(half_width, 2*mel)
 
-        self.fragment.gpoints = np.append(self.fragment.gpoints, [gijk], axis=0)
+        PointBuffer.appendTo(self.fragment, "gpoints", [gijk])
         uv = self.stxyToUv(stxy)
         nstp = len(self.stpoints)
-        self.fragment.gtpoints = np.append(self.fragment.gtpoints, [uv], axis=0)
-        self.stpoints = np.append(self.stpoints, [stxy], axis=0)
-        self.all_stpoints = np.insert(self.all_stpoints, nstp, stxy, axis=0)
+        PointBuffer.appendTo(self.fragment, "gtpoints", [uv])
+        PointBuffer.appendTo(self, "stpoints", [stxy])
+        PointBuffer.insertInto(self, "all_stpoints", nstp, [stxy])
         timer.time("setup")
 
         ops = TrglPointSet(self.all_stpoints, len(self.stpoints), astxy, half_width)
@@ -1726,7 +2405,7 @@ class TrglFragmentView(BaseFragmentView):
         trgls = self.fragment.trgls
         if len(trgls) < 3:
             return
-        neighbors = BaseFragment.findNeighbors(trgls)
+        topology = self.fragment.topology()
         '''
         gpoints = self.fragment.gpoints
         # testinds = np.nonzero(gpoints[:,2] == 10536)
@@ -1741,19 +2420,10 @@ class TrglFragmentView(BaseFragmentView):
         # print("neighbors")
         # print(neighbors[1774:1780])
         '''
-        nt = trgls.shape[0]
-        # print("t n", trgls.shape, neighbors.shape)
         # each triangle also has itself as a neighbor
         # (this is so that triangles with no neighbors will still
         # show up in the connectivity graph)
-        neighbors = np.append(neighbors, np.ogrid[:nt,:0][0], axis=1)
-        tindex = np.ogrid[:4*nt]//4
-        nindex = neighbors.flatten()
-        is_valid = (nindex > -1)
-        tindex = tindex[is_valid]
-        nindex = nindex[is_valid]
-        ones = np.full(nindex.shape[0], 1)
-        connections = scipy.sparse.csr_array((ones, (tindex, nindex)), shape=(nt,nt))
+        connections = topology.trglGraph(include_self=True)
         # print("connections")
         # print(connections)
         nc, labels = scipy.sparse.csgraph.connected_components(connections, directed=False)
@@ -1830,11 +2500,26 @@ class TrglFragmentView(BaseFragmentView):
         nps.deletePoint(index)
         # Retriangulate before deleting point from self.stpoints etc
         self.applyTrglDiff(ops, nps)
+        version_ok = self.slice_cache.isVersion((self.fpoints, self.trgls()))
+        if version_ok:
+            self.invalidateSlicesAroundPoint(index)
+        # the point's trgls have been removed by applyTrglDiff,
+        # so its normal sum is no longer used
+        normals_ok = self.normalsAreCurrent()
+        topology = self.fragment.topology()
         self.fragment.trgls[self.fragment.trgls>index] -= 1
+        topology.pointDeleted(index)
 
         self.fragment.gpoints = np.delete(self.fragment.gpoints, index, 0)
         self.fragment.gtpoints = np.delete(self.fragment.gtpoints, index, 0)
         self.fpoints = np.delete(self.fpoints, index, 0)
+        # renumbering the points doesn't change the cross sections
+        if version_ok:
+            self.slice_cache.setVersion((self.fpoints, self.trgls()))
+        if normals_ok:
+            self.normal_sums = np.delete(self.normal_sums, index, 0)
+            self.normals = np.delete(self.normals, index, 0)
+            self.normals_version = (self.fpoints, self.trgls())
         self.vpoints = np.delete(self.vpoints, index, 0)
         self.vpoints[:,3] = np.arange(len(self.vpoints))
         self.stpoints = np.delete(self.stpoints, index, 0)
@@ -1868,12 +2553,14 @@ class TrglFragmentView(BaseFragmentView):
     def regionByNormals(self, ptind, max_angle):
         pts = self.fpoints
         trgls = self.fragment.trgls
-        neighbors = self.fragment.neighbors
+        # self.fragment.neighbors is not updated when the
+        # trgls are edited; the topology is
+        neighbors = self.fragment.topology().neighbors()
         minz = math.cos(math.radians(max_angle))
         # print("minz", minz)
         normals = BaseFragment.faceNormals(pts, trgls)
         trgl_stack = deque()
-        tap = BaseFragment.trglsAroundPoint(ptind, trgls)
+        tap = self.trglsAroundPoint(ptind)
         zsgn = np.sum(normals[tap,2])
         # print("zsgn", zsgn)
         if zsgn < 0:
@@ -1911,6 +2598,134 @@ class TrglFragmentView(BaseFragmentView):
         return out_trgls
 
 
+'''
+TrglAxisIndex speeds up TrglFragment.findIntersections, which
+is called for every slice window every time the window is
+redrawn.  For each axis, the triangles are sorted by the
+smallest coordinate (along that axis) of their three vertices.
+Since nearly all triangles are small, the only triangles that
+can cross the plane at a given position are the ones whose
+smallest coordinate lies between position-max_extent and 
+position, where max_extent is the largest extent of any 
+triangle along the axis; these are found by a binary search.
+The few triangles that are much larger than the rest (and
+any triangles with NaN coordinates) are kept in a separate 
+list, and are always tested, so that they don't increase
+max_extent.
+The vertex coordinates along each axis are sorted as well,
+so that findIntersections can check quickly whether any
+vertex lies exactly on the plane.
+The per-axis data is created the first time that axis is
+queried.  When a point is moved (in place), the triangles
+that contain it are added to a list of triangles that are 
+always tested, and the per-axis data is recreated only once 
+that list becomes long.
+'''
+class TrglAxisIndex:
+
+    # triangles whose extent is more than this multiple of the
+    # median extent (plus 1 voxel) are always tested
+    long_trgl_factor = 4.
+    # once this fraction of the triangles have been modified,
+    # the per-axis data is recreated
+    max_modified_fraction = .05
+
+    def __init__(self, pts, trgls):
+        self.pts = pts
+        self.trgls = trgls
+        self.clear()
+
+    def clear(self):
+        self.axes = [None, None, None]
+        self.modified_pts = set()
+        self.modified_trgls = set()
+        self.modified_pts_array = np.zeros(0, dtype=np.int64)
+        self.modified_trgls_array = np.zeros(0, dtype=np.int64)
+
+    # Called when point index has been moved (self.pts has
+    # been modified in place).  tindexes, if given, is the
+    # list of trgls around the point.
+    def pointMoved(self, index, tindexes=None):
+        if len(self.trgls) == 0:
+            return
+        self.modified_pts.add(index)
+        if tindexes is None:
+            tindexes = BaseFragment.trglsAroundPoint(index, self.trgls)
+        self.modified_trgls.update(tindexes)
+        if len(self.modified_trgls) > self.max_modified_fraction*len(self.trgls):
+            self.clear()
+            return
+        self.modified_pts_array = np.array(sorted(self.modified_pts), dtype=np.int64)
+        self.modified_trgls_array = np.array(sorted(self.modified_trgls), dtype=np.int64)
+
+    def axisData(self, axis):
+        data = self.axes[axis]
+        if data is not None:
+            return data
+        data = {}
+        coords = self.pts[:,axis].astype(np.float64)
+        order = np.argsort(coords, kind='stable')
+        data["pt_order"] = order
+        data["pt_coords"] = coords[order]
+
+        trgls = self.trgls
+        if len(trgls) == 0:
+            data["order"] = np.zeros(0, dtype=np.int64)
+            data["mins"] = np.zeros(0, dtype=np.float64)
+            data["maxs"] = np.zeros(0, dtype=np.float64)
+            data["long"] = np.zeros(0, dtype=np.int64)
+            data["max_extent"] = 0.
+            self.axes[axis] = data
+            return data
+        tcoords = coords[trgls]
+        mins = tcoords.min(axis=1)
+        maxs = tcoords.max(axis=1)
+        extents = maxs - mins
+        limit = self.long_trgl_factor*np.nanmedian(extents) + 1.
+        # NaN extents are not <= limit, so those trgls are
+        # put in the "long" list
+        normal = extents <= limit
+        data["long"] = np.nonzero(~normal)[0]
+        normal = np.nonzero(normal)[0]
+        order = normal[np.argsort(mins[normal], kind='stable')]
+        data["order"] = order
+        data["mins"] = mins[order]
+        data["maxs"] = maxs[order]
+        max_extent = 0.
+        if len(order) > 0:
+            max_extent = extents[order].max()
+        # allow for rounding
+        data["max_extent"] = max_extent*(1.+1.e-6) + 1.e-6
+        self.axes[axis] = data
+        return data
+
+    # Whether any point lies exactly on the plane; the test
+    # is the same as the one in findIntersections:
+    # pts[:,axis] == position
+    def hasPointOnPlane(self, axis, position):
+        data = self.axisData(axis)
+        # points close to position, including modified points,
+        # whose sorted coordinates may be out of date
+        tol = 1.e-6*(abs(position)+1.)
+        coords = data["pt_coords"]
+        lo = np.searchsorted(coords, position-tol, side='left')
+        hi = np.searchsorted(coords, position+tol, side='right')
+        near = np.concatenate((data["pt_order"][lo:hi], self.modified_pts_array))
+        return bool((self.pts[near,axis] == position).any())
+
+    # Returns the (sorted) indices of the trgls that may 
+    # cross the plane: all the trgls that do cross it are
+    # included, as well as some that don't
+    def candidates(self, axis, position):
+        data = self.axisData(axis)
+        mins = data["mins"]
+        lo = np.searchsorted(mins, position-data["max_extent"], side='left')
+        hi = np.searchsorted(mins, position, side='right')
+        inside = data["maxs"][lo:hi] >= position
+        selected = data["order"][lo:hi][inside]
+        return np.unique(np.concatenate((
+            selected, data["long"], self.modified_trgls_array)))
+
 class TrglPointSet:
 
     # Create a TrglPointSet that contains all stpoints
@@ -2006,20 +2821,31 @@ class TrglPointSet:
         otrgls[mins==2] = np.roll(trgls[mins==2], 1, axis=1)
         return otrgls
 
+    # returns the row in trgls of each trgl in uo, or None
+    # if any of them is not found exactly once
     @staticmethod
-    def replaceTrgls(trgls, uo, un):
+    def trglRows(trgls, uo):
+        orows = []
+        for o in uo:
+            row = (trgls == o).all(axis=1).nonzero()[0]
+            # print("row", row, len(row))
+            if len(row) != 1:
+                print("replaceTrgls unexpected row len", len(row))
+                return None
+            if len(row) == 0:
+                # continue
+                return None
+            orows.append(row[0])
+        return orows
+
+    # orows, if given, is the result of trglRows(trgls, uo)
+    @staticmethod
+    def replaceTrgls(trgls, uo, un, orows=None):
         if len(uo) > 0:
-            orows = []
-            for o in uo:
-                row = (trgls == o).all(axis=1).nonzero()[0]
-                # print("row", row, len(row))
-                if len(row) != 1:
-                    print("replaceTrgls unexpected row len", len(row))
-                    return None
-                if len(row) == 0:
-                    # continue
-                    return None
-                orows.append(row[0])
+            if orows is None:
+                orows = TrglPointSet.trglRows(trgls, uo)
+            if orows is None:
+                return None
             # print("before", len(trgls))
             # print("orows", orows)
             trgls = np.delete(trgls, orows, 0)
@@ -1,8 +1,18 @@
+import os
 import sys
 import time
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 from pathlib import Path
 from scipy import sparse
+from mesh_topology import MeshTopology
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
 
 
 """
@@ -161,7 +171,128 @@ class Timer():
         self.t0 = t
 
 
+'''
+SparseSolver solves the linear systems that UVMapper sets up.
+These are normal equations (A@At in linABF, At@A in the
+LSCM functions), so the matrices are symmetric and positive
+definite.  This allows SuperLU to be run in symmetric mode,
+with a fill-reducing ordering computed on A+At, and with no
+pivoting, which produces much sparser factors, and is several
+times faster, than splu's default (COLAMD ordering, partial
+pivoting).
+
+The matrices that are solved in successive linABF
+iterations, or in successive calls to reparameterize when
+the triangulation has not changed (for instance, when points
+have only been moved), have the same sparsity pattern.
+The fill-reducing ordering is kept, and reused as long as the
+pattern stays the same.  (Scipy's SuperLU interface does not
+allow the rest of the symbolic analysis to be reused.)
+
+In "iterative" mode, the factorization itself is kept as
+well.  When the next matrix has the same pattern, the
+system is solved by the conjugate gradient method, starting
+from the caller's initial guess (or else from the previous
+solution), and preconditioned by the old factorization, which
+is nearly the inverse of the new matrix if the values have
+not changed much.  If cg has not converged after cg_maxiter
+iterations, the matrix is factored again.  Keeping the
+factorization can take a lot of memory (several times the
+size of the matrix), which is why this is not the default.
+(Without the old factorization as a preconditioner, cg does
+poorly on these systems: they are anchored only by two pinned
+points and a small weight on the initial points, and the
+residual becomes small long before the error does.)
+'''
+class SparseSolver:
+
+    # "direct" or "iterative"
+    mode = "direct"
+    cg_rtol = 1.e-10
+    cg_maxiter = 20
+
+    def __init__(self):
+        # identifies the sparsity pattern that self.order
+        # was computed for
+        self.pattern = None
+        # fill-reducing ordering: the factored matrix
+        # is M[order][:,order]
+        self.order = None
+        # in iterative mode, function that applies the
+        # most recent factorization
+        self.inverse = None
+        # previous solution
+        self.x = None
+
+    # class function
+    def patternKey(M):
+        digest = hashlib.blake2b(M.indptr.tobytes())
+        digest.update(M.indices.tobytes())
+        return (M.shape, M.nnz, digest.digest())
+
+    # class function
+    def factor(M, permc_spec):
+        return sparse.linalg.splu(M, permc_spec=permc_spec,
+                diag_pivot_thresh=0., options=dict(SymmetricMode=True))
+
+    # returns a function that solves M@x = b
+    def factorWithOrdering(self, M, key):
+        if key != self.pattern or self.order is None:
+            lu = SparseSolver.factor(M, 'MMD_AT_PLUS_A')
+            self.pattern = key
+            self.order = np.argsort(lu.perm_c)
+            return lu.solve
+        order = self.order
+        lu = SparseSolver.factor(M[order][:,order].tocsc(), 'NATURAL')
+        def inverse(b):
+            x = np.empty_like(b)
+            x[order] = lu.solve(b[order])
+            return x
+        return inverse
+
+    # returns None if cg did not converge
+    def solveIterative(self, M, b, x0):
+        precond = sparse.linalg.LinearOperator(M.shape, matvec=self.inverse)
+        x, info = sparse.linalg.cg(M, b, x0=x0, M=precond,
+                rtol=self.cg_rtol, maxiter=self.cg_maxiter)
+        if info != 0:
+            return None
+        return x
+
+    # Solves M@x = b; x0, if given, is the initial guess
+    # for the iterative mode
+    def solve(self, M, b, x0=None):
+        M = sparse.csc_array(M)
+        M.sum_duplicates()
+        key = SparseSolver.patternKey(M)
+        x = None
+        if self.mode == "iterative" and self.inverse is not None and key == self.pattern:
+            if x0 is None and self.x is not None and len(self.x) == len(b):
+                x0 = self.x
+            x = self.solveIterative(M, b, x0)
+        if x is None:
+            inverse = self.factorWithOrdering(M, key)
+            x = inverse(b)
+            self.inverse = None
+            if self.mode == "iterative":
+                self.inverse = inverse
+        self.x = x
+        return x
+
+
 class UVMapper:
+
+    # The solvers are shared by all UVMappers, so that
+    # the fill-reducing ordering computed by one call to
+    # reparameterize can be reused by the next one (see
+    # SparseSolver).  The key is the name of the function
+    # that uses the solver.
+    solvers = {}
+
+    # class function
+    def solver(name):
+        return UVMapper.solvers.setdefault(name, SparseSolver())
+
     def __init__(self, points, trgls):
         self.points = points
         self.trgls = trgls
@@ -183,6 +314,11 @@ class UVMapper:
         # created by self.createNeighbors()
         self.neighbors = None
 
+        # If set to a MeshTopology whose trgls array is
+        # self.trgls, createNeighbors takes the neighbors
+        # from it, instead of computing them again
+        self.topology = None
+
         # shape (nb, 2) and dtype int64,
         # nb is number of boundary edges,
         # each row has trgl index, edge index
@@ -198,42 +334,11 @@ class UVMapper:
         # ignored if ip_weights is set
         self.ip_weights = None
 
-    # Copied from base_fragment.py in order
-    # to remove dependency
+    # mesh_topology (unlike base_fragment) only depends on
+    # numpy and scipy
     @staticmethod
     def findNeighbors(trgls):
-        index = np.indices((len(trgls),1))[0]
-        ones = np.ones((len(trgls),1), dtype=np.int32)
-        zeros = np.zeros((len(trgls),1), dtype=np.int32)
-        twos = 2*ones
-        
-        e01 = np.concatenate((trgls[:, (0,1)], index, twos, ones), axis=1)
-        e12 = np.concatenate((trgls[:, (1,2)], index, zeros, ones), axis=1)
-        e20 = np.concatenate((trgls[:, (2,0)], index, ones, ones), axis=1)
-        
-        edges = np.concatenate((e01,e12,e20), axis=0)
-        rev = (edges[:,0] > edges[:,1])
-        edges[rev,0:2] = edges[rev,1::-1]
-        edges[rev,4] = -1
-        edges = edges[edges[:,4].argsort()]
-        edges = edges[edges[:,1].argsort(kind='mergesort')]
-        edges = edges[edges[:,0].argsort(kind='mergesort')]
-        
-        ediff = np.diff(edges, axis=0)
-        duprows = np.where(((ediff[:,0]==0) & (ediff[:,1]==0)))[0]
-        duprows2 = np.sort(np.append(duprows, duprows+1))
-        bdup = np.zeros((len(edges)), dtype=np.bool_)
-        bdup[duprows2] = True
-        
-        neighbors = np.full((len(trgls), 3), -1, dtype=np.int32)
-        
-        eplus = edges[duprows+1,:4]
-        eminus = edges[duprows,:4]
-        # print(eplus)
-        # print(eminus)
-        neighbors[eplus[:,2],eplus[:,3]] = eminus[:,2]
-        neighbors[eminus[:,2],eminus[:,3]] = eplus[:,2]
-        return neighbors
+        return MeshTopology.findNeighbors(trgls)
     
 
     def createNeighbors(self):
@@ -241,6 +346,10 @@ class UVMapper:
             print("createNeighbors: no triangles specified!")
             return
         # print("Creating neighbors")
+        topology = self.topology
+        if topology is not None and topology.trgls is self.trgls:
+            self.neighbors = topology.neighbors()
+            return
         self.neighbors = self.findNeighbors(self.trgls)
 
     def createBoundaries(self):
@@ -538,10 +647,8 @@ class UVMapper:
         AAt = Acsc@At
 
         try:
-            lu = sparse.linalg.splu(AAt)
-            timer.time("  created splu")
-            x = At@lu.solve(b)
-            timer.time("  solved splu")
+            x = At@UVMapper.solver("linABF").solve(AAt, b)
+            timer.time("  solved")
         # print("x min max", x.min(), x.max())
         except Exception as e:
             print("SPLU exception:", e)
@@ -550,6 +657,12 @@ class UVMapper:
         flattened_angles = adjusted_angles*(x.reshape(nt, 3) + 1.)
         return flattened_angles
 
+    # Prints, and returns as a dict, the maximum and average
+    # errors of the given angles: the difference from 2 pi of the
+    # sum of the angles around each interior point, the difference
+    # from pi of the sum of the angles of each trgl, and the
+    # wheel error (see maxWheelError).  Returns None if there
+    # are no interior points.
     def angleQuality(self, angles):
         points = self.points
         trgls = self.trgls
@@ -601,6 +714,14 @@ class UVMapper:
               np.abs(trgl_angle_sum).sum()/nt,
               np.abs(wheel_error).sum()/nipt
               )
+        return {
+                "max_point_angle_error": float(np.max(np.abs(pt_angle_sum))),
+                "max_trgl_angle_error": float(np.max(np.abs(trgl_angle_sum))),
+                "max_wheel_error": float(np.max(np.abs(wheel_error))),
+                "avg_point_angle_error": float(np.abs(pt_angle_sum).sum()/nipt),
+                "avg_trgl_angle_error": float(np.abs(trgl_angle_sum).sum()/nt),
+                "avg_wheel_error": float(np.abs(wheel_error).sum()/nipt),
+                }
 
     def maxWheelError(self, angles):
         points = self.points
@@ -885,7 +1006,7 @@ class UVMapper:
             wf_csr = sparse.csr_array((AV, (AI, AJ)), shape=(2*nfp, 2*nfp))
             bw = wf_csr @ self.initial_points[isfree].flatten()
             # print("bw", bw)
-        b = np.concatenate((b, bw))
+            b = np.concatenate((b, bw))
 
         timer.time("  created arrays")
 
@@ -895,9 +1016,11 @@ class UVMapper:
         # print(At@Acsr)
         # print(b)
         # print(At@b)
+        x0 = None
+        if self.initial_points is not None:
+            x0 = self.initial_points[isfree].flatten()
         try:
-            lu = sparse.linalg.splu(At@Acsr)
-            x = lu.solve(At@b)
+            x = UVMapper.solver("computeUvsFromAngles").solve(At@Acsr, At@b, x0)
         except Exception as e:
             print("SPLU exception:", e)
             return None
@@ -1113,10 +1236,12 @@ class UVMapper:
         # print(b)
         # print(A_coo)
         # print(At@Acsr)
+        x0 = None
+        if self.initial_points is not None:
+            x0 = self.initial_points[isfree].transpose().flatten()
         try:
-            lu = sparse.linalg.splu(At@Acsr)
-            # print("splu solved")
-            x = lu.solve(At@b)
+            x = UVMapper.solver("computeUvsFromXyzs").solve(At@Acsr, At@b, x0)
+            # print("solved")
         except Exception as e:
             print("SPLU exception:", e)
             # print(b)
@@ -1130,6 +1255,641 @@ class UVMapper:
         # print("uv", uv)
         return uv
 
+'''
+PartitionedUVMapper computes uv coordinates for meshes that
+are too large for UVMapper: the sparse factorizations in
+linABF and the LSCM functions need memory (and time) that
+grows faster than the number of trgls, so a mesh with tens of
+millions of trgls cannot be flattened in one piece.
+
+The mesh is partitioned into charts of at most chart_trgls trgls
+each (not counting the overlap).  Seed trgls are spread over the
+mesh by recursively bisecting the trgl centroids, and each trgl
+is assigned to the seed that is nearest to it in the trgl
+adjacency graph, so each chart is connected.  Graph distance
+does not always match the centroid bisection, so charts that
+are still too large are split again the same way.  Each chart
+is then extended by overlap_rings rings of trgls into its
+neighbors.
+
+The charts are flattened independently (with ABF followed by
+angle-based LSCM, as in UVMapper.computeUvsFromABF), in a pool
+of worker processes.  Each chart is scaled so that its uv edge
+lengths match its xyz edge lengths, and then the charts are
+stitched together: a similarity transform (rotation, scale,
+translation) is computed for each chart, by a global least
+squares fit that makes the transformed uvs of the points
+shared by overlapping charts agree.  The uvs of the shared
+points are a weighted average of their transformed uvs; the
+weight of a point in a chart falls to zero toward the edges
+where the chart was cut out of the mesh, where the chart's
+flattening is least reliable.
+
+Blending alone can still fold trgls where the charts disagree,
+so finally the bands where charts overlap (plus
+seam_buffer_rings rings) are flattened again, by xyz-based
+LSCM starting from the blended uvs, with the points on the
+edges of the bands pinned (the same technique as
+TrglFragmentView.reparameterizeRegion).  The bands are
+split, in the same way as the mesh, into connected pieces
+of at most seam_piece_trgls trgls, which are relaxed
+independently (in the worker pool); then the places where
+the pieces meet are relaxed.
+
+The charts are not constrained by each other while they are
+being flattened, so the result is not identical to what
+UVMapper would produce for the whole mesh.
+
+Worker processes are started with the "spawn" method (the
+"fork" method is not safe in a program that uses threads, such
+as the Qt GUI), which means that the main module of the program
+must not do any work at import time unless it is run as a script.
+If workers is 1, the charts are flattened in the current process.
+
+computeUvs prints, and stores in self.stage_report, the time
+taken and the peak memory (in Mb) of each stage, and the sizes
+of the pieces that were flattened in the stage.
+'''
+class PartitionedUVMapper:
+
+    # maximum number of trgls per chart, not counting
+    # the overlap
+    chart_trgls = 250000
+    # number of rings of trgls that each chart shares
+    # with its neighbors
+    overlap_rings = 3
+    # number of rings of trgls, beyond the bands where
+    # charts overlap, that are flattened again after
+    # the charts are blended
+    seam_buffer_rings = 2
+    # maximum number of trgls in each of the pieces that
+    # the bands along the seams are split into
+    seam_piece_trgls = 20000
+    # maximum number of times that the neighborhoods of
+    # trgls that are flipped after the seams are relaxed
+    # are relaxed again
+    max_flip_repairs = 3
+    # number of worker processes
+    workers = min(4, os.cpu_count() or 1)
+
+    def __init__(self, points, trgls):
+        self.points = points
+        self.trgls = trgls
+
+        # If set to a MeshTopology whose trgls array is
+        # self.trgls, it is used instead of creating a new one
+        self.topology = None
+
+        # list of (stage name, seconds, peak memory in Mb of
+        # this process, peak memory in Mb of the largest worker
+        # process, dict of sizes); created by computeUvs.  Memory
+        # values are None if not available.  The sizes are the
+        # numbers of trgls flattened in the stage (for instance
+        # "band_trgls" and "largest_piece" for the "seams" stage).
+        self.stage_report = []
+        self.worker_peak_memory = None
+        # worker pool; only exists while computeUvs is running
+        self.executor = None
+        self.point_trgl_counts = None
+
+    # class function
+    # returns the peak memory use (in Mb) of this process,
+    # or None if this is not available.  On Linux, ru_maxrss
+    # of a process that was started by fork and exec includes
+    # the memory of its parent at the time of the fork, so
+    # VmHWM (which is reset by exec) is used instead.
+    def peakMemory():
+        try:
+            with open("/proc/self/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1])/1024.
+        except (OSError, ValueError, IndexError):
+            pass
+        if resource is None:
+            return None
+        # ru_maxrss is in bytes on macOS, in kilobytes elsewhere
+        unit = 1024.
+        if sys.platform == "darwin":
+            unit = 1024.*1024.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/unit
+
+    def reportStage(self, name, t0, sizes=None):
+        t = time.time()
+        mself = PartitionedUVMapper.peakMemory()
+        mworkers = self.worker_peak_memory
+        if sizes is None:
+            sizes = {}
+        self.stage_report.append((name, t-t0, mself, mworkers, sizes))
+        msg = "%s: %.3f sec"%(name, t-t0)
+        if mself is not None:
+            msg += ", peak memory %.0f Mb"%mself
+        if mworkers is not None:
+            msg += ", largest worker %.0f Mb"%mworkers
+        for key, value in sizes.items():
+            msg += ", %s %d"%(key, value)
+        print(msg)
+        return t
+
+    def getTopology(self):
+        if self.topology is None or self.topology.trgls is not self.trgls:
+            self.topology = MeshTopology(self.trgls)
+        return self.topology
+
+    # returns an array with the number of trgls that use
+    # each point
+    def pointTrglCounts(self):
+        if self.point_trgl_counts is None:
+            self.point_trgl_counts = np.bincount(self.trgls.flatten(), minlength=len(self.points))
+        return self.point_trgl_counts
+
+    # Calls function (a class function that returns a tuple
+    # whose last element is the peak memory of the process)
+    # with each set of arguments, in the worker pool if there
+    # is one; returns a list of the results, without the
+    # peak memory
+    def mapInWorkers(self, function, *args):
+        if self.executor is not None and len(args[0]) > 1:
+            results = list(self.executor.map(function, *args))
+            peaks = [result[-1] for result in results if result[-1] is not None]
+            if len(peaks) > 0:
+                self.worker_peak_memory = max(peaks+[self.worker_peak_memory or 0])
+        else:
+            results = [function(*fargs) for fargs in zip(*args)]
+        return [result[:-1] for result in results]
+
+    # class function
+    # splits the rows of centroids into n groups of nearly
+    # equal size, by repeatedly splitting the largest group
+    # at the median of its longest axis; returns a list of
+    # arrays of row indices
+    def bisect(centroids, n):
+        groups = [np.arange(len(centroids))]
+        while len(groups) < n:
+            i = int(np.argmax([len(group) for group in groups]))
+            if len(groups[i]) < 2:
+                break
+            group = groups.pop(i)
+            gcs = centroids[group]
+            axis = np.argmax(gcs.max(axis=0)-gcs.min(axis=0))
+            half = len(group)//2
+            order = np.argpartition(gcs[:,axis], half)
+            groups.append(group[order[:half]])
+            groups.append(group[order[half:]])
+        return groups
+
+    # class function
+    # splits region (an array of trgl indices, connected in
+    # graph) into about len(region)/max_trgls connected
+    # pieces: seeds are placed by bisecting the centroids of
+    # the region's trgls, and each trgl is assigned to the
+    # seed that is the fewest steps away in graph.  Returns
+    # a list of arrays of trgl indices.
+    def splitRegion(graph, centroids, region, max_trgls):
+        npieces = int(np.ceil(len(region)/max_trgls))
+        rcentroids = centroids[region]
+        seeds = []
+        for group in PartitionedUVMapper.bisect(rcentroids, npieces):
+            gcs = rcentroids[group]
+            d = ((gcs-gcs.mean(axis=0))**2).sum(axis=1)
+            seeds.append(group[np.argmin(d)])
+        seeds = np.array(seeds, dtype=np.int64)
+        subgraph = graph[region][:, region]
+        dist, pred, sources = sparse.csgraph.dijkstra(
+                subgraph, directed=False, indices=seeds,
+                unweighted=True, min_only=True, return_predecessors=True)
+        seed_piece = np.full(len(region), -1, dtype=np.int64)
+        seed_piece[seeds] = np.arange(len(seeds))
+        owner = seed_piece[sources]
+        order = np.argsort(owner, kind='stable')
+        counts = np.bincount(owner, minlength=len(seeds))
+        return [region[piece] for piece in np.split(order, np.cumsum(counts)[:-1])]
+
+    # class function
+    # Repeated splitting can leave some small regions; each
+    # region (an array of trgl indices) that has less than
+    # a quarter of max_trgls trgls is merged, smallest first,
+    # into the neighboring region that it shares the most
+    # edges with, if the result has no more than max_trgls
+    # trgls.  Returns the new list of regions.
+    def mergeSmallRegions(graph, regions, max_trgls):
+        nregions = len(regions)
+        labels = np.zeros(graph.shape[0], dtype=np.int64)
+        for i, region in enumerate(regions):
+            labels[region] = i
+        rows, cols = graph.nonzero()
+        shared = sparse.csr_array(
+                (np.ones(len(rows)), (labels[rows], labels[cols])),
+                shape=(nregions, nregions)).toarray()
+        np.fill_diagonal(shared, 0)
+        sizes = np.array([len(region) for region in regions])
+        merged = [[region] for region in regions]
+        for i in np.argsort(sizes, kind='stable'):
+            if sizes[i] == 0 or sizes[i] >= max_trgls/4:
+                continue
+            fits = (shared[i] > 0) & (sizes + sizes[i] <= max_trgls)
+            fits[i] = False
+            if not fits.any():
+                continue
+            j = int(np.argmax(np.where(fits, shared[i], -1)))
+            merged[j].extend(merged[i])
+            merged[i] = []
+            sizes[j] += sizes[i]
+            sizes[i] = 0
+            shared[j] += shared[i]
+            shared[:, j] += shared[:, i]
+            shared[j, j] = 0
+            shared[i] = 0
+            shared[:, i] = 0
+        return [np.sort(np.concatenate(m)) for m in merged if len(m) > 0]
+
+    # class function
+    # splits region (an array of trgl indices) into connected
+    # pieces of at most max_trgls trgls: starts with the
+    # connected components of the region, and splits every
+    # piece that has more than max_trgls trgls until none do
+    # (the graph distances from the seeds can produce pieces
+    # that are much larger than average), then merges small
+    # pieces.  Returns a list of arrays of trgl indices.
+    def splitIntoPieces(graph, centroids, region, max_trgls):
+        if len(region) == graph.shape[0]:
+            # region is the whole mesh
+            subgraph = graph
+        else:
+            subgraph = graph[region][:, region]
+        ncomps, labels = sparse.csgraph.connected_components(subgraph, directed=False)
+        order = np.argsort(labels, kind='stable')
+        counts = np.bincount(labels, minlength=ncomps)
+        pieces = [region[piece] for piece in np.split(order, np.cumsum(counts)[:-1])]
+        result = []
+        while len(pieces) > 0:
+            piece = pieces.pop()
+            if len(piece) <= max_trgls:
+                result.append(piece)
+            else:
+                pieces.extend(PartitionedUVMapper.splitRegion(graph, centroids, piece, max_trgls))
+        return PartitionedUVMapper.mergeSmallRegions(graph, result, max_trgls)
+
+    # returns a list of charts; each chart is a sorted array
+    # of trgl indices
+    def partition(self):
+        trgls = self.trgls
+        topology = self.getTopology()
+        graph = topology.trglGraph()
+        centroids = self.points[trgls].mean(axis=1)
+        cores = PartitionedUVMapper.splitIntoPieces(graph, centroids, np.arange(len(trgls)), self.chart_trgls)
+        charts = []
+        for core in cores:
+            chart = core
+            for j in range(self.overlap_rings):
+                chart = topology.trglsAroundPoints(trgls[chart].flatten())
+            charts.append(chart)
+        return charts
+
+    # class function
+    # flattens a single chart; returns uvs (in the same units
+    # as points), or None if the chart could not be flattened
+    def flattenChart(points, trgls):
+        mapper = UVMapper(points, trgls)
+        pts = mapper.getTwoAdjacentBoundaryPoints()
+        if pts is None:
+            return None
+        pt0, pt1 = pts
+        mapper.constraints = np.array([[pt0, 0., 0.], [pt1, 1., 0.]], dtype=np.float64)
+        uvs = mapper.computeUvsFromABF()
+        if uvs is None:
+            print("ABF failed; using xyz-based LSCM instead")
+            uvs = mapper.computeUvsFromXyzs()
+        if uvs is None:
+            return None
+        ea = trgls.flatten()
+        eb = trgls[:, (1,2,0)].flatten()
+        lxyz = np.sqrt(((points[eb]-points[ea])**2).sum(axis=1)).sum()
+        luv = np.sqrt(((uvs[eb]-uvs[ea])**2).sum(axis=1)).sum()
+        if luv > 0:
+            uvs *= lxyz/luv
+        return uvs
+
+    # class function
+    # flattenChart, run in a worker process; also returns
+    # the peak memory of the worker
+    def flattenChartInWorker(points, trgls):
+        uvs = PartitionedUVMapper.flattenChart(points, trgls)
+        return uvs, PartitionedUVMapper.peakMemory()
+
+    # class function
+    # converts a chart (an array of trgl indices) to a local
+    # points array and a local trgls array; also returns
+    # the global indices of the local points
+    def chartMesh(points, trgls, chart):
+        ctrgls = trgls[chart]
+        cpts = np.unique(ctrgls)
+        ltrgls = np.searchsorted(cpts, ctrgls)
+        return points[cpts], ltrgls, cpts
+
+    # returns a list, with one entry per chart: the global
+    # indices of the chart's points, and their uvs
+    # (or None if the chart could not be flattened)
+    def flattenCharts(self, charts):
+        meshes = [PartitionedUVMapper.chartMesh(self.points, self.trgls, chart) for chart in charts]
+        cpoints = [mesh[0] for mesh in meshes]
+        ctrgls = [mesh[1] for mesh in meshes]
+        results = self.mapInWorkers(PartitionedUVMapper.flattenChartInWorker, cpoints, ctrgls)
+        return [(mesh[2], result[0]) for mesh, result in zip(meshes, results)]
+
+    # Returns the blending weight of each point of the chart
+    # (cpts are the chart's points, as returned by chartMesh).
+    # The weight is 0 on the edges where the chart was cut
+    # out of the mesh, and increases linearly with the number
+    # of steps from these edges, up to 1 at 2*overlap_rings
+    # steps (the width of the band that the chart shares with
+    # its neighbors).
+    def chartWeights(self, chart, cpts):
+        trgls = self.trgls
+        neighbors = self.getTopology().neighbors()
+        in_chart = np.zeros(len(trgls), dtype=np.bool_)
+        in_chart[chart] = True
+        cnbrs = neighbors[chart]
+        # edge s of a trgl is opposite vertex s
+        cut = (cnbrs >= 0) & ~in_chart[np.maximum(cnbrs, 0)]
+        ctrgls = trgls[chart]
+        cut_pts = np.concatenate((ctrgls[:, (1,2,0)][cut], ctrgls[:, (2,0,1)][cut]))
+        if len(cut_pts) == 0:
+            return np.ones(len(cpts), dtype=np.float64)
+        ltrgls = np.searchsorted(cpts, ctrgls)
+        ea = ltrgls.flatten()
+        eb = ltrgls[:, (1,2,0)].flatten()
+        vgraph = sparse.csr_array((np.ones(len(ea)), (ea, eb)), shape=(len(cpts), len(cpts)))
+        steps = sparse.csgraph.dijkstra(
+                vgraph, directed=False, indices=np.unique(np.searchsorted(cpts, cut_pts)),
+                unweighted=True, min_only=True)
+        width = 2*max(self.overlap_rings, 1)
+        return np.minimum(steps, width)/width
+
+    # class function
+    # flattened is the output of flattenCharts, weights are
+    # the chartWeights of the charts; returns an array of
+    # shape (ncharts, 4); each row (a, b, tx, ty) is a
+    # similarity transform that maps the chart's u, v to
+    # a*u - b*v + tx, b*u + a*v + ty
+    def alignCharts(flattened, weights):
+        ncharts = len(flattened)
+        gpts = np.concatenate([f[0] for f in flattened])
+        uvs = np.concatenate([f[1] for f in flattened])
+        ws = np.concatenate(weights)
+        cids = np.concatenate([np.full(len(f[0]), i, dtype=np.int64) for i, f in enumerate(flattened)])
+        # sort by point, and for each point, by decreasing weight
+        order = np.lexsort((-ws, gpts))
+        gpts = gpts[order]
+        # each copy of a shared point is paired with the
+        # copy that has the largest weight; the pair's equations
+        # are weighted by the smaller weight, so that points
+        # near the cut edges of a chart are ignored
+        is_first = np.ones(len(gpts), dtype=np.bool_)
+        is_first[1:] = gpts[1:] != gpts[:-1]
+        first = order[np.nonzero(is_first)[0][np.cumsum(is_first)-1]]
+        second = order[~is_first]
+        first = first[~is_first]
+        pw = ws[second]
+        keep = pw > 0
+        first = first[keep]
+        second = second[keep]
+        pw = pw[keep]
+        ca = cids[first]
+        cb = cids[second]
+        ua, va = uvs[first].T
+        ub, vb = uvs[second].T
+        npairs = len(first)
+        # for each pair, one row for the u equation and one
+        # for the v equation; unknowns are (a, b, tx, ty)
+        # of each chart
+        rows = np.repeat(np.arange(2*npairs), 6)
+        ones = np.ones(npairs)
+        ucols = np.stack((4*ca, 4*ca+1, 4*ca+2, 4*cb, 4*cb+1, 4*cb+2), axis=1)
+        uvals = np.stack((ua, -va, ones, -ub, vb, -ones), axis=1)*pw[:,np.newaxis]
+        vcols = np.stack((4*ca, 4*ca+1, 4*ca+3, 4*cb, 4*cb+1, 4*cb+3), axis=1)
+        vvals = np.stack((va, ua, ones, -vb, -ub, -ones), axis=1)*pw[:,np.newaxis]
+        cols = np.stack((ucols, vcols), axis=1).flatten()
+        vals = np.stack((uvals, vvals), axis=1).flatten()
+        # charts that are not connected to each other by
+        # shared points form separate groups; in each
+        # group, one chart keeps its original uvs
+        cgraph = sparse.csr_array((ones, (ca, cb)), shape=(ncharts, ncharts))
+        ngroups, labels = sparse.csgraph.connected_components(cgraph, directed=False)
+        gauge = np.unique(labels, return_index=True)[1]
+        grows = 2*npairs + np.arange(4*len(gauge))
+        gcols = (4*gauge[:,np.newaxis] + np.arange(4)).flatten()
+        rows = np.concatenate((rows, grows))
+        cols = np.concatenate((cols, gcols))
+        vals = np.concatenate((vals, np.ones(len(gcols))))
+        b = np.zeros(2*npairs + len(gcols))
+        b[2*npairs::4] = 1.
+        A = sparse.csr_array((vals, (rows, cols)), shape=(len(b), 4*ncharts))
+        At = A.transpose()
+        x = sparse.linalg.spsolve((At@A).tocsc(), At@b)
+        return x.reshape(ncharts, 4)
+
+    # class function
+    # returns a bool array, True for each trgl that has
+    # a negative area in uv space
+    def flippedTrgls(uvs, trgls):
+        d1 = uvs[trgls[:,1]]-uvs[trgls[:,0]]
+        d2 = uvs[trgls[:,2]]-uvs[trgls[:,0]]
+        return (d1[:,0]*d2[:,1]-d1[:,1]*d2[:,0]) < 0
+
+    # Extends the trgls in in_region (a bool array) by nrings
+    # rings of trgls; returns a new bool array
+    def growRegion(self, in_region, nrings):
+        trgls = self.trgls
+        for i in range(nrings):
+            used = np.zeros(len(self.points), dtype=np.bool_)
+            used[trgls[in_region]] = True
+            in_region = used[trgls].any(axis=1)
+        return in_region
+
+    # Returns the global indices of the points of region (an
+    # array of trgl indices), and the arguments of relaxMesh
+    # that flatten the region starting from the given uvs, with
+    # the points that are shared with the rest of the mesh
+    # pinned to their current uvs; returns None if there is
+    # nothing to flatten
+    def regionMesh(self, uvs, region):
+        if len(region) == 0 or len(region) == len(self.trgls):
+            return None
+        rtrgls = self.trgls[region]
+        rpts, ltrgls, counts = np.unique(rtrgls.flatten(), return_inverse=True, return_counts=True)
+        ltrgls = ltrgls.reshape(rtrgls.shape)
+        pinned = np.nonzero(counts < self.pointTrglCounts()[rpts])[0]
+        if len(pinned) < 2:
+            return None
+        return rpts, (self.points[rpts], ltrgls, pinned, uvs[rpts[pinned]], uvs[rpts])
+
+    # class function
+    # flattens a mesh by xyz-based LSCM, starting from
+    # initial_uvs, with the pinned points (an array of point
+    # indices) fixed at pinned_uvs (as in
+    # TrglFragmentView.reparameterizeRegion); returns the uvs,
+    # or None if the mesh could not be flattened
+    def relaxMesh(points, trgls, pinned, pinned_uvs, initial_uvs):
+        mapper = UVMapper(points, trgls)
+        constraints = np.zeros((len(pinned), 3), dtype=np.float64)
+        constraints[:, 0] = pinned
+        constraints[:, (1,2)] = pinned_uvs
+        mapper.constraints = constraints
+        mapper.initial_points = initial_uvs
+        return mapper.computeUvsFromXyzs()
+
+    # class function
+    # relaxMesh, run in a worker process; also returns
+    # the peak memory of the worker
+    def relaxMeshInWorker(points, trgls, pinned, pinned_uvs, initial_uvs):
+        uvs = PartitionedUVMapper.relaxMesh(points, trgls, pinned, pinned_uvs, initial_uvs)
+        return uvs, PartitionedUVMapper.peakMemory()
+
+    # Relaxes each of regions (a list of arrays of trgl
+    # indices) with relaxMesh, in the worker pool if there is
+    # one.  The regions must not share any points other than
+    # the pinned ones, so that they can be relaxed
+    # independently.  Modifies uvs in place; returns False if
+    # a region could not be flattened.
+    def relaxRegions(self, uvs, regions):
+        meshes = [self.regionMesh(uvs, region) for region in regions]
+        meshes = [mesh for mesh in meshes if mesh is not None]
+        if len(meshes) == 0:
+            return True
+        args = list(zip(*[mesh[1] for mesh in meshes]))
+        results = self.mapInWorkers(PartitionedUVMapper.relaxMeshInWorker, *args)
+        for (rpts, margs), (ruvs,) in zip(meshes, results):
+            if ruvs is None:
+                return False
+            uvs[rpts] = ruvs
+        return True
+
+    # Extends the trgls in in_region (a bool array) by nrings
+    # rings of trgls, and relaxes the result in one piece
+    # (see relaxMesh).  Modifies uvs in place; returns False if
+    # the region could not be flattened.
+    def relaxRegion(self, uvs, in_region, nrings):
+        in_region = self.growRegion(in_region, nrings)
+        return self.relaxRegions(uvs, [np.nonzero(in_region)[0]])
+
+    # Recomputes the uvs in the bands where charts overlap
+    # (shared is a bool array, True for points that are in
+    # more than one chart), extended by seam_buffer_rings.
+    # The bands are split into pieces of at most
+    # seam_piece_trgls trgls, which are relaxed independently;
+    # the points where two pieces meet stay at their blended
+    # uvs, so the neighborhoods of these points are relaxed
+    # next.  LSCM with pinned points can itself fold a few
+    # (skinny) trgls, so the neighborhoods of any flipped trgls
+    # are then relaxed again, in larger neighborhoods each time.
+    # Modifies uvs in place; returns the sizes to report, or
+    # None if a region could not be flattened.
+    def relaxSeams(self, uvs, shared):
+        trgls = self.trgls
+        in_band = self.growRegion(shared[trgls].any(axis=1), self.seam_buffer_rings)
+        band = np.nonzero(in_band)[0]
+        sizes = {"band_trgls": len(band), "largest_piece": 0}
+        if len(band) == 0:
+            return sizes
+        graph = self.getTopology().trglGraph()
+        centroids = self.points[trgls[band]].mean(axis=1)
+        bcentroids = np.zeros((len(trgls), 3), dtype=np.float64)
+        bcentroids[band] = centroids
+        pieces = PartitionedUVMapper.splitIntoPieces(graph, bcentroids, band, self.seam_piece_trgls)
+        sizes["largest_piece"] = max(map(len, pieces))
+        print("relaxing %d trgls along the seams, in %d pieces of up to %d trgls"%(len(band), len(pieces), sizes["largest_piece"]))
+        if not self.relaxRegions(uvs, pieces):
+            return None
+        if len(pieces) > 1:
+            label = np.full(len(trgls), -1, dtype=np.int64)
+            for i, piece in enumerate(pieces):
+                label[piece] = i
+            npt = len(self.points)
+            lmin = np.full(npt, len(pieces), dtype=np.int64)
+            lmax = np.full(npt, -1, dtype=np.int64)
+            btrgls = trgls[band].flatten()
+            blabels = np.repeat(label[band], 3)
+            np.minimum.at(lmin, btrgls, blabels)
+            np.maximum.at(lmax, btrgls, blabels)
+            joins = (lmax >= 0) & (lmin != lmax)
+            in_joins = joins[trgls].any(axis=1)
+            print("relaxing around %d points where pieces meet"%joins.sum())
+            if not self.relaxRegion(uvs, in_joins, self.seam_buffer_rings):
+                return None
+        for i in range(self.max_flip_repairs):
+            flipped = PartitionedUVMapper.flippedTrgls(uvs, trgls)
+            if not flipped.any():
+                break
+            print("relaxing around %d flipped trgls"%flipped.sum())
+            if not self.relaxRegion(uvs, flipped, self.seam_buffer_rings*(i+2)):
+                return None
+        return sizes
+
+    # returns an array of uvs, of shape (npts, 2); points
+    # that are not in any trgl are set to 0.  Returns None
+    # on failure.
+    def computeUvs(self):
+        if self.trgls is None or len(self.trgls) == 0:
+            print("No triangles")
+            return None
+        if self.workers <= 1:
+            return self.computeStages()
+        # the worker processes are only started when there
+        # is more than one piece to flatten
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=context) as executor:
+            self.executor = executor
+            try:
+                return self.computeStages()
+            finally:
+                self.executor = None
+
+    # computeUvs, once the worker pool (if any) exists
+    def computeStages(self):
+        points = self.points
+        trgls = self.trgls
+        self.stage_report = []
+        self.worker_peak_memory = None
+        self.point_trgl_counts = None
+        t0 = time.time()
+        tstart = t0
+        charts = self.partition()
+        print("%d trgls in %d charts, %d to %d trgls per chart"%(len(trgls), len(charts), min(map(len, charts)), max(map(len, charts))))
+        t0 = self.reportStage("partition", t0)
+        flattened = self.flattenCharts(charts)
+        for i, (gpts, uvs) in enumerate(flattened):
+            if uvs is None:
+                print("Could not flatten chart", i)
+                return None
+        t0 = self.reportStage("flatten", t0, {"charts": len(charts), "largest_chart": max(map(len, charts))})
+        weights = [self.chartWeights(chart, gpts) for chart, (gpts, uvs) in zip(charts, flattened)]
+        transforms = PartitionedUVMapper.alignCharts(flattened, weights)
+        t0 = self.reportStage("align", t0)
+        usum = np.zeros((len(points), 2), dtype=np.float64)
+        wsum = np.zeros(len(points), dtype=np.float64)
+        count = np.zeros(len(points), dtype=np.int64)
+        for (gpts, uvs), w, (a, b, tx, ty) in zip(flattened, weights, transforms):
+            u, v = uvs.T
+            # points with zero total weight (which can only
+            # happen if some chart is narrower than the overlap)
+            # are averaged
+            w = w + 1.e-6
+            usum[gpts, 0] += w*(a*u - b*v + tx)
+            usum[gpts, 1] += w*(b*u + a*v + ty)
+            wsum[gpts] += w
+            count[gpts] += 1
+        used = wsum > 0
+        usum[used] /= wsum[used, np.newaxis]
+        t0 = self.reportStage("blend", t0)
+        sizes = self.relaxSeams(usum, count > 1)
+        if sizes is None:
+            print("Could not relax the seams")
+            return None
+        t0 = self.reportStage("seams", t0, sizes)
+        self.reportStage("total", tstart)
+        return usum
+
 if __name__ == '__main__':
     from trgl_fragment import TrglFragment
     points = None
@@ -1137,6 +1897,15 @@ if __name__ == '__main__':
     tpoints = None
     timer = Timer()
     out_file = "test_out.obj"
+    # if chart_trgls is given (third argument), the mesh
+    # is flattened by PartitionedUVMapper, using the given
+    # number of workers (fourth argument) if any
+    chart_trgls = None
+    if len(sys.argv) > 3:
+        chart_trgls = int(sys.argv[3])
+        PartitionedUVMapper.chart_trgls = chart_trgls
+    if len(sys.argv) > 4:
+        PartitionedUVMapper.workers = int(sys.argv[4])
     if len(sys.argv) > 1:
         obj_file = sys.argv[1]
         trgl_frags = TrglFragment.load(obj_file)
@@ -1157,35 +1926,42 @@ if __name__ == '__main__':
         exit()
     # print(points.shape, points.dtype, trgls.shape, trgls.dtype)
     timer.time("read")
-    lscm = UVMapper(points, trgls)
-    pt0, pt1 = lscm.getTwoAdjacentBoundaryPoints(0)
-    # print("pt0, pt1", pt0, pt1)
-    # pt2, pt3 = lscm.getTwoAdjacentBoundaryPoints(-1)
-    # print("pt2, pt3", pt2, pt3)
-    # ptmn, ptmx = lscm.getTwoAdjacentBoundaryPoints()
-    # print("ptmn, ptmx", ptmn, ptmx)
-    lscm.constraints = np.array([[pt0, 0., 0.], [pt1, 1., 0.]], dtype=np.float64)
-    '''
-    lscm.constraints = np.array(
-            [
-            [1., 600., 1500.],
-            [2., 500., 1600.],
-            [3., 400., 1500.],
-            [4., 500., 1400.],
-            ], dtype=np.float64)
-    '''
-    if tpoints is not None:
-        lscm.initial_points = tpoints
-        weight = .000001
-        # weight = 0.
-        # lscm.ip_weight = weight
-        weights = np.full(tpoints.shape[0], weight, dtype=np.float64)
-        # weights[0] = 0.
-        lscm.ip_weights = weights
-    # uvs = lscm.computeUvs()
-    # uvs = lscm.computeUvsFromAngles()
-    # uvs = lscm.computeUvsFromXyzs()
-    uvs = lscm.computeUvsFromABF()
+    if chart_trgls is not None:
+        lscm = PartitionedUVMapper(points, trgls)
+        uvs = lscm.computeUvs()
+        if uvs is None:
+            print("couldn't compute uvs")
+            exit()
+    else:
+        lscm = UVMapper(points, trgls)
+        pt0, pt1 = lscm.getTwoAdjacentBoundaryPoints(0)
+        # print("pt0, pt1", pt0, pt1)
+        # pt2, pt3 = lscm.getTwoAdjacentBoundaryPoints(-1)
+        # print("pt2, pt3", pt2, pt3)
+        # ptmn, ptmx = lscm.getTwoAdjacentBoundaryPoints()
+        # print("ptmn, ptmx", ptmn, ptmx)
+        lscm.constraints = np.array([[pt0, 0., 0.], [pt1, 1., 0.]], dtype=np.float64)
+        '''
+        lscm.constraints = np.array(
+                [
+                [1., 600., 1500.],
+                [2., 500., 1600.],
+                [3., 400., 1500.],
+                [4., 500., 1400.],
+                ], dtype=np.float64)
+        '''
+        if tpoints is not None:
+            lscm.initial_points = tpoints
+            weight = .000001
+            # weight = 0.
+            # lscm.ip_weight = weight
+            weights = np.full(tpoints.shape[0], weight, dtype=np.float64)
+            # weights[0] = 0.
+            lscm.ip_weights = weights
+        # uvs = lscm.computeUvs()
+        # uvs = lscm.computeUvsFromAngles()
+        # uvs = lscm.computeUvsFromXyzs()
+        uvs = lscm.computeUvsFromABF()
     timer.time("computed uvs")
     # lscm.angleQuality(lscm.angles)
     uvmin = uvs.min(axis=0)
@@ -1,4 +1,5 @@
 import pathlib
+import os
 import numpy as np
 from utils import Utils
 from PyQt5 import QtCore, QtGui, QtWidgets
@@ -7,6 +8,7 @@ import cv2
 import nrrd
 import nrrd.writer
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 # The nrrd writer provided by the pynrrd package duplicates
 # the data in memory before writing.  This is undesirable
@@ -21,9 +23,15 @@ nrrd_write_data_original = nrrd.writer._write_data
 # def _write_data(data: npt.NDArray, fh: IO, header: NRRDHeader, compression_level: Optional[int] = None,
 
 # overriding function
+# A zero-stride placeholder array (all of its strides are 0) 
+# stands for data that the caller writes itself, after
+# the header (see Volume.createFromTiffs); nothing is written
+# for it.
 def nrrd_write_data_override(data, fh, header, compression_level=None, index_order='F'):
     print("nrrd_write_data_override", header['encoding'], index_order)
-    if header['encoding'] == 'raw' and index_order == 'C':
+    if header['encoding'] == 'raw' and index_order == 'C' and data.size > 1 and not any(data.strides):
+        print("nrrd_write_data_override: header only")
+    elif header['encoding'] == 'raw' and index_order == 'C':
         print("nrrd_write_data_override: doing direct write")
         # write without duplicating data
         data.tofile(fh)
@@ -1023,6 +1031,9 @@ class VolumeView():
     def getSliceInRange(self, data, islice, jslice, k, axis):
         return self.volume.getSliceInRange(data, islice, jslice, k, axis)
 
+    def getSliceInRangeWithMisses(self, data, islice, jslice, k, axis):
+        return self.volume.getSliceInRangeWithMisses(data, islice, jslice, k, axis)
+
     def paintSlice(self, out, axis, ijkt, zoom, zarr_max_width):
         return self.volume.paintSlice(out, axis, ijkt, zoom, zarr_max_width, self.direction)
 
@@ -1056,8 +1067,60 @@ class TransposedDataView():
         result = self.data[selection]
         return result
 
+'''
+Reads a single TIFF image, and returns the part of it
+that is selected by xrange and yrange (each of these is
+[start, end, step], with end inclusive), as uint16.
+Called from the reader threads in Volume.createFromTiffs.
+'''
+class TiffSliceReader():
+    def __init__(self, tdir, xrange, yrange):
+        self.tdir = tdir
+        self.xrange = xrange
+        self.yrange = yrange
+        # set if any image was 8 bit (and thus multiplied by 256)
+        self.converted_uint8 = False
+
+    # returns (array, err); array is None if err is not ""
+    def read(self, fname):
+        xrange = self.xrange
+        yrange = self.yrange
+        imgf = self.tdir / fname
+        iarr = None
+        try:
+            # note that imread doesn't throw an exception
+            # when it cannot find the file, it simply returns
+            # None
+            iarr = cv2.imread(str(imgf), cv2.IMREAD_UNCHANGED)
+        except cv2.error as e:
+            return None, "could not read file %s: %s"%(imgf, str(e))
+        if iarr is None:
+            return None, "failed to read file %s"%(imgf)
+        if xrange[1]+1 > iarr.shape[1]:
+            return None, "max requested x value %d is outside x range %d of image %s"%(xrange[1],iarr.shape[1]-1, fname)
+        if yrange[1]+1 > iarr.shape[0]:
+            return None, "requested y range %d to %d is outside y range %d of image %s"%(yrange[1], iarr.shape[0]-1, fname)
+        # crop before converting, so that only the 
+        # selected pixels are converted and copied
+        iarr = iarr[yrange[0]:yrange[1]+1:yrange[2], 
+                xrange[0]:xrange[1]+1:xrange[2]]
+        if iarr.dtype == np.uint8:
+            self.converted_uint8 = True
+            oarr = iarr.astype(np.uint16)
+            oarr *= 256
+        else:
+            oarr = np.ascontiguousarray(iarr, dtype=np.uint16)
+        return oarr, ""
+
 class Volume():
 
+    # number of threads used by createFromTiffs to read 
+    # TIFF files
+    tiff_reader_threads = min(8, os.cpu_count() or 1)
+    # approximate size of the slabs that createFromTiffs 
+    # gathers before writing, in the vc_render case
+    tiff_slab_bytes = 256*2**20
+
     def __init__(self):
         self.data = None
         self.trdatas = None
@@ -1201,7 +1264,7 @@ class Volume():
             print(err)
             return Volume.createErrorVolume(err)
         try:
-            open(ofilefull, 'wb')
+            open(ofilefull, 'wb').close()
         except Exception as e:
             err = "cannot write to file %s: %s"%(ofilefull, str(e))
             print(err)
@@ -1211,73 +1274,30 @@ class Volume():
         ysize = Volume.sliceSize(yrange[0], yrange[1]+1, yrange[2])
         zsize = Volume.sliceSize(zrange[0], zrange[1]+1, zrange[2])
         gb = 1.*xsize*ysize*zsize*2/1000000000
-        print("allocating numpy cube, size %.3f Gb"%gb)
-        if callback is not None and not callback("Allocating %.1f Gb of memory"%gb):
-            ofilefull.unlink(True)
-            return Volume.createErrorVolume("Cancelled by user")
-        ocube = np.zeros((zsize, ysize, xsize), dtype=np.uint16)
-        first_print = True
-        for i,z in enumerate(range(zrange[0], zrange[1]+1, zrange[2])):
+
+        # Make the list of files to read before creating anything,
+        # so that a missing file is detected right away
+        fnames = []
+        for z in range(zrange[0], zrange[1]+1, zrange[2]):
             if pattern == "":
                 if z not in filenamedict:
                     err = "file for image %d is missing"%z
                     print(err)
                     ofilefull.unlink(True)
                     return Volume.createErrorVolume(err)
-                fname = filenamedict[z]
+                fnames.append(filenamedict[z])
             else:
-                fname = pattern%z
-            imgf = tdir / fname
-            # print(fname, imgf)
-            if callback is not None and not callback("Reading %s"%fname):
-                ofilefull.unlink(True)
-                return Volume.createErrorVolume("Cancelled by user")
-            iarr = None
-            try:
-                # note that imread doesn't throw an exception
-                # when it cannot find the file, it simply returns
-                # None
-                iarr = cv2.imread(str(imgf), cv2.IMREAD_UNCHANGED)
-            except cv2.error as e:
-                err = "could not read file %s: %s"%(imgf, str(e))
-                print(err)
-                ofilefull.unlink(True)
-                return Volume.createErrorVolume(err)
-            if iarr is None:
-                err = "failed to read file %s"%(imgf)
-                print(err)
-                ofilefull.unlink(True)
-                return Volume.createErrorVolume(err)
+                fnames.append(pattern%z)
 
-            if xrange[1]+1 > iarr.shape[1]:
-                err = "max requested x value %d is outside x range %d of image %s"%(xrange[1],iarr.shape[1]-1, fname)
-                print(err)
-                ofilefull.unlink(True)
-                return Volume.createErrorVolume(err)
-            if yrange[1]+1 > iarr.shape[0]:
-                err = "requested y range %d to %d is outside y range %d of image %s"%(yrange[1], iarr.shape[0]-1, fname)
-                ofilefull.unlink(True)
-                return Volume.createErrorVolume(err)
-            if iarr.dtype == np.uint8:
-                if first_print:
-                   print("tiff file is unsigned 8 bit, multiplying by 256")
-                   first_print = False
-                iarr = iarr.astype(np.uint16)
-                iarr *= 256
-            ocube[i] = np.copy(
-                    iarr[yrange[0]:yrange[1]+1:yrange[2], 
-                        xrange[0]:xrange[1]+1:xrange[2]])
-
-        print("\nbeginning stack")
-        if callback is not None and not callback("Stacking images"):
-            ofilefull.unlink(True)
-            return Volume.createErrorVolume("Cancelled by user")
         timestamp = Utils.timestamp()
         range0 = [xrange[0], yrange[0], zrange[0]]
         drange = [xrange[2], yrange[2], zrange[2]]
+        # shape of the data in the output file
+        oshape = (zsize, ysize, xsize)
         if axes is not None:
             range0 = (range0[0], range0[2], range0[1])
             drange = (drange[0], drange[2], drange[1])
+            oshape = (oshape[1], oshape[0], oshape[2])
         header = {
                 "khartes_xyz_starts": "%d %d %d"%(range0[0], range0[1], range0[2]),
                 "khartes_xyz_steps": "%d %d %d"%(drange[0], drange[1], drange[2]),
@@ -1291,35 +1311,135 @@ class Volume():
                 # the I/O speed)
                 "encoding": "raw",
                 }
-        print("beginning transpose")
-        if callback is not None and not callback("Beginning transpose"):
+
+        # Rather than assembling the whole volume in memory and
+        # then writing it, the NRRD header is written first, the
+        # file is extended to its full size, and then each image
+        # is written into its place in the file as soon as it
+        # has been read.  The images are decoded by a pool of
+        # threads (cv2.imread releases the GIL).
+        print("creating %s, size %.3f Gb"%(ofilefull, gb))
+        if callback is not None and not callback("Creating %.1f Gb file"%gb):
             ofilefull.unlink(True)
             return Volume.createErrorVolume("Cancelled by user")
+        ofile = None
+        try:
+            ofile = open(ofilefull, 'wb')
+            # The header only depends on the shape and type of
+            # the data, so a zero-stride placeholder array
+            # is enough to create it; nrrd_write_data_override
+            # doesn't write the placeholder's data
+            placeholder = np.broadcast_to(np.zeros(1, dtype=np.uint16), oshape)
+            nrrd.write(ofile, placeholder, header, index_order='C')
+            data_offset = ofile.tell()
+            ofile.truncate(data_offset + 2*xsize*ysize*zsize)
+        except Exception as e:
+            err = "cannot write to file %s: %s"%(ofilefull, str(e))
+            print(err)
+            if ofile is not None:
+                ofile.close()
+            ofilefull.unlink(True)
+            return Volume.createErrorVolume(err)
+
+        reader = TiffSliceReader(tdir, xrange, yrange)
+        # In the vc_render case, each image is a (y,x) slice of
+        # an output volume with shape (y,z,x), so a single image
+        # is scattered over ysize separate rows of the file.  
+        # To keep the writes reasonably large, consecutive images 
+        # are gathered into a slab of shape (y, nz, x), and
+        # each row of the slab is written as one contiguous block.
+        slab = None
+        slab_start = 0
+        slab_count = 0
         if axes is not None:
-            # the copy() uses more memory, but makes the write
-            # much faster, because it reorders the array.  
-            # Note that this is called only
-            # for transposed data (data generated by vc_layers)
-            ocube = np.transpose(ocube, axes=axes).copy()
-        print("beginning write to %s"%ofilefull)
-        if callback is not None and not callback("Beginning write to %s"%ofilefull):
-            return Volume.createErrorVolume("Cancelled by user")
-        nrrd.write(str(ofilefull), ocube, header, index_order='C')
-        # nrrd.write(str(ofilefull), tocube, header)
-        print("file %s saved"%ofilefull)
-        callback("Loading volume from %s"%ofilefull)
+            slab_z = Volume.tiff_slab_bytes // (2*xsize*ysize)
+            slab_z = max(1, min(zsize, slab_z))
+            slab = np.zeros((ysize, slab_z, xsize), dtype=np.uint16)
+
+        err = ""
+        nthreads = max(1, Volume.tiff_reader_threads)
+        executor = ThreadPoolExecutor(max_workers=nthreads)
+        futures = {}
+        next_submit = 0
+        t0 = time.time()
+        try:
+            for i in range(zsize):
+                # keep a limited number of images in flight, so 
+                # that memory use doesn't depend on the number 
+                # of images
+                while next_submit < zsize and next_submit < i + 2*nthreads:
+                    futures[next_submit] = executor.submit(
+                            reader.read, fnames[next_submit])
+                    next_submit += 1
+                fname = fnames[i]
+                iarr, err = futures.pop(i).result()
+                if err != "":
+                    break
+                if axes is None:
+                    ofile.seek(data_offset + 2*i*xsize*ysize)
+                    ofile.write(iarr.data)
+                else:
+                    slab[:, slab_count, :] = iarr
+                    slab_count += 1
+                    if slab_count == slab.shape[1] or i == zsize-1:
+                        Volume.writeTiffSlab(ofile, data_offset, oshape, slab[:, :slab_count, :], slab_start)
+                        slab_start += slab_count
+                        slab_count = 0
+                del iarr
+                mb = 2.*(i+1)*xsize*ysize/1000000
+                dt = max(time.time()-t0, .001)
+                msg = "Read %s (%d of %d, %.1f Mb/s)"%(fname, i+1, zsize, mb/dt)
+                if callback is not None and not callback(msg):
+                    err = "Cancelled by user"
+                    break
+        except Exception as e:
+            err = "error while writing file %s: %s"%(ofilefull, str(e))
+        finally:
+            for future in futures.values():
+                future.cancel()
+            executor.shutdown(wait=True)
+            ofile.close()
+        if err != "":
+            print(err)
+            ofilefull.unlink(True)
+            return Volume.createErrorVolume(err)
+        if reader.converted_uint8:
+            print("tiff file is unsigned 8 bit, multiplied by 256")
+
+        dt = max(time.time()-t0, .001)
+        print("file %s saved (%.1f Gb in %.1f seconds)"%(ofilefull, gb, dt))
+        if callback is not None:
+            callback("Loading volume from %s"%ofilefull)
         volume = Volume.loadNRRD(ofilefull)
         project.addVolume(volume)
         
         return volume
 
+    # class function
+    # Writes slab, which has shape (ysize, nz, xsize), into
+    # an (uncompressed, C-ordered) data file with shape 
+    # oshape = (ysize, zsize, xsize), starting at z = z0.
+    # Each row slab[y] is contiguous in the file.
+    def writeTiffSlab(ofile, data_offset, oshape, slab, z0):
+        ysize, zsize, xsize = oshape
+        # the rows are written in increasing file order
+        for y in range(ysize):
+            ofile.seek(data_offset + 2*(y*zsize + z0)*xsize)
+            ofile.write(np.ascontiguousarray(slab[y]).data)
+
     def loadData(self, project_view):
         if self.data is not None:
             return
         print("reading data from",self.path,"for",self.name)
-        # need to call nrrd.read rather than nrrd.read_data,
-        # because nrrd.read_data has complicated prerequisites
-        data, data_header = nrrd.read(str(self.path), index_order='C')
+        # Raw-encoded NRRD files (such as the ones written by
+        # createFromTiffs) are memory-mapped rather than read,
+        # so that opening the volume is immediate, and the 
+        # operating system decides which parts stay in memory
+        data = Volume.memmapNRRD(self.path)
+        if data is None:
+            # need to call nrrd.read rather than nrrd.read_data,
+            # because nrrd.read_data has complicated prerequisites
+            data, data_header = nrrd.read(str(self.path), index_order='C')
         print("finished reading")
         self.data = data
         self.createTransposedData()
@@ -1343,6 +1463,33 @@ class Volume():
         self.trdata = None
         volume_view.trdata = None
 
+    # Returns a read-only np.memmap (in C index order) of the data
+    # in the given NRRD file, or None if the data cannot be
+    # memory-mapped (for instance, if it is compressed, or
+    # stored in a separate file)
+    def memmapNRRD(filename):
+        try:
+            with open(str(filename), 'rb') as fh:
+                header = nrrd.read_header(fh)
+                offset = fh.tell()
+            if header.get("encoding", "") != "raw":
+                return None
+            if "data file" in header or "datafile" in header:
+                return None
+            if int(header.get("line skip", 0)) != 0 or int(header.get("byte skip", 0)) != 0:
+                return None
+            dtype = nrrd.reader._determine_datatype(header)
+            shape = tuple(reversed([int(size) for size in header["sizes"]]))
+            size = os.path.getsize(str(filename))
+            if offset+int(np.prod(shape))*dtype.itemsize > size:
+                print("memmapNRRD: file", filename, "is too short")
+                return None
+            return np.memmap(str(filename), dtype=dtype, mode='r', 
+                    offset=offset, shape=shape, order='C')
+        except Exception as e:
+            print("memmapNRRD: could not memory-map", filename, e)
+            return None
+
     def loadNRRD(filename, missing_allowed=False):
         try:
             print("reading header for",filename)
@@ -1545,6 +1692,12 @@ class Volume():
         result = data[slices[2],slices[1],slices[0],:]
         return result
 
+    # Same as getSliceInRange, but also returns a list of
+    # the parts of the data that were not available yet;
+    # the data of this type of volume is always available
+    def getSliceInRangeWithMisses(self, data, islice, jslice, k, axis):
+        return self.getSliceInRange(data, islice, jslice, k, axis), []
+
     def getSliceShape(self, axis, zarr_max_width, direction):
         # zarr_max_width will be ignored
         shape = self.trdatas[direction].shape
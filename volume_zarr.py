@@ -5,13 +5,15 @@ import zarr
 import time
 import pathlib
 import re
-import queue
 import json
+import heapq
+import hashlib
+import urllib.parse
 import threading
-from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from concurrent.futures import Future
 import fsspec
 import cv2
-from scipy import ndimage
 from utils import Utils
 
 CHUNK_SIZE = 500
@@ -89,6 +91,11 @@ def zarr_is_file(path):
     proto = fs.protocol
     return proto == "file"
 
+# The stream cache directory (if any) holds the decoded chunks
+# (see CachedZarrVolume.setDiskCache), whose total size is
+# limited.  The compressed chunks are not cached on disk
+# as well (an fsspec "simplecache::" layer would store every
+# compressed chunk there, with no size limit).
 def load_zarr(dirname, load_zarr_options=None):
     options = None
     # print("load_zarr options", load_zarr_options)
@@ -97,10 +104,7 @@ def load_zarr(dirname, load_zarr_options=None):
         cache_dir = load_zarr_options["stream_cache_directory"]
         # print("load_zarr stream_cache_directory", cache_dir)
         dp = pathlib.Path(cache_dir)
-        if dp.is_dir():
-            dirname = "simplecache::"+dirname
-            options = {"simplecache": {"cache_storage": cache_dir}}
-        else:
+        if not dp.is_dir():
             print("WARNING: stream cache directory", cache_dir, "not found!")
     stack_array = zarr.open(dirname, mode="r", storage_options=options)
     return stack_array
@@ -185,10 +189,14 @@ class TransposedDataViewWontWork():
 class TransposedDataView():
     # def __init__(self, data, direction=0, from_vc_render=False, original_dtype=None):
     # Note that "data" is a zarr array, not a numpy array
-    def __init__(self, data, direction=0, from_vc_render=False):
+    # If native is False, uint8 data is converted to uint16
+    # (see __getitem__); if True, data is returned in its
+    # original dtype.
+    def __init__(self, data, direction=0, from_vc_render=False, native=False):
         self.data = data
         self.from_vc_render = from_vc_render
         self.direction = direction
+        self.native = native
         # self.original_dtype = original_dtype
 
     @property
@@ -204,13 +212,26 @@ class TransposedDataView():
         elif self.direction == 1:
             return (shape[1], shape[0], shape[2], shape[3])
 
-    # TODO: currently hard-wired to uint16 to reflect the fact
+    # When not native, hard-wired to uint16 to reflect the fact
     # that __getitem__ converts uint8 data to uint16
     @property
     def dtype(self):
-        # return self.data.dtype
+        if self.native:
+            return self.data.dtype
         return np.uint16
 
+    # For each axis of the transposed data (in the order used
+    # by __getitem__), returns the corresponding axis of
+    # the underlying (zarr) data
+    def dataAxes(self):
+        if self.direction == 0:
+            axes = (2, 0, 1)
+        else:
+            axes = (1, 0, 2)
+        if self.from_vc_render:
+            axes = tuple((1, 0, 2)[a] for a in axes)
+        return axes
+
     # def getDataAndMisses(self, slice0, slice1, slice2, immediate=False):
     # Is this used any more?
     """
@@ -281,7 +302,7 @@ class TransposedDataView():
         # if input_dtype != self.original_dtype:
         #     print("mismatch", input_dtype, self.original_dtype)
         # if self.original_dtype == np.uint8 and result.dtype == np.uint8:
-        if input_dtype == np.uint8 and result.dtype == np.uint8:
+        if not self.native and input_dtype == np.uint8 and result.dtype == np.uint8:
             result = result.astype(np.uint16)
             # result = result * 256 + 128  # Scale up to full 16-bit range
 
@@ -306,6 +327,487 @@ class TransposedDataView():
         return result
 
 
+'''
+Persistent, size-limited disk cache of decoded (decompressed)
+chunks from streamed data stores.  This is a second tier,
+below the in-memory KhartesThreadedLRUCache: when a chunk
+is not in memory, KhartesThreadedLRUCache.getValue looks
+for it here before going to the (remote) data store, and
+chunks that are read from the data store are written here
+after they have been decompressed.  So a region of a volume
+that was viewed in an earlier session can be shown again
+without using the network and without decompressing the data.
+
+Each chunk is stored as a raw file (the decoded bytes, with
+no header), so it can be read with a single read (or
+memory-mapped).  Files are placed in a subdirectory of the
+stream cache directory; that subdirectory contains one directory
+per data store (named with a hash of the store's URL), and within
+that, one file per chunk key.
+Least-recently-used files are deleted when the total size
+of the cache exceeds the limit.  The file modification times
+record the order of use, so the LRU order persists between sessions.
+
+There is one DecodedChunkDiskCache object per cache directory;
+it is shared by all volumes and levels that use that directory.
+'''
+class DecodedChunkDiskCache():
+    subdirectory = "khartes_decoded_chunks"
+    url_file_name = ".store_url"
+    default_max_size_gb = 20.
+    # cache directory -> DecodedChunkDiskCache
+    caches = {}
+    caches_mutex = threading.Lock()
+
+    def __init__(self, cache_dir, max_size_gb):
+        self.path = pathlib.Path(cache_dir) / DecodedChunkDiskCache.subdirectory
+        self.path.mkdir(exist_ok=True)
+        self.max_bytes = int(max_size_gb*2**30)
+        self.mutex = threading.Lock()
+        # file name (str) -> size in bytes, least-recently-used first
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # store url -> store directory
+        self.store_dirs = {}
+        self.scan()
+
+    @staticmethod
+    def getCache(cache_dir, max_size_gb=None):
+        if max_size_gb is None:
+            max_size_gb = DecodedChunkDiskCache.default_max_size_gb
+        key = str(pathlib.Path(cache_dir).resolve())
+        with DecodedChunkDiskCache.caches_mutex:
+            cache = DecodedChunkDiskCache.caches.get(key, None)
+            if cache is None:
+                cache = DecodedChunkDiskCache(key, max_size_gb)
+                DecodedChunkDiskCache.caches[key] = cache
+        cache.setMaxSizeGb(max_size_gb)
+        return cache
+
+    # Deletes all the decoded chunks stored in cache_dir, as
+    # well as any compressed chunks left there by the fsspec
+    # "simplecache::" layer that earlier versions used.
+    # Returns the number of bytes freed.
+    @staticmethod
+    def purgeDirectory(cache_dir):
+        key = str(pathlib.Path(cache_dir).resolve())
+        with DecodedChunkDiskCache.caches_mutex:
+            cache = DecodedChunkDiskCache.caches.get(key, None)
+        if cache is None:
+            cache = DecodedChunkDiskCache(key, DecodedChunkDiskCache.default_max_size_gb)
+        return cache.purge() + DecodedChunkDiskCache.purgeSimpleCacheFiles(key)
+
+    # simplecache names each file after the sha256 of its url
+    simplecache_name = re.compile(r'^[0-9a-f]{64}$')
+
+    # Deletes the files that fsspec's simplecache stored in
+    # cache_dir; returns the number of bytes freed
+    @staticmethod
+    def purgeSimpleCacheFiles(cache_dir):
+        freed = 0
+        for entry in os.scandir(cache_dir):
+            if not entry.is_file() or not DecodedChunkDiskCache.simplecache_name.match(entry.name):
+                continue
+            try:
+                size = entry.stat().st_size
+                os.unlink(entry.path)
+                freed += size
+            except OSError as e:
+                print("Could not delete", entry.path, e)
+        return freed
+
+    # Reads the sizes and modification times of the
+    # files already in the cache
+    def scan(self):
+        files = []
+        for sdir in self.path.iterdir():
+            if not sdir.is_dir():
+                continue
+            for entry in os.scandir(sdir):
+                if entry.name.startswith('.') or not entry.is_file():
+                    continue
+                st = entry.stat()
+                files.append((st.st_mtime, entry.path, st.st_size))
+        files.sort()
+        with self.mutex:
+            self.entries.clear()
+            self.total_bytes = 0
+            for _, name, size in files:
+                self.entries[name] = size
+                self.total_bytes += size
+
+    def setMaxSizeGb(self, max_size_gb):
+        with self.mutex:
+            self.max_bytes = int(max_size_gb*2**30)
+            self.evict()
+
+    def sizeBytes(self):
+        with self.mutex:
+            return self.total_bytes
+
+    def storeDirectory(self, url):
+        sdir = self.store_dirs.get(url, None)
+        if sdir is not None:
+            return sdir
+        sdir = self.path / hashlib.sha1(url.encode()).hexdigest()[:16]
+        sdir.mkdir(exist_ok=True)
+        # for the benefit of anyone looking in the directory
+        url_file = sdir / DecodedChunkDiskCache.url_file_name
+        if not url_file.exists():
+            url_file.write_text(url)
+        self.store_dirs[url] = sdir
+        return sdir
+
+    def chunkFileName(self, url, key):
+        return str(self.storeDirectory(url) / urllib.parse.quote(key, safe=''))
+
+    # Returns the decoded chunk, or None if it is not in the cache
+    def get(self, url, key):
+        name = self.chunkFileName(url, key)
+        with self.mutex:
+            if name not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(name)
+            self.hits += 1
+        try:
+            with open(name, "rb") as infile:
+                value = infile.read()
+            # record the use, so that LRU order persists between sessions
+            os.utime(name)
+        except OSError as e:
+            # FileNotFoundError means the file was evicted
+            # by another thread after the check above
+            if not isinstance(e, FileNotFoundError):
+                print("DecodedChunkDiskCache: could not read", name, e)
+            with self.mutex:
+                self.removeEntry(name)
+            return None
+        return value
+
+    def put(self, url, key, value):
+        name = self.chunkFileName(url, key)
+        tmp_name = "%s.%d.tmp"%(name, threading.get_ident())
+        try:
+            with open(tmp_name, "wb") as outfile:
+                outfile.write(value)
+            os.replace(tmp_name, name)
+        except OSError as e:
+            print("DecodedChunkDiskCache: could not write", name, e)
+            return
+        size = len(value)
+        with self.mutex:
+            self.removeEntry(name)
+            self.entries[name] = size
+            self.total_bytes += size
+            self.evict()
+
+    # must be called with self.mutex held
+    def removeEntry(self, name):
+        size = self.entries.pop(name, None)
+        if size is not None:
+            self.total_bytes -= size
+
+    # must be called with self.mutex held
+    def evict(self):
+        while self.total_bytes > self.max_bytes and len(self.entries) > 0:
+            name, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+
+    def purge(self):
+        with self.mutex:
+            freed = self.total_bytes
+            names = list(self.entries.keys())
+            self.entries.clear()
+            self.total_bytes = 0
+        for name in names:
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+        return freed
+
+
+'''
+Priority scheduler for the chunk reads that
+KhartesThreadedLRUCache performs in the background.
+This replaces the ThreadPoolExecutor (with its work queue
+swapped for a LifoQueue) that was used previously.
+
+A single scheduler is shared by all the levels of a
+CachedZarrVolume, so that requests for chunks at different
+levels can be ranked against each other.
+Pending requests are ranked by:
+  - pyramid level, coarsest first (a coarse chunk
+    covers a large part of the window, and is cheap to read);
+  - distance, in full-resolution voxels, between the chunk and
+    the slice plane (and the focus point) of the window that 
+    requested it;
+  - which window requested it (depth, xline, inline; requests
+    made by threads with no requester come last);
+  - order of submission, most recent first (this was
+    the behavior of the old LifoQueue).
+The distance depends on the current view, so whenever
+the view changes (see setView), the pending requests are re-ranked
+the next time a worker thread asks for work.
+
+The window that is requesting data is not known to
+KhartesThreadedLRUCache.__getitem__, since __getitem__ is
+called from inside the zarr library.  So the consumer calls
+setRequester before reading the data; the requester is
+stored per thread, and must be reset to None once the
+window's reads are done, so that later reads by the same
+thread are not tagged with that window.
+
+When the view moves, requests that were queued for the old
+view are usually no longer needed.  To allow these requests
+to be dropped before they reach the data store, each window
+brackets its data requests with startChunkSet and finishChunkSet.
+Every request (new or already pending) made between these two calls
+is tagged with the window's current chunk-set generation.
+finishChunkSet removes the window from the list of requesters
+of any pending request that was not tagged with the current
+generation; a request that no window needs any more is cancelled.
+'''
+class ChunkRequest():
+    def __init__(self, klru, key, ilevel, box, seq):
+        self.klru = klru
+        self.key = key
+        self.ilevel = ilevel
+        # bounding box of the chunk, in global (x,y,z) coordinates;
+        # None if the box could not be determined from the key
+        self.box = box
+        self.seq = seq
+        # windows that have asked for this chunk:
+        # window name -> chunk-set generation of the latest request
+        self.requesters = {}
+        # set if the request counts against the prefetch
+        # thread limit while it is being read
+        self.prefetch_slot = False
+
+class ChunkRequestScheduler():
+    # lower rank means higher priority
+    window_ranks = {"depth": 0, "xline": 1, "inline": 2}
+    # a chunk that is off the slice plane is penalized more
+    # than a chunk that is on the plane but far from the focus point
+    plane_distance_weight = 4.
+    # maximum fraction of the worker threads that may be
+    # reading prefetch requests at any one time
+    prefetch_worker_share = .25
+
+    def __init__(self, max_workers=4):
+        # max_workers may be changed any time before the first
+        # request is submitted (worker threads are created lazily)
+        self.max_workers = max_workers
+        self.threads = []
+        self.condition = threading.Condition()
+        self.heap = []
+        # (id of klru, key) -> ChunkRequest
+        self.requests = {}
+        # window name -> (global axis normal to window, global ijk of focus)
+        self.views = {}
+        self.seq = 0
+        # set when priorities need to be recomputed
+        self.dirty = False
+        self.local = threading.local()
+        # window name -> current chunk-set generation
+        self.generations = {}
+        # number of requests dropped before being read
+        self.cancelled = 0
+        # number of prefetch requests currently being read
+        self.prefetch_in_flight = 0
+
+    def setRequester(self, window):
+        self.local.window = window
+
+    # Name under which prefetch requests are made on
+    # behalf of the given window
+    @staticmethod
+    def prefetchRequester(window):
+        return window+"-prefetch"
+
+    # A prefetch request is one that only prefetch
+    # requesters are waiting for.  The requester is None
+    # for threads that never called setRequester; these
+    # requests are not prefetch requests.
+    @staticmethod
+    def isPrefetch(request):
+        if len(request.requesters) == 0:
+            return False
+        for window in request.requesters:
+            if window is None or not window.endswith("-prefetch"):
+                return False
+        return True
+
+    def prefetchLimit(self):
+        return max(1, int(self.max_workers*self.prefetch_worker_share))
+
+    def requester(self):
+        return getattr(self.local, "window", None)
+
+    def startChunkSet(self, window):
+        with self.condition:
+            self.generations[window] = self.generations.get(window, 0) + 1
+
+    # Supersedes the window's previous chunk sets: pending
+    # requests that the window did not make (or repeat) since
+    # the last startChunkSet are no longer needed by the window,
+    # and are cancelled if no other window needs them.
+    # Returns the number of requests cancelled.
+    def finishChunkSet(self, window):
+        cancelled = []
+        with self.condition:
+            generation = self.generations.get(window, 0)
+            for rkey, request in list(self.requests.items()):
+                rgen = request.requesters.get(window, None)
+                if rgen is None or rgen == generation:
+                    continue
+                del request.requesters[window]
+                self.dirty = True
+                if len(request.requesters) == 0:
+                    del self.requests[rkey]
+                    cancelled.append(request)
+            self.cancelled += len(cancelled)
+        # call the klru outside of the lock, since
+        # the klru's mutex is held while calling the scheduler
+        for request in cancelled:
+            request.klru.cancelRequest(request.key)
+        return len(cancelled)
+
+    def setView(self, window, gaxis, gijk):
+        view = (gaxis, tuple(int(g) for g in gijk))
+        with self.condition:
+            if self.views.get(window) == view:
+                return
+            self.views[window] = view
+            self.dirty = True
+
+    def priority(self, request):
+        nranks = len(self.window_ranks)
+        rank = nranks
+        distance = 0.
+        box = request.box
+        distances = []
+        for window in request.requesters:
+            rank = min(rank, self.window_ranks.get(window, nranks))
+            view = self.views.get(window)
+            if box is None or view is None:
+                continue
+            gaxis, gijk = view
+            bmin, bmax = box
+            ds = [max(bmin[i]-gijk[i], 0, gijk[i]-bmax[i]+1) for i in range(3)]
+            plane = ds[gaxis]
+            ds[gaxis] = 0
+            inplane = (ds[0]*ds[0]+ds[1]*ds[1]+ds[2]*ds[2])**.5
+            distances.append(self.plane_distance_weight*plane+inplane)
+        if len(distances) > 0:
+            distance = min(distances)
+        # prefetch requests come after all the others
+        prefetch = int(self.isPrefetch(request))
+        return (prefetch, -request.ilevel, distance, rank, -request.seq)
+
+    def push(self, request):
+        heapq.heappush(self.heap, (self.priority(request), request.seq, request))
+
+    # Called by KhartesThreadedLRUCache.__getitem__ after
+    # the key has been added to klru.submitted
+    def submit(self, klru, key):
+        ilevel = klru.ilevel
+        box = klru.chunkBox(key)
+        window = self.requester()
+        with self.condition:
+            self.seq += 1
+            request = ChunkRequest(klru, key, ilevel, box, self.seq)
+            request.requesters[window] = self.generations.get(window, 0)
+            self.requests[(id(klru), key)] = request
+            self.push(request)
+            self.startWorkers()
+            self.condition.notify()
+
+    # Called by KhartesThreadedLRUCache.__getitem__ when a
+    # key that is still pending is requested again, possibly
+    # by a different window
+    def touch(self, klru, key):
+        window = self.requester()
+        with self.condition:
+            request = self.requests.get((id(klru), key), None)
+            if request is None:
+                return
+            if window not in request.requesters:
+                self.dirty = True
+            request.requesters[window] = self.generations.get(window, 0)
+
+    def pendingCount(self):
+        with self.condition:
+            return len(self.requests)
+
+    # must be called with self.condition held
+    def startWorkers(self):
+        while len(self.threads) < self.max_workers:
+            thread = threading.Thread(target=self.workerLoop, daemon=True)
+            self.threads.append(thread)
+            thread.start()
+
+    # must be called with self.condition held
+    def popRequest(self):
+        if self.dirty:
+            self.heap = [(self.priority(r), r.seq, r) for r in self.requests.values()]
+            heapq.heapify(self.heap)
+            self.dirty = False
+        while len(self.heap) > 0:
+            _, _, request = self.heap[0]
+            rkey = (id(request.klru), request.key)
+            # skip stale heap entries
+            if self.requests.get(rkey, None) is not request:
+                heapq.heappop(self.heap)
+                continue
+            # Since prefetch requests are at the end of the
+            # heap, if the first request is a prefetch, all the
+            # remaining ones are too.  Limit the number of threads
+            # that are reading prefetch requests, so that 
+            # requests for visible data are not held up.
+            if self.isPrefetch(request):
+                if self.prefetch_in_flight >= self.prefetchLimit():
+                    return None
+                self.prefetch_in_flight += 1
+                request.prefetch_slot = True
+            heapq.heappop(self.heap)
+            del self.requests[rkey]
+            return request
+        return None
+
+    def workerLoop(self):
+        while True:
+            with self.condition:
+                request = self.popRequest()
+                while request is None:
+                    self.condition.wait()
+                    request = self.popRequest()
+            # processValue expects a future, as it did when
+            # ThreadPoolExecutor was used
+            future = Future()
+            try:
+                future.set_result(request.klru.getValue(request.key))
+            except Exception as e:
+                future.set_exception(e)
+            try:
+                request.klru.processValue(request.key, future)
+            except Exception as e:
+                print("ChunkRequestScheduler: exception while processing", request.key, e)
+            if request.prefetch_slot:
+                with self.condition:
+                    self.prefetch_in_flight -= 1
+                    self.condition.notify()
+
+
 '''
 LRU (least-recently-used) cache based on the version
 in https://github.com/zarr-developers/zarr-python.
@@ -313,7 +815,7 @@ It has been modified to work in threaded mode:
 that is, when __getitem__ is called, if the requested
 chunk is not in cache, a KeyError is immediately returned
 to the caller (telling the caller to treat the chunk as all
-zeros), and a request is submitted to ThreadPoolExecutor
+zeros), and a request is submitted to ChunkRequestScheduler
 to run a thread to retrieve the chunk.  Once the thread has retrieved the
 chunk, the chunk is added to the cache, and (optionally)
 a callback is called.
@@ -327,25 +829,70 @@ and after the data has been retrieved, call setImmediateDataMode(False)
 (to restore request queueing).
 '''
 class KhartesThreadedLRUCache(zarr.storage.LRUStoreCache):
-    def __init__(self, store, max_size):
+    # maximum fraction of the cache that may be taken up
+    # by prefetched chunks that have not yet been used
+    prefetch_memory_share = .25
+    # fsspec protocols whose directory listings are complete.
+    # The listing of an http data store is parsed from the
+    # index page that the server returns, which may leave out
+    # some of the files, so it is not used.
+    complete_listing_protocols = ("file", "local", "s3", "s3a", "gs", "gcs", "az", "abfs", "abfss")
+    # A data store with nested chunk directories needs one
+    # request per directory to be listed; the listing is
+    # abandoned if it would take more requests, or more
+    # seconds, than this
+    max_listing_requests = 20000
+    max_listing_seconds = 300.
+
+    def __init__(self, store, max_size, scheduler=None):
         super().__init__(store, max_size)
         self.future_done_callback = None
         self.callback_called = False
         self.zero_vols = set()
+        # Set of chunk keys that are known (from a listing of the
+        # data store) to exist; None if no listing is available.
+        # If there is a listing, chunk keys that are not in it
+        # are treated as all-zeros chunks, and are never requested
+        # from the data store.
+        self.present_keys = None
+        # time (as returned by time.time()) when the data store
+        # was listed to create present_keys
+        self.present_keys_time = None
         self.submitted = set()
         # non-zero misses: that is, misses due to 
         # key not being in the cache, and not being
         # in the list of empty chunks
         self.nz_misses = 0
         self.immediate_data_mode = False
-        self.executor = ThreadPoolExecutor(max_workers=4)
-        # This is a dubious thing to do from a coding standpoint,
-        # but over a slow connection, the user probably wants to
-        # see the most-recently-requested data first.
-        self.executor._work_queue = queue.LifoQueue()
+        # The scheduler is normally shared among all the
+        # levels of a volume
+        if scheduler is None:
+            scheduler = ChunkRequestScheduler()
+        self.scheduler = scheduler
         self.compressor = None
         self.dtype = None
         self.expected_bytes = None
+        # chunk geometry, used by the scheduler to rank requests;
+        # see setChunkGeometry
+        self.ilevel = 0
+        # number of submitted requests that were cancelled
+        # by the scheduler before being read
+        self.cancelled = 0
+        self.scale = 1
+        self.chunks = None
+        self.key_prefix = ""
+        self.dimension_separator = "."
+        self.from_vc_render = False
+        # second-tier cache of decoded chunks; see setDiskCache
+        self.disk_cache = None
+        self.store_url = None
+        # per-thread list of missed keys; see startMissRecording
+        self.local = threading.local()
+        # keys of prefetch requests that have not yet been read
+        self.prefetch_pending = set()
+        # keys of chunks in the cache that were prefetched, and
+        # that have not been used since
+        self.prefetched = set()
 
     def __getitem__old(self, key):
         print("get item", key)
@@ -375,10 +922,74 @@ class KhartesThreadedLRUCache(zarr.storage.LRUStoreCache):
         c = array.chunks
         self.expected_bytes = c[0]*c[1]*c[2]*array.dtype.itemsize
 
+    def setDiskCache(self, disk_cache, store_url):
+        self.disk_cache = disk_cache
+        self.store_url = store_url
+
+    # Information needed to convert a chunk key into the
+    # position of the chunk in the volume.
+    def setChunkGeometry(self, array, ilevel, scale, from_vc_render):
+        self.ilevel = ilevel
+        self.scale = int(scale)
+        self.chunks = array.chunks
+        self.key_prefix = getattr(array, "_key_prefix", "")
+        self.dimension_separator = getattr(array, "_dimension_separator", None) or "."
+        self.from_vc_render = from_vc_render
+
+    # Returns the chunk indices (in data-axis order) of the
+    # chunk corresponding to key, or None if the key can't be parsed
+    def chunkIndices(self, key):
+        if self.chunks is None or not key.startswith(self.key_prefix):
+            return None
+        parts = key[len(self.key_prefix):].split(self.dimension_separator)
+        try:
+            idxs = [int(part) for part in parts]
+        except ValueError:
+            return None
+        if len(idxs) < 3:
+            return None
+        return idxs
+
+    # Inverse of chunkIndices
+    def chunkKey(self, idxs):
+        return self.key_prefix+self.dimension_separator.join(str(i) for i in idxs)
+
+    # Returns the bounding box (min corner, max corner) of 
+    # the chunk, in full-resolution global (x,y,z) coordinates,
+    # or None if the key can't be parsed
+    def chunkBox(self, key):
+        idxs = self.chunkIndices(key)
+        if idxs is None:
+            return None
+        # data axes are in kji (z,y,x) order
+        dmin = [idxs[i]*self.chunks[i]*self.scale for i in range(3)]
+        dmax = [(idxs[i]+1)*self.chunks[i]*self.scale for i in range(3)]
+        if self.from_vc_render:
+            order = (2,0,1)
+        else:
+            order = (2,1,0)
+        return (tuple(dmin[i] for i in order), tuple(dmax[i] for i in order))
+
     def setImmediateDataMode(self, flag):
         with self._mutex:
             self.immediate_data_mode = flag
 
+    # Between calls to startMissRecording and stopMissRecording,
+    # the keys of chunks that were requested by the current 
+    # thread, but that have not yet been loaded (and that are
+    # not known to be empty), are recorded.  This allows the caller
+    # to tell which parts of the returned data are missing, rather
+    # than truly zero.
+    def startMissRecording(self):
+        self.local.missed = []
+
+    def stopMissRecording(self):
+        missed = getattr(self.local, "missed", None)
+        self.local.missed = None
+        if missed is None:
+            return []
+        return missed
+
     def getImmediateDataMode(self):
         with self._mutex:
             return self.immediate_data_mode
@@ -439,6 +1050,9 @@ class KhartesThreadedLRUCache(zarr.storage.LRUStoreCache):
                 self.hits += 1
                 # treat the end as most recently used
                 self._values_cache.move_to_end(key)
+                # a prefetched chunk that has been used
+                # is treated like any other
+                self.prefetched.discard(key)
                 return value
 
         except KeyError:
@@ -471,16 +1085,22 @@ class KhartesThreadedLRUCache(zarr.storage.LRUStoreCache):
                     wait_for_data = True
             raise_error = False
             with self._mutex:
+                # a chunk that was being prefetched is now needed
+                self.prefetch_pending.discard(key)
+                is_empty = self.isKnownEmpty(key)
                 # check whether
                 # key is known to correspond to an all-zeros volume,
                 # or key has already been submitted to the thread queue:
-                if key in self.zero_vols or key in self.submitted:
+                if is_empty or key in self.submitted:
                     # this tells the caller to treat the current
                     # chunk as all zeros
                     raise_error = True
-                if key not in self.zero_vols and not wait_for_data:
+                if not is_empty and not wait_for_data:
                     # print("+1")
                     self.nz_misses += 1
+                    missed = getattr(self.local, "missed", None)
+                    if missed is not None:
+                        missed.append(key)
                 if not raise_error and not wait_for_data:
                     # the add() is done here, instead of below,
                     # where the request is submitted, because here
@@ -492,21 +1112,154 @@ class KhartesThreadedLRUCache(zarr.storage.LRUStoreCache):
             # if wait_for_data is set, hand all control to
             # the getValue call, and let it decide for 
             # itself whether to raise an error.
+            # The one exception is a chunk that is known to be
+            # empty, which is not read from the store at all.
             if wait_for_data:  # read the value immediately
+                if is_empty:
+                    raise KeyError(key)
                 value = self.getValue(key)
                 self.cacheValue(key, value)
                 return value
             elif raise_error:
+                if key in self.submitted:
+                    # let the scheduler know which window
+                    # is still waiting for this key
+                    self.scheduler.touch(self, key)
                 raise KeyError(key)
-            else:  # submit to the thread pool a request to read the value
-                future = self.executor.submit(self.getValue, key)
-                future.add_done_callback(lambda x: self.processValue(key, x))
+            else:  # submit to the scheduler a request to read the value
+                self.scheduler.submit(self, key)
                 raise KeyError(key)
 
     def is_dotfile(self, key):
         parts = key.split('/')
         return parts[-1][0] == '.'
 
+    # Used for data that was drawn while the chunk was missing.
+    # Returns False if the chunk has since been loaded, or has
+    # been found to be empty.  Otherwise, makes sure that the
+    # chunk is (still) requested, and returns True.
+    def stillMissing(self, key):
+        try:
+            self[key]
+        except KeyError:
+            with self._mutex:
+                return not self.isKnownEmpty(key)
+        return False
+
+    # must be called with self._mutex held
+    def isKnownEmpty(self, key):
+        if key in self.zero_vols:
+            return True
+        if self.present_keys is None or len(key) == 0:
+            return False
+        if not key.startswith(self.key_prefix) or self.is_dotfile(key):
+            return False
+        return key not in self.present_keys
+
+    # Whether a listing of the data store is known to
+    # contain every chunk in the store
+    def listingIsComplete(self):
+        if isinstance(self._store, zarr.storage.DirectoryStore):
+            return True
+        fs = getattr(self._store, "fs", None)
+        if fs is None:
+            return False
+        protocols = fs.protocol
+        if isinstance(protocols, str):
+            protocols = (protocols,)
+        for protocol in protocols:
+            if protocol in self.complete_listing_protocols:
+                return True
+        return False
+
+    # Returns the set of keys of the chunks (in this level)
+    # that exist in the data store, or None if the
+    # data store could not be listed completely.
+    def listChunkKeys(self):
+        if self.chunks is None or not self.listingIsComplete():
+            return None
+        prefix = self.key_prefix
+        root = prefix[:-1] if prefix.endswith('/') else prefix
+        fs = getattr(self._store, "fs", None)
+        def listdir(path):
+            if fs is not None:
+                # FSStore.listdir of a directory with nested chunks
+                # lists all of the chunk directories by itself
+                names = [p.rstrip('/').rsplit('/', 1)[-1] for p in fs.ls(self._store.dir_path(path), detail=False)]
+            elif isinstance(self._store, zarr.storage.DirectoryStore):
+                # (so does DirectoryStore.listdir)
+                names = os.listdir(os.path.join(self._store.path, path))
+            else:
+                names = self._store.listdir(path)
+            return [name for name in names if not name.startswith('.')]
+        start = time.time()
+        try:
+            if self.dimension_separator == '/':
+                # nested chunk directories: one level per dimension
+                paths = [root]
+                nrequests = 0
+                for _ in self.chunks:
+                    nrequests += len(paths)
+                    if nrequests > self.max_listing_requests:
+                        print("Listing the chunks in", root, "would take more than", self.max_listing_requests, "requests")
+                        return None
+                    npaths = []
+                    for p in paths:
+                        if time.time()-start > self.max_listing_seconds:
+                            print("Listing the chunks in", root, "took more than", self.max_listing_seconds, "seconds")
+                            return None
+                        npaths.extend(p+'/'+n if p != "" else n for n in listdir(p))
+                    paths = npaths
+                keys = set(paths)
+            else:
+                keys = set(prefix+n for n in listdir(root))
+        except Exception as e:
+            print("Could not list chunks in", root, e)
+            return None
+        return keys
+
+    # The empty-chunk index: the empty chunks found so far (each
+    # one confirmed by a read from the data store), and the chunks
+    # present according to a listing of the data store, along
+    # with the time of the listing
+    def getEmptyChunkIndex(self):
+        with self._mutex:
+            present = None
+            if self.present_keys is not None:
+                present = sorted(self.present_keys)
+            return {"empty": sorted(self.zero_vols), "present": present, "listed": self.present_keys_time}
+
+    def setEmptyChunkIndex(self, index):
+        with self._mutex:
+            self.zero_vols.update(index.get("empty", []))
+            present = index.get("present", None)
+            if present is not None:
+                self.present_keys = set(present)
+                self.present_keys_time = index.get("listed", None)
+
+    # Sets the chunks present according to a listing of the
+    # data store, made at time listed.  Returns False, without
+    # setting anything, if the listing is missing some chunks
+    # that have already been read from the data store (which
+    # means that the listing was truncated).
+    def setPresentKeys(self, keys, listed):
+        with self._mutex:
+            for key in self._values_cache:
+                if key.startswith(self.key_prefix) and not self.is_dotfile(key) and key not in keys:
+                    return False
+            self.present_keys = keys
+            self.present_keys_time = listed
+            # chunks that were empty when they were read, but
+            # that now exist in the data store
+            self.zero_vols -= keys
+        return True
+
+    # Used to decide whether the index has changed since
+    # it was last loaded or saved
+    def emptyChunkIndexSignature(self):
+        with self._mutex:
+            return (len(self.zero_vols), self.present_keys_time)
+
     # This function gets a chunk from the underlying data
     # store.  The access may cause an exception to be thrown.
     # This function does not try to catch exceptions, because
@@ -516,6 +1269,11 @@ class KhartesThreadedLRUCache(zarr.storage.LRUStoreCache):
     # here.
     def getValue(self, key):
         # print("getValue", key)
+        use_disk_cache = self.disk_cache is not None and not self.is_dotfile(key)
+        if use_disk_cache:
+            value = self.disk_cache.get(self.store_url, key)
+            if value is not None and self.expected_bytes is not None and len(value) == self.expected_bytes:
+                return value
         try_count = 10
         try_wait = 2
         for i in range(try_count):
@@ -557,6 +1315,8 @@ class KhartesThreadedLRUCache(zarr.storage.LRUStoreCache):
                 print(key,"unexpected value length", lv, key)
                 time.sleep(try_wait)
                 continue
+            if use_disk_cache:
+                self.disk_cache.put(self.store_url, key, value)
             return value
 
     def cacheValue(self, key, value):
@@ -570,6 +1330,85 @@ class KhartesThreadedLRUCache(zarr.storage.LRUStoreCache):
                 self._cache_value(key, value)
                 # print("  pv done")
 
+    # This is called by the scheduler when a request is
+    # dropped before being read from the data store
+    def cancelRequest(self, key):
+        with self._mutex:
+            self.submitted.discard(key)
+            self.prefetch_pending.discard(key)
+            self.cancelled += 1
+
+    # must be called with self._mutex held
+    def prefetchRoom(self):
+        if self._max_size is None or self.expected_bytes is None:
+            return True
+        count = len(self.prefetched)+len(self.prefetch_pending)
+        return count*self.expected_bytes < self.prefetch_memory_share*self._max_size
+
+    # Submits a low-priority request to read the chunk, unless
+    # it is already in the cache, already requested, or
+    # known to be empty, or unless prefetched chunks already
+    # take up their share of the cache.
+    # The requester (see ChunkRequestScheduler.setRequester)
+    # should be a prefetch requester.
+    # Returns True if the chunk was requested.
+    def prefetch(self, key):
+        touch = False
+        with self._mutex:
+            if self.immediate_data_mode or key in self._values_cache or self.isKnownEmpty(key):
+                return False
+            if key in self.submitted:
+                touch = True
+            elif not self.prefetchRoom():
+                return False
+            else:
+                self.submitted.add(key)
+                self.prefetch_pending.add(key)
+        if touch:
+            # keep the request from being cancelled
+            self.scheduler.touch(self, key)
+            return False
+        self.scheduler.submit(self, key)
+        return True
+
+    # Adds a prefetched chunk to the cache.  To make room for it,
+    # only other prefetched (and not yet used) chunks may be 
+    # evicted; if that does not make enough room, the chunk
+    # is not cached.
+    def cachePrefetchedValue(self, key, value):
+        with self._mutex:
+            if key in self._values_cache:
+                return
+            size = zarr.util.buffer_size(value)
+            if self._max_size is not None:
+                evictable = sum(zarr.util.buffer_size(self._values_cache[old]) 
+                        for old in self.prefetched if old in self._values_cache)
+                if self._current_size - evictable + size > self._max_size:
+                    return
+                for old in list(self._values_cache.keys()):
+                    if self._current_size + size <= self._max_size:
+                        break
+                    if old in self.prefetched:
+                        ovalue = self._values_cache.pop(old)
+                        self.prefetched.discard(old)
+                        self._current_size -= zarr.util.buffer_size(ovalue)
+                if self._current_size + size > self._max_size:
+                    return
+            self._values_cache[key] = value
+            self._current_size += size
+            self.prefetched.add(key)
+
+    # overrides LRUStoreCache._pop_value
+    def _pop_value(self):
+        key, value = self._values_cache.popitem(last=False)
+        self.prefetched.discard(key)
+        return value
+
+    def invalidate(self):
+        super().invalidate()
+        with self._mutex:
+            self.prefetched.clear()
+
     # This is called when the thread reports that it has
     # completed the getValue (disk read) operation
     def processValue(self, key, future):
@@ -591,9 +1430,19 @@ class KhartesThreadedLRUCache(zarr.storage.LRUStoreCache):
             # print("pv key error", key)
             with self._mutex:
                 self.zero_vols.add(key)
+                self.prefetch_pending.discard(key)
             if self.future_done_callback is not None:
                 self.future_done_callback(key, False)
             return
+        with self._mutex:
+            prefetch = key in self.prefetch_pending
+            self.prefetch_pending.discard(key)
+        if prefetch:
+            # No window is waiting for this chunk, so
+            # there is no need to call the callback (which
+            # would trigger a redraw)
+            self.cachePrefetchedValue(key, value)
+            return
         self.cacheValue(key, value)
         if self.future_done_callback is not None:
             self.future_done_callback(key, True)
@@ -601,9 +1450,10 @@ class KhartesThreadedLRUCache(zarr.storage.LRUStoreCache):
 
 class ZarrLevel():
     # def __init__(self, array, path, scale, ilevel, max_mem_gb, from_vc_render=False, original_dtype=None):
-    def __init__(self, array, path, scale, ilevel, max_mem_gb, from_vc_render=False):
+    def __init__(self, array, path, scale, ilevel, max_mem_gb, from_vc_render=False, scheduler=None):
         klru = KhartesThreadedLRUCache(
-                array.store, max_size=int(max_mem_gb*2**30))
+                array.store, max_size=int(max_mem_gb*2**30),
+                scheduler=scheduler)
         self.klru = klru
         self.ilevel = ilevel
         self.data = zarr.open(klru, mode="r")
@@ -612,6 +1462,7 @@ class ZarrLevel():
         # klru.setCompressor(self.data._compressor)
         # self.data._compressor = None
         klru.transferCompressor(self.data)
+        klru.setChunkGeometry(self.data, ilevel, scale, from_vc_render)
         # print("self data compressor", self.data._compressor)
         self.scale = scale
         # don't know if self.from_vc_render will ever be used
@@ -622,6 +1473,11 @@ class ZarrLevel():
         # self.trdatas.append(TransposedDataView(self.data, 1, from_vc_render, original_dtype))
         self.trdatas.append(TransposedDataView(self.data, 0, from_vc_render))
         self.trdatas.append(TransposedDataView(self.data, 1, from_vc_render))
+        # used by CachedZarrVolume.paintLevel, which converts
+        # uint8 data to uint16 itself, as late as possible
+        self.native_trdatas = []
+        self.native_trdatas.append(TransposedDataView(self.data, 0, from_vc_render, True))
+        self.native_trdatas.append(TransposedDataView(self.data, 1, from_vc_render, True))
 
 
     # The callback takes 2 arguments: key (a string) and
@@ -637,6 +1493,236 @@ class ZarrLevel():
     def setImmediateDataMode(self, flag):
         self.klru.setImmediateDataMode(flag)
 
+'''
+A tile of a data slice that has been resized to window
+resolution and converted to uint16 (the values that are
+displayed).  x, y is the location of the upper left corner
+of the tile, relative to the upper left corner of the resized
+data slice.
+If some of the chunks covered by the tile were still being
+loaded when the tile was drawn, mask is a boolean array that
+is True where the tile is valid, and missed is the set of
+keys of the missing chunks.  Otherwise mask is None.
+'''
+class SliceTile():
+    def __init__(self, x, y, data, mask, missed):
+        self.x = x
+        self.y = y
+        self.data = data
+        self.mask = mask
+        self.missed = missed
+        self.nbytes = data.nbytes
+        if mask is not None:
+            self.nbytes += mask.nbytes
+
+'''
+LRU cache, with a memory budget, of SliceTile's.
+Used by CachedZarrVolume.paintLevel, so that when the user pans
+the view, most of the window can be copied from tiles that
+were drawn in previous frames, instead of being sliced and 
+resized again.
+The key is 
+(volume, direction, axis, slice index, level, zoom, tile i, tile j).
+Tiles that were drawn while chunks were missing are
+invalidated when those chunks arrive (see
+CachedZarrVolume.chunkDone).
+The cache is accessed from the chunk-reading threads as well
+as from the GUI thread, so all access is protected by a lock.
+'''
+class SliceTileCache():
+    default_max_mb = 256
+
+    def __init__(self, max_mb=None):
+        if max_mb is None:
+            max_mb = SliceTileCache.default_max_mb
+        self.max_bytes = int(max_mb*2**20)
+        self.lock = threading.Lock()
+        self.tiles = OrderedDict()
+        self.nbytes = 0
+        # (volume, level, chunk key) -> set of keys of
+        # tiles that are waiting for that chunk
+        self.waiting = {}
+        self.hits = 0
+        self.misses = 0
+
+    def setMaxMb(self, max_mb):
+        with self.lock:
+            self.max_bytes = int(max_mb*2**20)
+            self.evict()
+
+    def get(self, key):
+        with self.lock:
+            tile = self.tiles.get(key, None)
+            if tile is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.tiles.move_to_end(key)
+            return tile
+
+    def put(self, key, tile):
+        with self.lock:
+            self.remove(key)
+            self.tiles[key] = tile
+            self.nbytes += tile.nbytes
+            for ckey in tile.missed:
+                self.waiting.setdefault((key[0], key[4], ckey), set()).add(key)
+            self.evict()
+
+    # must be called with self.lock held
+    def remove(self, key):
+        tile = self.tiles.pop(key, None)
+        if tile is None:
+            return
+        self.nbytes -= tile.nbytes
+        for ckey in tile.missed:
+            wkey = (key[0], key[4], ckey)
+            keys = self.waiting.get(wkey, None)
+            if keys is None:
+                continue
+            keys.discard(key)
+            if len(keys) == 0:
+                del self.waiting[wkey]
+
+    # must be called with self.lock held
+    def evict(self):
+        while self.nbytes > self.max_bytes and len(self.tiles) > 0:
+            key = next(iter(self.tiles))
+            self.remove(key)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.remove(key)
+
+    # Called when a chunk has arrived
+    def invalidateChunk(self, volume, ilevel, ckey):
+        with self.lock:
+            keys = self.waiting.pop((volume, ilevel, ckey), None)
+            if keys is None:
+                return
+            for key in keys:
+                self.remove(key)
+
+    def invalidateVolume(self, volume):
+        with self.lock:
+            for key in [key for key in self.tiles if key[0] is volume]:
+                self.remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.tiles.clear()
+            self.waiting.clear()
+            self.nbytes = 0
+
+'''
+Scratch buffers used by CachedZarrVolume.paintSlice and
+paintLevel when compositing the levels of a multi-resolution
+volume into a window.  There is one PaintBuffers instance per
+window; its arrays are allocated when the window size changes,
+and are reused from one redraw to the next, so that a redraw
+does not have to allocate (and zero) window-sized arrays.
+
+"valid" is True where the window has already been painted
+with data from a loaded chunk.  In addition, the window is
+divided into tiles (tile_size x tile_size pixels), and
+"tile_valid" records which tiles are completely painted;
+this allows paintLevel to limit the work done at coarser levels
+to the part of the window that still needs painting.
+'''
+class PaintBuffers():
+    tile_size = 64
+
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        h, w = self.shape
+        ts = self.tile_size
+        self.nty = (h+ts-1)//ts
+        self.ntx = (w+ts-1)//ts
+        # valid is padded to a whole number of tiles, so
+        # that it can be reshaped into tiles without copying.
+        # The padding is always True (it never needs painting)
+        self.valid_padded = np.ones((self.nty*ts, self.ntx*ts), dtype=np.bool_)
+        self.valid = self.valid_padded[:h, :w]
+        self.tile_valid = np.zeros((self.nty, self.ntx), dtype=np.bool_)
+        # window-sized scratch arrays; views of the upper
+        # left corner are used for smaller rectangles
+        self.paint = np.zeros(self.shape, dtype=np.bool_)
+        self.mask = np.zeros(self.shape, dtype=np.bool_)
+        self.wvalid = np.zeros(self.shape, dtype=np.uint8)
+        self.values16 = np.zeros(self.shape, dtype=np.uint16)
+        self.resized_buffers = {}
+        # level -> slice and zoom at which the level was 
+        # most recently drawn in the window
+        self.views = {}
+
+    # called at the start of each redraw
+    def reset(self):
+        self.valid[:] = False
+        self.tile_valid[:] = False
+
+    # returns an h x w scratch array of the given dtype, used
+    # to hold a resized data slice
+    def resized(self, dtype, h, w):
+        dtype = np.dtype(dtype)
+        buf = self.resized_buffers.get(dtype)
+        if buf is None:
+            buf = np.zeros(self.shape, dtype=dtype)
+            self.resized_buffers[dtype] = buf
+        return buf[:h, :w]
+
+    # updates tile_valid in the tiles that overlap the
+    # given rectangle (in window coordinates)
+    def updateTiles(self, x1, y1, x2, y2):
+        ts = self.tile_size
+        tx1, ty1 = x1//ts, y1//ts
+        tx2, ty2 = (x2+ts-1)//ts, (y2+ts-1)//ts
+        if tx1 >= tx2 or ty1 >= ty2:
+            return
+        tiles = self.valid_padded[ty1*ts:ty2*ts, tx1*ts:tx2*ts].reshape(
+                ty2-ty1, ts, tx2-tx1, ts)
+        tiles.all(axis=(1,3), out=self.tile_valid[ty1:ty2, tx1:tx2])
+
+    # marks the given rectangle (in window coordinates) as
+    # painted.  Tiles that are entirely inside the rectangle are
+    # marked without checking their pixels; only the tiles
+    # along the edges of the rectangle need to be checked.
+    def setValid(self, x1, y1, x2, y2):
+        self.valid[y1:y2, x1:x2] = True
+        ts = self.tile_size
+        h, w = self.shape
+        # the padding beyond the right and bottom edges
+        # of the window is always valid
+        px2 = self.ntx*ts if x2 == w else x2
+        py2 = self.nty*ts if y2 == h else y2
+        tx1, ty1 = (x1+ts-1)//ts, (y1+ts-1)//ts
+        tx2, ty2 = px2//ts, py2//ts
+        if tx1 >= tx2 or ty1 >= ty2:
+            self.updateTiles(x1, y1, x2, y2)
+            return
+        self.tile_valid[ty1:ty2, tx1:tx2] = True
+        # edges
+        self.updateTiles(x1, y1, x2, ty1*ts)
+        self.updateTiles(x1, ty2*ts, x2, y2)
+        self.updateTiles(x1, y1, tx1*ts, y2)
+        self.updateTiles(tx2*ts, y1, x2, y2)
+
+    # returns the bounding rectangle (in window coordinates)
+    # of the tiles that are not yet completely painted,
+    # or None if the whole window has been painted
+    def missingRect(self):
+        if self.tile_valid.all():
+            return None
+        missing = ~self.tile_valid
+        rows = np.flatnonzero(missing.any(axis=1))
+        cols = np.flatnonzero(missing.any(axis=0))
+        ts = self.tile_size
+        h, w = self.shape
+        x1 = cols[0]*ts
+        y1 = rows[0]*ts
+        x2 = min((cols[-1]+1)*ts, w)
+        y2 = min((rows[-1]+1)*ts, h)
+        return ((x1,y1),(x2,y2))
+
 
 class CachedZarrVolume():
     """An interface to cached volume data stored on disk as .tif files
@@ -678,9 +1764,50 @@ class CachedZarrVolume():
         self.active_project_views = set()
         self.from_vc_render = False
         self.levels = []
+        self.path = None
+        self.store_url = None
+        # see setEmptyChunkIndexDirectory
+        self.empty_index_path = None
+        self.empty_index_signature = None
+        # shared by all levels; the number of worker
+        # threads is set once the levels are known
+        self.scheduler = ChunkRequestScheduler()
+        # scratch buffers used by paintSlice, indexed by window name
+        self.paint_buffers = {}
+        # see setCallback
+        self.callback = None
+        # window name -> (axis, direction, ijkt, zoom) at the
+        # window's previous redraw; used by prefetchAhead
+        self.prefetch_views = {}
 
     # class member
     max_mem_gb = 8
+    # number of chunk-reading threads per level
+    workers_per_level = 4
+    # whether to list the chunks of a streamed data store, in
+    # order to find out in advance which chunks are empty
+    seed_empty_chunk_index = True
+    # a saved listing of the chunks of a data store that is
+    # older than this (or that has no time) is not used; the
+    # data store is listed again instead
+    empty_chunk_listing_max_age_days = 7.
+    # window names, indexed by axis
+    window_names = ("inline", "xline", "depth")
+    # converts uint8 data to the uint16 values that are displayed
+    uint8_to_uint16_lut = np.arange(256, dtype=np.uint16)*256
+    # whether paintLevel draws from (and fills) tile_cache
+    use_tile_cache = True
+    # approximate width and height, in window pixels, of
+    # the tiles in tile_cache
+    tile_pixels = 512
+    # resized data-slice tiles, shared by all volumes
+    tile_cache = SliceTileCache()
+    # whether to prefetch the chunks that the user is likely
+    # to need next (see prefetchAhead)
+    use_prefetch = True
+    # number of (full-resolution) slices to prefetch ahead
+    # of the current one, when the user is stepping through slices
+    prefetch_slices = 8
 
     @property
     def shape(self):
@@ -867,6 +1994,7 @@ class CachedZarrVolume():
         volume.data_header = header
         # volume.max_width = max_width
         volume.path = filename
+        volume.empty_index_path = CachedZarrVolume.emptyChunkIndexPath(filename)
         # _, volume.name = os.path.split(filename)
         _, name = os.path.split(filename)
         if name.endswith(".volzarr") and len(name) > 8:
@@ -910,6 +2038,14 @@ class CachedZarrVolume():
             err = f"Problem parsing zdata from input directory {ddir}"
             print(err)
             return CachedZarrVolume.createErrorVolume(err)
+        volume.scheduler.max_workers = CachedZarrVolume.workers_per_level*len(volume.levels)
+        volume.setChunkCallbacks()
+        volume.store_url = ddir
+        if volume.is_streaming:
+            volume.setDiskCache(ddir, load_zarr_options)
+        volume.loadEmptyChunkIndex()
+        if volume.is_streaming and CachedZarrVolume.seed_empty_chunk_index:
+            volume.seedEmptyChunkIndex()
 
         # print("len levels", len(volume.levels))
 
@@ -934,7 +2070,7 @@ class CachedZarrVolume():
     def setLevelFromArray(self, array, max_mem_gb):
         # self.original_dtype = array.dtype
         # level = ZarrLevel(array, "", 1., 0, max_mem_gb, self.from_vc_render, self.original_dtype)
-        level = ZarrLevel(array, "", 1., 0, max_mem_gb, self.from_vc_render)
+        level = ZarrLevel(array, "", 1., 0, max_mem_gb, self.from_vc_render, self.scheduler)
         self.levels.append(level)
 
     def parseMetadata(self, hier):
@@ -1042,7 +2178,7 @@ class CachedZarrVolume():
 
             # Create a custom ZarrLevel that handles the dtype conversion
             # level = ZarrLevel(hier, path, scale, i, max(min_max_gb, max_gb), self.from_vc_render, self.original_dtype)
-            level = ZarrLevel(hier, path, scale, i, max(min_max_gb, max_gb), self.from_vc_render)
+            level = ZarrLevel(hier, path, scale, i, max(min_max_gb, max_gb), self.from_vc_render, self.scheduler)
             self.levels.append(level)
             expected_scale *= 2.
             expected_path_int += 1
@@ -1052,10 +2188,148 @@ class CachedZarrVolume():
         for level in self.levels:
             level.setImmediateDataMode(flag)
 
+    # Attach a disk cache of decoded chunks, if the user has
+    # specified a stream cache directory
+    def setDiskCache(self, url, load_zarr_options):
+        if load_zarr_options is None:
+            return
+        cache_dir = load_zarr_options.get("stream_cache_directory", None)
+        if cache_dir is None or not pathlib.Path(cache_dir).is_dir():
+            return
+        size_gb = load_zarr_options.get("stream_cache_size_gb", None)
+        try:
+            disk_cache = DecodedChunkDiskCache.getCache(cache_dir, size_gb)
+        except OSError as e:
+            print("Could not create decoded-chunk cache in", cache_dir, e)
+            return
+        for level in self.levels:
+            level.klru.setDiskCache(disk_cache, url)
+
     def setCallback(self, cb):
         print("setting callback")
+        self.callback = cb
+
+    # Called (from within a chunk-reading thread) when
+    # a chunk of the given level has been loaded, or has
+    # been found to be empty
+    def chunkDone(self, level, key, has_data):
+        # tiles that were drawn while the chunk was missing
+        # are now out of date
+        self.tile_cache.invalidateChunk(self, level.ilevel, key)
+        if self.callback is not None:
+            self.callback(key, has_data)
+
+    def setChunkCallbacks(self):
         for level in self.levels:
-            level.setCallback(cb)
+            level.setCallback(
+                    lambda key, has_data, level=level: self.chunkDone(level, key, has_data))
+
+    # The empty-chunk index is stored next to the .volzarr file
+    @staticmethod
+    def emptyChunkIndexPath(volzarr_path):
+        return pathlib.Path(volzarr_path).with_suffix(".emptychunks")
+
+    # Sets the directory where the empty-chunk index is written
+    # (the volumes directory of the project); this changes when
+    # the project is saved under a new name, while self.path
+    # does not.
+    def setEmptyChunkIndexDirectory(self, vdir):
+        if self.path is None:
+            return
+        ipath = pathlib.Path(vdir) / CachedZarrVolume.emptyChunkIndexPath(self.path).name
+        if ipath != self.empty_index_path:
+            self.empty_index_path = ipath
+            # make sure the index is written to the new location
+            self.empty_index_signature = None
+
+    def emptyChunkIndexSignatures(self):
+        return [level.klru.emptyChunkIndexSignature() for level in self.levels]
+
+    def loadEmptyChunkIndex(self):
+        if self.empty_index_path is None:
+            return
+        ipath = self.empty_index_path
+        if not ipath.exists():
+            return
+        try:
+            info = json.loads(ipath.read_text(encoding="utf8"))
+        except Exception as e:
+            print("Could not read empty-chunk index", ipath, e)
+            return
+        levels = info.get("levels", [])
+        if info.get("store", None) != self.store_url or len(levels) != len(self.levels):
+            print("Empty-chunk index", ipath, "does not match the data store; ignoring it")
+            return
+        max_age = CachedZarrVolume.empty_chunk_listing_max_age_days*86400.
+        stale = False
+        for level, index in zip(self.levels, levels):
+            listed = index.get("listed", None)
+            if index.get("present", None) is not None and not level.klru.listingIsComplete():
+                # saved by a version that trusted any listing
+                index = {"empty": index.get("empty", [])}
+            elif index.get("present", None) is not None and (listed is None or time.time()-listed > max_age):
+                # the data store may have changed since it was listed
+                index = {"empty": index.get("empty", [])}
+                stale = True
+            level.klru.setEmptyChunkIndex(index)
+        if stale:
+            print("Empty-chunk index", ipath, "has an old listing of the data store; it will be listed again")
+        self.empty_index_signature = self.emptyChunkIndexSignatures()
+
+    # Writes the index only if it has changed since it was 
+    # last loaded or saved.  May be called from any thread.
+    def saveEmptyChunkIndex(self):
+        if self.empty_index_path is None or len(self.levels) == 0:
+            return
+        signature = self.emptyChunkIndexSignatures()
+        if signature == self.empty_index_signature:
+            return
+        info = {
+            "store": self.store_url,
+            "levels": [level.klru.getEmptyChunkIndex() for level in self.levels],
+        }
+        ipath = self.empty_index_path
+        tmp_path = ipath.with_name("%s.%d.tmp"%(ipath.name, threading.get_ident()))
+        try:
+            tmp_path.write_text(json.dumps(info), encoding="utf8")
+            os.replace(tmp_path, ipath)
+        except Exception as e:
+            print("Could not write empty-chunk index", ipath, e)
+            return
+        self.empty_index_signature = signature
+
+    # Lists the chunks in each level of the data store (in
+    # a background thread, since a remote listing may take
+    # a while), so that chunks that are absent from the
+    # store are never requested.
+    # Levels that already have a listing, and data stores whose
+    # listings may be incomplete, are skipped.
+    def seedEmptyChunkIndex(self):
+        levels = [level for level in self.levels if level.klru.present_keys is None and level.klru.listingIsComplete()]
+        if len(levels) == 0:
+            return
+        def seed():
+            # coarse levels first, since they are drawn first
+            for level in reversed(levels):
+                listed = time.time()
+                keys = level.klru.listChunkKeys()
+                # An empty listing is more likely to mean that the store
+                # can't be listed than that the level has no data
+                if keys is None or len(keys) == 0:
+                    continue
+                if not level.klru.setPresentKeys(keys, listed):
+                    print("Volume %s level %d: listing of %d chunks is incomplete; ignoring it"%(self.name, level.ilevel, len(keys)))
+                    continue
+                print("Volume %s level %d: %d chunks listed"%(self.name, level.ilevel, len(keys)))
+            self.saveEmptyChunkIndex()
+        thread = threading.Thread(target=seed, daemon=True)
+        thread.start()
+
+    # Number of chunk requests that were cancelled (because
+    # the view moved on) before they were read, in total
+    # and per level
+    def cancelledRequestCounts(self):
+        return self.scheduler.cancelled, [level.klru.cancelled for level in self.levels]
 
     def dataSize(self):
         """Size of the whole dataset in bytes
@@ -1087,9 +2361,12 @@ class CachedZarrVolume():
 
     def unloadData(self, project_view):
         self.active_project_views.discard(project_view)
+        self.saveEmptyChunkIndex()
         # self.data.store.invalidate()
         for level in self.levels:
             level.data.store.invalidate()
+        self.paint_buffers = {}
+        self.tile_cache.invalidateVolume(self)
 
     def createTransposedData(self):
         pass
@@ -1194,27 +2471,79 @@ class CachedZarrVolume():
         # print(islice, jslice, k, data.shape, axis, result.shape)
         return result
 
+    # Same as getSliceInRange, but also returns the keys of
+    # the chunks that were not loaded yet (see
+    # KhartesThreadedLRUCache.startMissRecording); data must
+    # be one of the full-resolution trdatas
+    def getSliceInRangeWithMisses(self, data, islice, jslice, k, axis):
+        klru = self.levels[0].klru
+        klru.startMissRecording()
+        try:
+            result = self.getSliceInRange(data, islice, jslice, k, axis)
+        finally:
+            missed = klru.stopMissRecording()
+        return result, missed
+
+    # Returns a mask (in slice coordinates; 255 where valid, 0
+    # where not) showing which parts of a slice come from chunks
+    # that have been loaded.  Returns None if all of them have.
+    # "missed" is the list of keys of the chunks that were
+    # not loaded (see KhartesThreadedLRUCache.startMissRecording)
+    def sliceValidity(self, data, klru, missed, axis, shape, x1s, y1s):
+        if len(missed) == 0:
+            return None
+        mask = np.full(shape, 255, dtype=np.uint8)
+        for key in missed:
+            rect = self.chunkRectInSlice(data, klru, key, axis)
+            if rect is None:
+                mask[:] = 0
+                break
+            ci0, cj0, ci1, cj1 = rect
+            ci0 -= x1s
+            ci1 -= x1s
+            cj0 -= y1s
+            cj1 -= y1s
+            mask[max(cj0,0):max(cj1,0), max(ci0,0):max(ci1,0)] = 0
+        return mask
+
+    # Returns the rectangle (i0, j0, i1, j1), in slice coordinates,
+    # covered by the chunk with the given key, or None if the
+    # key can't be parsed
+    def chunkRectInSlice(self, data, klru, key, axis):
+        idxs = klru.chunkIndices(key)
+        if idxs is None:
+            return None
+        il, jl = self.ijIndexesInPlaneOfSlice(axis)
+        daxes = data.dataAxes()
+        # data axes corresponding to slice columns and rows
+        dai = daxes[2-il]
+        daj = daxes[2-jl]
+        chunks = klru.chunks
+        ci0 = idxs[dai]*chunks[dai]
+        cj0 = idxs[daj]*chunks[daj]
+        return (ci0, cj0, ci0+chunks[dai], cj0+chunks[daj])
+
+    # "buffers" is the PaintBuffers instance of the window;
+    # buffers.valid is a boolean array, the same size as the
+    # window, that is True where out has already been
+    # painted with data from a loaded chunk.
+    # Zero-valued data cannot be used to tell whether
+    # a pixel has been painted, since zero is a legitimate data value.
     # returns True if out has been completely painted,
     # False otherwise
-    def paintLevel(self, out, axis, oijkt, zoom, direction, level, draw, zarr_max_width):
+    def paintLevel(self, out, buffers, axis, oijkt, zoom, direction, level, draw, zarr_max_width):
         # if not draw:
         #     return True
-        # mask = (out == 0).astype(np.uint8)
-        mask = (out == 0)
-        msum = mask.sum()
-        if msum == 0: # no zeros
-            # print(axis,level.scale,out.min(),out.max(),"no zeros")
+        # part of the window that still needs to be painted
+        mr = buffers.missingRect()
+        if mr is None:
             return True
-        if msum != out.shape[0]*out.shape[1]: # some but not all zeros
-            # dilate the mask by one pixel
-            # to avoid small black lines from appearing
-            # (cause unknown!) during loading
-            kernel = np.ones((3,3,1),dtype=np.bool_)
-            mask = ndimage.binary_dilation(mask, kernel)
-            pass
+        valid = buffers.valid
 
         scale = level.scale
-        data = level.trdatas[direction]
+        # uint8 data stays uint8 through slicing and resizing;
+        # it is converted to uint16 only when it is copied into out
+        data = level.native_trdatas[direction]
 
         z = zoom*scale
         it,jt,kt = oijkt
@@ -1266,15 +2595,25 @@ class CachedZarrVolume():
             cy2 = int(whh+z*(bsy2-fj))
         # print("c", ((cx1,cy1),(cx2,cy2)))
 
-        # locations of upper left and lower right corners of drawing window
-        bx1 = 0
-        by1 = 0
-        bx2 = ww
-        by2 = wh
+        # locations of upper left and lower right corners of
+        # the part of the drawing window that is not yet painted
+        ((bx1,by1),(bx2,by2)) = mr
         # intersection of data slice and drawing window
         ri = Utils.rectIntersection(
                 ((cx1,cy1),(cx2,cy2)), ((bx1,by1),(bx2,by2)))
         # print("ri", ri)
+        # The tile cache is only used if this level was drawn
+        # with the same slice and zoom in the window's previous
+        # redraw (typically, when the user is panning).
+        # When the user is zooming or moving from slice to slice,
+        # the tiles would be drawn but never reused, which
+        # is slower than drawing the window directly.
+        view = (direction, axis, fk, z)
+        repeated = (buffers.views.get(level.ilevel, None) == view)
+        buffers.views[level.ilevel] = view
+        if ri is not None and draw and zarr_max_width <= 0 and self.use_tile_cache and repeated:
+            return self.paintTiles(out, buffers, data, level, axis, 
+                    direction, ijkt, z, ax1, ay1, ri)
         misses0 = level.klru.nz_misses
         if ri is not None:
             # upper left and lower right corners of intersected rectangle
@@ -1292,27 +2631,67 @@ class CachedZarrVolume():
             # print(sw,sh,ww,wh)
             # print(x1,y1,x2,y2)
             # print(x1s,y1s,x2s,y2s)
+            level.klru.startMissRecording()
             slc = self.getSliceInRange(data,
                     slice(x1s,x2s), slice(y1s,y2s), ijkt[axis], 
                     axis)
+            missed = level.klru.stopMissRecording()
             # print(slc.shape)
-            # resize windowed data slice to its size in drawing
-            # window coordinates
-            zslc = cv2.resize(slc, (x2-x1, y2-y1), interpolation=cv2.INTER_AREA)
-            # paste resized data slice into the intersection window
-            # in the drawing window
-            # print("mask, out", mask.shape, out.shape, out[mask].shape, zslc.shape)
-
-            # TODO: 
-            zslc = zslc[:,:,np.newaxis]
+            rw = x2-x1
+            rh = y2-y1
+            oslc = out[y1:y2, x1:x2, 0]
+            vslc = valid[y1:y2, x1:x2]
+            svalid = None
             if draw:
-                buf = np.zeros_like(out)
-                buf[y1:y2, x1:x2, :] = zslc
-                # if scale == 1.:
-                #     buf[buf != 0] = 24000
-                # if level.ilevel != 2:
-                #     buf[buf != 0] = 48000 - level.ilevel*5000
-                out[mask] = buf[mask]
+                svalid = self.sliceValidity(data, level.klru, missed, 
+                        axis, slc.shape[:2], x1s, y1s)
+
+            if draw and svalid is None and not vslc.any():
+                # Common case: nothing has been painted yet in
+                # this rectangle, and all the chunks were loaded,
+                # so resize (and convert) the data slice directly
+                # into out
+                if slc.dtype == np.uint8:
+                    zslc = cv2.resize(slc, (rw, rh), 
+                            dst=buffers.resized(slc.dtype, rh, rw),
+                            interpolation=cv2.INTER_AREA)
+                    cv2.LUT(zslc, self.uint8_to_uint16_lut, dst=oslc)
+                else:
+                    cv2.resize(slc, (rw, rh), dst=oslc,
+                            interpolation=cv2.INTER_AREA)
+                buffers.setValid(x1, y1, x2, y2)
+            elif draw:
+                # resize windowed data slice to its size in drawing
+                # window coordinates
+                zslc = cv2.resize(slc, (rw, rh), 
+                        dst=buffers.resized(slc.dtype, rh, rw),
+                        interpolation=cv2.INTER_AREA)
+                # paste resized data slice into the intersection window
+                # in the drawing window, in the pixels that have not
+                # already been painted
+                paint = buffers.paint[:rh, :rw]
+                np.logical_not(vslc, out=paint)
+                if svalid is not None:
+                    # A pixel is valid only if it is completely
+                    # covered by loaded chunks; this keeps pixels
+                    # that were blended with missing data (which
+                    # is returned as zeros) from being painted.
+                    wvalid = cv2.resize(svalid, (rw, rh), 
+                            dst=buffers.wvalid[:rh, :rw],
+                            interpolation=cv2.INTER_AREA)
+                    mask = buffers.mask[:rh, :rw]
+                    np.equal(wvalid, 255, out=mask)
+                    np.logical_and(paint, mask, out=paint)
+                if zslc.dtype == np.uint8:
+                    zslc = cv2.LUT(zslc, self.uint8_to_uint16_lut, 
+                            dst=buffers.values16[:rh, :rw])
+                if zslc.dtype == oslc.dtype:
+                    # much faster than numpy's masked copy
+                    cv2.copyTo(zslc, paint.view(np.uint8), oslc)
+                else:
+                    np.copyto(oslc, zslc, where=paint, casting='unsafe')
+                np.logical_or(vslc, paint, out=vslc)
+                buffers.updateTiles(x1, y1, x2, y2)
         misses1 = level.klru.nz_misses
             
         # if misses0 = misses1, this means that there were no
@@ -1320,13 +2699,213 @@ class CachedZarrVolume():
         # print("  ms",axis,level.scale,misses0,misses1)
         return misses0 == misses1
 
+    # Returns the range (t1, t2) of tiles that overlap the
+    # pixels p1 to p2 (not including p2) of the resized slice.
+    # Tile t covers voxels t*tv to (t+1)*tv, and pixels
+    # int(t*tv*z) to int((t+1)*tv*z).
+    @staticmethod
+    def tileRange(p1, p2, tv, z, ntiles):
+        def start(t):
+            return int(t*tv*z)
+        t1 = min(max(int(p1/(tv*z)), 0), ntiles-1)
+        while t1 > 0 and start(t1) > p1:
+            t1 -= 1
+        while t1 < ntiles-1 and start(t1+1) <= p1:
+            t1 += 1
+        t2 = t1
+        while t2 < ntiles and start(t2) < p2:
+            t2 += 1
+        return t1, t2
+
+    # Slices, resizes, and converts to uint16 the tiles
+    # ti1 <= ti < ti2, tj1 <= tj < tj2 of the data slice.
+    # This is done in one step, rather than tile by tile, which
+    # would be much slower.
+    # Returns a dict of SliceTile's, indexed by (ti, tj);
+    # tiles too small to cover any pixels are omitted.
+    def renderTiles(self, data, level, axis, k, z, tv, ti1, ti2, tj1, tj2, sw, sh):
+        i1 = ti1*tv
+        i2 = min(ti2*tv, sw)
+        j1 = tj1*tv
+        j2 = min(tj2*tv, sh)
+        x1, x2 = int(i1*z), int(i2*z)
+        y1, y2 = int(j1*z), int(j2*z)
+        tiles = {}
+        if x2 <= x1 or y2 <= y1:
+            return tiles
+        klru = level.klru
+        klru.startMissRecording()
+        slc = self.getSliceInRange(data, slice(i1,i2), slice(j1,j2), k, axis)
+        missed = klru.stopMissRecording()
+        zslc = cv2.resize(slc, (x2-x1, y2-y1), interpolation=cv2.INTER_AREA)
+        if zslc.dtype == np.uint8:
+            zslc = cv2.LUT(zslc, self.uint8_to_uint16_lut)
+        elif zslc.dtype != np.uint16:
+            zslc = zslc.astype(np.uint16)
+        wvalid = None
+        rects = []
+        svalid = self.sliceValidity(data, klru, missed, 
+                axis, slc.shape[:2], i1, j1)
+        if svalid is not None:
+            # see the comments in paintLevel
+            wvalid = cv2.resize(svalid, (x2-x1, y2-y1), interpolation=cv2.INTER_AREA)
+            rects = [(key, self.chunkRectInSlice(data, klru, key, axis)) for key in set(missed)]
+        for tj in range(tj1, tj2):
+            for ti in range(ti1, ti2):
+                ti0v, tj0v = ti*tv, tj*tv
+                ti1v, tj1v = min(ti0v+tv, sw), min(tj0v+tv, sh)
+                tx1, tx2 = int(ti0v*z), int(ti1v*z)
+                ty1, ty2 = int(tj0v*z), int(tj1v*z)
+                if tx2 <= tx1 or ty2 <= ty1:
+                    continue
+                tdata = zslc[ty1-y1:ty2-y1, tx1-x1:tx2-x1].copy()
+                mask = None
+                tmissed = set()
+                if wvalid is not None:
+                    tmask = (wvalid[ty1-y1:ty2-y1, tx1-x1:tx2-x1] == 255)
+                    if not tmask.all():
+                        mask = tmask
+                        # Chunks that (nearly; resizing may blend
+                        # neighboring voxels) overlap the tile.
+                        # The tile is invalidated when any of them
+                        # arrives.
+                        for key, rect in rects:
+                            if rect is None or (
+                                    rect[0] <= ti1v and rect[2] >= ti0v and 
+                                    rect[1] <= tj1v and rect[3] >= tj0v):
+                                tmissed.add(key)
+                tiles[(ti,tj)] = SliceTile(tx1, ty1, tdata, mask, tmissed)
+        return tiles
+
+    # Paints the rectangle ri (in window coordinates) of out,
+    # using tiles of the resized data slice, which are taken from
+    # CachedZarrVolume.tile_cache when possible.
+    # ax1, ay1 is the location, in the window, of the
+    # upper left corner of the data slice.
+    # Returns True if all the tiles were complete.
+    def paintTiles(self, out, buffers, data, level, axis, direction, ijkt, z, ax1, ay1, ri):
+        il, jl = self.ijIndexesInPlaneOfSlice(axis)
+        sw = data.shape[2-il]
+        sh = data.shape[2-jl]
+        k = ijkt[axis]
+        # tile size, in voxels
+        tv = max(int(round(self.tile_pixels/z)), 1)
+        nti = (sw+tv-1)//tv
+        ntj = (sh+tv-1)//tv
+        (rx1,ry1),(rx2,ry2) = ri
+        ti1, ti2 = self.tileRange(rx1-ax1, rx2-ax1, tv, z, nti)
+        tj1, tj2 = self.tileRange(ry1-ay1, ry2-ay1, tv, z, ntj)
+        cache = self.tile_cache
+        klru = level.klru
+        valid = buffers.valid
+        complete = True
+        tiles = {}
+        # range of the tiles that are not in the cache
+        uti1, uti2, utj1, utj2 = ti2, ti1, tj2, tj1
+        for tj in range(tj1, tj2):
+            for ti in range(ti1, ti2):
+                key = (self, direction, axis, k, level.ilevel, z, ti, tj)
+                tile = cache.get(key)
+                if tile is not None and len(tile.missed) > 0:
+                    # Make sure that the missing chunks are still
+                    # requested; if any of them has arrived in 
+                    # the meantime, the tile needs to be redrawn.
+                    # (stillMissing is called on every key, so that
+                    # each of them is requested)
+                    still = [klru.stillMissing(ckey) for ckey in tile.missed]
+                    if not all(still):
+                        cache.invalidate(key)
+                        tile = None
+                if tile is None:
+                    uti1, uti2 = min(uti1, ti), max(uti2, ti+1)
+                    utj1, utj2 = min(utj1, tj), max(utj2, tj+1)
+                    continue
+                tiles[(ti,tj)] = tile
+        if uti1 < uti2:
+            rendered = self.renderTiles(data, level, axis, k, z, tv, 
+                    uti1, uti2, utj1, utj2, sw, sh)
+            for tij, tile in rendered.items():
+                if tij in tiles:
+                    continue
+                key = (self, direction, axis, k, level.ilevel, z)+tij
+                cache.put(key, tile)
+                tiles[tij] = tile
+        for tile in tiles.values():
+            th, tw = tile.data.shape
+            # intersection of tile and ri, in window coordinates
+            x1 = max(ax1+tile.x, rx1)
+            y1 = max(ay1+tile.y, ry1)
+            x2 = min(ax1+tile.x+tw, rx2)
+            y2 = min(ay1+tile.y+th, ry2)
+            if x2 <= x1 or y2 <= y1:
+                continue
+            # the same rectangle, in tile coordinates
+            sx1, sy1 = x1-ax1-tile.x, y1-ay1-tile.y
+            sx2, sy2 = sx1+x2-x1, sy1+y2-y1
+            tdata = tile.data[sy1:sy2, sx1:sx2]
+            oslc = out[y1:y2, x1:x2, 0]
+            vslc = valid[y1:y2, x1:x2]
+            if tile.mask is None and not vslc.any():
+                oslc[:] = tdata
+                vslc[:] = True
+                continue
+            paint = buffers.paint[:y2-y1, :x2-x1]
+            np.logical_not(vslc, out=paint)
+            if tile.mask is not None:
+                complete = False
+                np.logical_and(paint, tile.mask[sy1:sy2, sx1:sx2], out=paint)
+            cv2.copyTo(tdata, paint.view(np.uint8), oslc)
+            np.logical_or(vslc, paint, out=vslc)
+        if complete:
+            # every pixel in ri has been painted
+            buffers.setValid(rx1, ry1, rx2, ry2)
+        else:
+            buffers.updateTiles(rx1, ry1, rx2, ry2)
+        return complete
+
+    # returns the PaintBuffers of the given window, reallocating
+    # them if the size of the window has changed
+    def paintBuffers(self, window, shape):
+        buffers = self.paint_buffers.get(window)
+        if buffers is None or buffers.shape != tuple(shape):
+            buffers = PaintBuffers(shape)
+            self.paint_buffers[window] = buffers
+        return buffers
+
     def paintSlice(self, out, axis, ijkt, zoom, zarr_max_width, direction):
+        # tell the scheduler which window is asking for data
+        window = self.window_names[axis]
+        self.scheduler.setRequester(window)
+        try:
+            return self.paintWindowSlice(window, out, axis, ijkt, zoom, zarr_max_width, direction)
+        finally:
+            # other reads by this thread (for instance, those
+            # made by DataWindow.sliceST) are not made on
+            # behalf of the window
+            self.scheduler.setRequester(None)
+
+    # called by paintSlice, once the requester is set
+    def paintWindowSlice(self, window, out, axis, ijkt, zoom, zarr_max_width, direction):
+        # tell the scheduler where the window is looking
+        gijk = self.transposedIjkToGlobalPosition(ijkt, direction)
+        gaxis = self.globalAxisFromTransposedAxis(axis, direction)
+        self.scheduler.setView(window, gaxis, gijk)
+        self.scheduler.startChunkSet(window)
+
         level = self.levels[0]
         draw = True
+        # keeps track of the pixels of out that have been painted
+        buffers = self.paintBuffers(window, out.shape[:2])
+        buffers.reset()
         if len(self.levels) == 1:
             self.paintLevel(
-                    out, axis, ijkt, zoom, direction, level, 
+                    out, buffers, axis, ijkt, zoom, direction, level, 
                     draw, zarr_max_width)
+            # requests from previous paints that were not
+            # repeated in this one are no longer needed
+            self.scheduler.finishChunkSet(window)
+            self.prefetchAhead(window, out.shape[:2], axis, ijkt, zoom, 
+                    direction, level, zarr_max_width)
             return True
         if len(self.levels) > 1:
             for i in range(len(self.levels)):
@@ -1345,12 +2924,16 @@ class CachedZarrVolume():
             # print("level", axis, i, draw)
             # zarr_max_width is set to 0 for the multi-resolution case
             result = self.paintLevel(
-                    out, axis, ijkt, zoom, direction, 
+                    out, buffers, axis, ijkt, zoom, direction, 
                     level, draw, 0)
             if result:
                 break
                 # draw = False
 
+        self.scheduler.finishChunkSet(window)
+        self.prefetchAhead(window, out.shape[:2], axis, ijkt, zoom, 
+                direction, self.levels[start], 0)
+
         '''
         for level in self.levels:
             n = len(level.klru._values_cache)
@@ -1362,6 +2945,123 @@ class CachedZarrVolume():
 
         return True
 
+    # Watches how the view moves from one redraw of the window
+    # to the next, and prefetches (at low priority) the chunks
+    # that will be needed if the movement continues:
+    # if the user is stepping through slices, the chunks of
+    # the next prefetch_slices slices; if the user is panning,
+    # the chunks of the region beyond the edge of the window
+    # in the direction of the pan.
+    # "level" is the level that matches the current zoom.
+    # Redraws where the view did not move (for instance, those 
+    # triggered by the arrival of chunks) leave the current
+    # prefetch requests in place.
+    def prefetchAhead(self, window, shape, axis, ijkt, zoom, direction, level, zarr_max_width):
+        view = (axis, direction, tuple(ijkt), zoom)
+        prev = self.prefetch_views.get(window, None)
+        self.prefetch_views[window] = view
+        if not self.use_prefetch or prev is None:
+            return
+        if prev[0] != axis or prev[1] != direction or prev[3] != zoom:
+            return
+        il, jl = self.ijIndexesInPlaneOfSlice(axis)
+        dk = ijkt[axis]-prev[2][axis]
+        di = ijkt[il]-prev[2][il]
+        dj = ijkt[jl]-prev[2][jl]
+        if dk == 0 and di == 0 and dj == 0:
+            return
+
+        data = level.trdatas[direction]
+        iscale = int(level.scale)
+        z = zoom*level.scale
+        wh, ww = shape
+        # visible part of the slice, in level coordinates
+        fi, fj, fk = ijkt[il]//iscale, ijkt[jl]//iscale, ijkt[axis]//iscale
+        hw = int(ww/(2*z))+1
+        hh = int(wh/(2*z))+1
+        i1, i2 = fi-hw, fi+hw
+        j1, j2 = fj-hh, fj+hh
+        k1, k2 = fk, fk+1
+        if dk != 0:
+            # the next slices, in the direction of travel
+            n = self.prefetch_slices
+            if dk > 0:
+                k1, k2 = (ijkt[axis]+1)//iscale, (ijkt[axis]+n)//iscale+1
+            else:
+                k1, k2 = (ijkt[axis]-n)//iscale, (ijkt[axis]-1)//iscale+1
+        else:
+            # the region next to the window, in the direction of the pan
+            if di > 0:
+                i2 += hw
+            elif di < 0:
+                i1 -= hw
+            if dj > 0:
+                j2 += hh
+            elif dj < 0:
+                j1 -= hh
+        if zarr_max_width > 0:
+            rb = self.getSliceBounds(axis, ijkt, zarr_max_width, direction)
+            if rb is None:
+                return
+            ((bi1,bj1),(bi2,bj2)) = rb
+            i1, i2 = max(i1, bi1), min(i2, bi2)
+            j1, j2 = max(j1, bj1), min(j2, bj2)
+        keys = self.chunkKeysInRange(data, level.klru, axis, 
+                (i1,i2), (j1,j2), (k1,k2), (fi,fj,fk))
+
+        pwindow = self.scheduler.prefetchRequester(window)
+        gijk = self.transposedIjkToGlobalPosition(ijkt, direction)
+        gaxis = self.globalAxisFromTransposedAxis(axis, direction)
+        self.scheduler.setRequester(pwindow)
+        try:
+            self.scheduler.setView(pwindow, gaxis, gijk)
+            self.scheduler.startChunkSet(pwindow)
+            for key in keys:
+                level.klru.prefetch(key)
+            # prefetch requests that were made for the previous
+            # movement, and not repeated, are cancelled
+            self.scheduler.finishChunkSet(pwindow)
+        finally:
+            self.scheduler.setRequester(None)
+
+    # Returns the keys of the chunks covering the given ranges
+    # (in the level's transposed ijk coordinates), sorted so that
+    # the chunks nearest to the focus point come first.
+    def chunkKeysInRange(self, data, klru, axis, irange, jrange, krange, focus):
+        if klru.chunks is None:
+            return []
+        il, jl = self.ijIndexesInPlaneOfSlice(axis)
+        daxes = data.dataAxes()
+        # data axes corresponding to slice columns, rows, and depth
+        tas = (il, jl, axis)
+        das = [daxes[2-ta] for ta in tas]
+        ranges = (irange, jrange, krange)
+        cranges = []
+        for t in range(3):
+            da = das[t]
+            size = data.shape[2-tas[t]]
+            c = klru.chunks[da]
+            v1 = max(ranges[t][0], 0)
+            v2 = min(ranges[t][1], size)
+            if v2 <= v1:
+                return []
+            cranges.append(range(v1//c, (v2-1)//c+1))
+        items = []
+        for ck in cranges[2]:
+            for cj in cranges[1]:
+                for ci in cranges[0]:
+                    cidxs = (ci, cj, ck)
+                    idxs = [0]*3
+                    dist = 0
+                    for t in range(3):
+                        c = klru.chunks[das[t]]
+                        idxs[das[t]] = cidxs[t]
+                        center = (cidxs[t]+.5)*c
+                        dist += (center-focus[t])**2
+                    items.append((dist, klru.chunkKey(idxs)))
+        items.sort()
+        return [key for dist, key in items]
+
     def ijIndexesInPlaneOfSlice(self, axis):
         return ((1,2), (0,2), (0,1))[axis]
 